@@ -0,0 +1,154 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from diffusers import AutoencoderKL, DDPMScheduler
+from transformers import AutoTokenizer, CLIPImageProcessor, CLIPVisionModelWithProjection, CLIPTextModelWithProjection, CLIPTextModel
+
+from src.unet_hacked_tryon import UNet2DConditionModel
+from src.unet_hacked_garmnet import UNet2DConditionModel as UNet2DConditionModel_ref
+from src.tryon_pipeline import StableDiffusionXLInpaintPipeline as TryonPipeline
+from src.prompt_cache import GARMENT_PROMPT_TEMPLATE, NEGATIVE_PROMPT, PERSON_PROMPT_TEMPLATE
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per-step time of the try-on pipeline with and without the cross-attention K/V cache.")
+    parser.add_argument("--pretrained_model_name_or_path",type=str,default= "yisol/IDM-VTON",required=False,)
+    parser.add_argument("--width",type=int,default=768,)
+    parser.add_argument("--height",type=int,default=1024,)
+    parser.add_argument("--num_inference_steps",type=int,default=30,)
+    parser.add_argument("--batch_size",type=int,default=1,)
+    parser.add_argument("--repeats",type=int,default=3,)
+    parser.add_argument("--guidance_scale",type=float,default=2.0,)
+    parser.add_argument("--seed", type=int, default=42,)
+    args = parser.parse_args()
+    return args
+
+
+def synthetic_inputs(args, device):
+    # per-step cost does not depend on the image content
+    rng = np.random.default_rng(args.seed)
+    size = (args.width, args.height)
+    human_img = Image.fromarray(rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8))
+    garm_img = Image.fromarray(rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8))
+    mask = Image.new("L", size, 0)
+    mask.paste(255, (args.width // 4, args.height // 5, 3 * args.width // 4, 3 * args.height // 5))
+    pose_img = torch.rand(args.batch_size, 3, args.height, args.width, device=device, dtype=torch.float16) * 2 - 1
+    cloth = torch.rand(args.batch_size, 3, args.height, args.width, device=device, dtype=torch.float16) * 2 - 1
+    return {
+        "image": [human_img] * args.batch_size,
+        "mask_image": [mask] * args.batch_size,
+        "ip_adapter_image": [garm_img] * args.batch_size,
+        "pose_img": pose_img,
+        "cloth": cloth,
+    }
+
+
+def timed_run(pipe, args, inputs, embeds, device):
+    step_ends = []
+
+    def on_step_end(pipe, i, t, callback_kwargs):
+        torch.cuda.synchronize()
+        step_ends.append(time.perf_counter())
+        return {}
+
+    generator = torch.Generator(device).manual_seed(args.seed)
+    with torch.cuda.amp.autocast(), torch.inference_mode():
+        images = pipe(
+            **embeds,
+            **inputs,
+            num_inference_steps=args.num_inference_steps,
+            generator=generator,
+            strength=1.0,
+            height=args.height,
+            width=args.width,
+            guidance_scale=args.guidance_scale,
+            output_type="pt",
+            callback_on_step_end=on_step_end,
+        )[0]
+    # the first step also carries the setup before the loop, only the following ones are compared
+    return np.diff(step_ends), images
+
+
+def main():
+    args = parse_args()
+    device = "cuda"
+
+    noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", torch_dtype=torch.float16)
+    unet = UNet2DConditionModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet", torch_dtype=torch.float16)
+    image_encoder = CLIPVisionModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder", torch_dtype=torch.float16)
+    unet_encoder = UNet2DConditionModel_ref.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet_encoder", torch_dtype=torch.float16)
+    text_encoder_one = CLIPTextModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder", torch_dtype=torch.float16)
+    text_encoder_two = CLIPTextModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder_2", torch_dtype=torch.float16)
+    tokenizer_one = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer", revision=None, use_fast=False)
+    tokenizer_two = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer_2", revision=None, use_fast=False)
+    for model in (vae, unet, image_encoder, unet_encoder, text_encoder_one, text_encoder_two):
+        model.requires_grad_(False)
+
+    pipe = TryonPipeline.from_pretrained(
+            args.pretrained_model_name_or_path,
+            unet=unet,
+            vae=vae,
+            feature_extractor= CLIPImageProcessor(),
+            text_encoder = text_encoder_one,
+            text_encoder_2 = text_encoder_two,
+            tokenizer = tokenizer_one,
+            tokenizer_2 = tokenizer_two,
+            scheduler = noise_scheduler,
+            image_encoder=image_encoder,
+            unet_encoder = unet_encoder,
+            torch_dtype=torch.float16,
+    ).to(device)
+    pipe.set_progress_bar_config(disable=True)
+
+    inputs = synthetic_inputs(args, device)
+    with torch.cuda.amp.autocast(), torch.inference_mode():
+        prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = pipe.encode_prompt(
+            [PERSON_PROMPT_TEMPLATE + "a shirt"] * args.batch_size,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=True,
+            negative_prompt=[NEGATIVE_PROMPT] * args.batch_size,
+        )
+        prompt_embeds_c, _, _, _ = pipe.encode_prompt(
+            [GARMENT_PROMPT_TEMPLATE + "a shirt"] * args.batch_size,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=False,
+        )
+    embeds = {
+        "prompt_embeds": prompt_embeds,
+        "negative_prompt_embeds": negative_prompt_embeds,
+        "pooled_prompt_embeds": pooled_prompt_embeds,
+        "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds,
+        "text_embeds_cloth": prompt_embeds_c,
+    }
+
+    results = {}
+    outputs = {}
+    for mode in ("off", "on"):
+        if mode == "on":
+            kv_cache = pipe.enable_kv_cache()
+        timed_run(pipe, args, inputs, embeds, device)  # warmup
+        step_times = []
+        for _ in range(args.repeats):
+            times, outputs[mode] = timed_run(pipe, args, inputs, embeds, device)
+            step_times.extend(times)
+        results[mode] = {
+            "step_ms_mean": float(np.mean(step_times) * 1000),
+            "step_ms_p50": float(np.percentile(step_times, 50) * 1000),
+        }
+        if mode == "on":
+            results[mode]["kv_cache"] = kv_cache.report()
+            pipe.disable_kv_cache()
+
+    results["step_ms_saved"] = results["off"]["step_ms_mean"] - results["on"]["step_ms_mean"]
+    results["speedup"] = results["off"]["step_ms_mean"] / results["on"]["step_ms_mean"]
+    results["max_abs_diff"] = float((outputs["off"].float() - outputs["on"].float()).abs().max())
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+
+import torch
+from PIL import Image
+from diffusers import AutoencoderKL, DDPMScheduler
+from transformers import AutoTokenizer, CLIPImageProcessor, CLIPVisionModelWithProjection, CLIPTextModelWithProjection, CLIPTextModel
+
+from src.unet_hacked_tryon import UNet2DConditionModel
+from src.unet_hacked_garmnet import UNet2DConditionModel as UNet2DConditionModel_ref
+from src.tryon_pipeline import StableDiffusionXLInpaintPipeline as TryonPipeline
+from src.tryon_server import TryonRequest, benchmark_batching
+from src.prompt_cache import vitonhd_garment_descriptions
+from src.roi import select_roi
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Throughput and latency of the batching try-on server on VITON-HD test pairs.")
+    parser.add_argument("--pretrained_model_name_or_path",type=str,default= "yisol/IDM-VTON",required=False,)
+    parser.add_argument("--data_dir",type=str,required=True,)
+    parser.add_argument("--width",type=int,default=768,)
+    parser.add_argument("--height",type=int,default=1024,)
+    parser.add_argument("--num_inference_steps",type=int,default=30,)
+    parser.add_argument("--num_requests",type=int,default=16,)
+    parser.add_argument("--batch_sizes",type=str,default="1,2,4,8",)
+    parser.add_argument("--max_wait_ms",type=float,default=50.0,)
+    parser.add_argument("--roi", action="store_true", help="Denoise only the padded mask region of every request, see src/roi.py.")
+    parser.add_argument("--seed", type=int, default=42,)
+    args = parser.parse_args()
+    return args
+
+
+def load_requests(args, roi=False):
+    test_dir = os.path.join(args.data_dir, "test")
+    descriptions = vitonhd_garment_descriptions(os.path.join(test_dir, "vitonhd_test_tagged.json"))
+    size = (args.width, args.height)
+    requests = []
+    with open(os.path.join(args.data_dir, "test_pairs.txt"), "r") as f:
+        for i, line in enumerate(f.readlines()[: args.num_requests]):
+            im_name, c_name = line.strip().split()
+            human_img = Image.open(os.path.join(test_dir, "image", im_name)).convert("RGB").resize(size)
+            mask = Image.open(os.path.join(test_dir, "agnostic-mask", im_name.replace(".jpg", "_mask.png"))).resize(size)
+            pose_img = Image.open(os.path.join(test_dir, "image-densepose", im_name)).convert("RGB").resize(size)
+            crop = select_roi(mask) if roi else None
+            if crop is not None:
+                human_img, mask, pose_img = crop.crop(human_img), crop.crop(mask), crop.crop(pose_img)
+            requests.append(
+                TryonRequest(
+                    human_img=human_img,
+                    mask=mask,
+                    pose_img=pose_img,
+                    garm_img=Image.open(os.path.join(test_dir, "cloth", c_name)).convert("RGB").resize(size),
+                    garment_des=descriptions.get(c_name, "shirts"),
+                    num_inference_steps=args.num_inference_steps,
+                    seed=args.seed + i,
+                    size=crop.size if crop is not None else None,
+                )
+            )
+    if roi:
+        # requests are only batched with others of the same region size
+        sizes = [r.size or size for r in requests]
+        print(json.dumps({"roi_area_fraction": sum(w * h for w, h in sizes) / (len(sizes) * size[0] * size[1]), "roi_sizes": len(set(sizes))}))
+    return requests
+
+
+def main():
+    args = parse_args()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", torch_dtype=torch.float16)
+    unet = UNet2DConditionModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet", torch_dtype=torch.float16)
+    image_encoder = CLIPVisionModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder", torch_dtype=torch.float16)
+    unet_encoder = UNet2DConditionModel_ref.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet_encoder", torch_dtype=torch.float16)
+    text_encoder_one = CLIPTextModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder", torch_dtype=torch.float16)
+    text_encoder_two = CLIPTextModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder_2", torch_dtype=torch.float16)
+    tokenizer_one = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer", revision=None, use_fast=False)
+    tokenizer_two = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer_2", revision=None, use_fast=False)
+    for model in (vae, unet, image_encoder, unet_encoder, text_encoder_one, text_encoder_two):
+        model.requires_grad_(False)
+
+    pipe = TryonPipeline.from_pretrained(
+            args.pretrained_model_name_or_path,
+            unet=unet,
+            vae=vae,
+            feature_extractor= CLIPImageProcessor(),
+            text_encoder = text_encoder_one,
+            text_encoder_2 = text_encoder_two,
+            tokenizer = tokenizer_one,
+            tokenizer_2 = tokenizer_two,
+            scheduler = noise_scheduler,
+            image_encoder=image_encoder,
+            unet_encoder = unet_encoder,
+            torch_dtype=torch.float16,
+    ).to(device)
+
+    requests = load_requests(args, roi=args.roi)
+    reports = benchmark_batching(
+        pipe,
+        requests,
+        batch_sizes=[int(b) for b in args.batch_sizes.split(",") if b],
+        max_wait_ms=args.max_wait_ms,
+    )
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
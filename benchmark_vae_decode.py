@@ -0,0 +1,135 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from diffusers import AutoencoderKL
+
+from src.tryon_pipeline import StableDiffusionXLInpaintPipeline as TryonPipeline
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Latency and peak memory of the VAE decode: per-request upcast, resident float32 decoder and fp16-safe decoder, each plain, sliced and tiled.")
+    parser.add_argument("--pretrained_model_name_or_path",type=str,default= "yisol/IDM-VTON",required=False,)
+    parser.add_argument("--vae_decoder",type=str,default=None, help="fp16-safe VAE to compare, e.g. madebyollin/sdxl-vae-fp16-fix.")
+    parser.add_argument("--resolutions",type=str,default="768x1024,1536x2048", help="Comma separated WIDTHxHEIGHT output sizes.")
+    parser.add_argument("--batch_sizes",type=str,default="1,4",)
+    parser.add_argument("--image",type=str,default=None, help="Image encoded to get the latents, random latents otherwise.")
+    parser.add_argument("--repeats",type=int,default=3,)
+    parser.add_argument("--seed", type=int, default=42,)
+    parser.add_argument("--output",type=str,default="vae_decode_benchmark.json",)
+    args = parser.parse_args()
+    return args
+
+
+def make_latents(pipe, args, width, height, batch_size, device):
+    generator = torch.Generator(device).manual_seed(args.seed)
+    if args.image is None:
+        # decode cost does not depend on the content, fp16 overflows may
+        shape = (batch_size, pipe.vae.config.latent_channels, height // pipe.vae_scale_factor, width // pipe.vae_scale_factor)
+        return torch.randn(shape, generator=generator, device=device, dtype=torch.float16)
+    image = Image.open(args.image).convert("RGB").resize((width, height))
+    image = pipe.image_processor.preprocess(image, height=height, width=width).repeat(batch_size, 1, 1, 1)
+    return pipe.encode_vae_images({"image": image}, device, torch.float16, generator=generator)["image"]
+
+
+def decode_per_request_upcast(pipe, latents):
+    # the decode of the pipeline before the resident decoder: upcast, decode and cast the whole VAE back
+    pipe.upcast_vae()
+    latents = latents.to(next(iter(pipe.vae.post_quant_conv.parameters())).dtype)
+    image = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False)[0]
+    pipe.vae.to(dtype=torch.float16)
+    return image
+
+
+def set_decode(pipe, variant):
+    pipe.disable_vae_slicing()
+    pipe.disable_vae_tiling()
+    if variant == "sliced":
+        pipe.enable_vae_slicing()
+    elif variant == "tiled":
+        pipe.enable_vae_tiling()
+
+
+def measure(decode_fn, latents, repeats):
+    try:
+        with torch.inference_mode():
+            decode_fn(latents)  # warmup
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            baseline = torch.cuda.memory_allocated()
+            seconds = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                image = decode_fn(latents)
+                torch.cuda.synchronize()
+                seconds.append(time.perf_counter() - start)
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        return {"oom": True}, None
+    result = {
+        "ms_mean": float(np.mean(seconds) * 1000),
+        "ms_per_image": float(np.mean(seconds) * 1000 / latents.shape[0]),
+        "peak_mb": (torch.cuda.max_memory_allocated() - baseline) / 2**20,
+        "nan": bool(torch.isnan(image).any()),
+    }
+    image = image.float().cpu()
+    torch.cuda.empty_cache()
+    return result, image
+
+
+def main():
+    args = parse_args()
+    device = "cuda"
+
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", torch_dtype=torch.float16)
+    vae.requires_grad_(False)
+    pipe = TryonPipeline(
+        vae=vae,
+        text_encoder=None,
+        text_encoder_2=None,
+        tokenizer=None,
+        tokenizer_2=None,
+        unet=None,
+        unet_encoder=None,
+        scheduler=None,
+    ).to(device)
+    vae_decoder = None
+    if args.vae_decoder is not None:
+        vae_decoder = AutoencoderKL.from_pretrained(args.vae_decoder, torch_dtype=torch.float16)
+
+    # the per-request upcast has to run first, the resident decoder stays upcast afterwards
+    modes = [("per_request_upcast", lambda latents: decode_per_request_upcast(pipe, latents))]
+    modes.append(("resident", pipe.decode_vae_latents))
+    if vae_decoder is not None:
+        modes.append(("fp16_safe", pipe.decode_vae_latents))
+
+    results = []
+    references = {}
+    for mode, decode_fn in modes:
+        if mode == "fp16_safe":
+            pipe.set_vae_decoder(vae_decoder)
+        for resolution in args.resolutions.split(","):
+            width, height = (int(x) for x in resolution.split("x"))
+            for batch_size in [int(b) for b in args.batch_sizes.split(",") if b]:
+                latents = make_latents(pipe, args, width, height, batch_size, device)
+                for variant in ("plain", "sliced", "tiled"):
+                    set_decode(pipe, variant)
+                    result, image = measure(decode_fn, latents, args.repeats)
+                    key = (resolution, batch_size)
+                    if image is not None and key not in references:
+                        references[key] = image
+                    elif image is not None:
+                        result["max_abs_diff"] = float((image - references[key]).abs().max())
+                    result = {"mode": mode, "resolution": resolution, "batch_size": batch_size, "variant": variant, **result}
+                    print(json.dumps(result))
+                    results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,14 @@ sys.path.append('./')
 from PIL import Image
 import gradio as gr
 from src.tryon_pipeline import StableDiffusionXLInpaintPipeline as TryonPipeline
+from src.tryon_server import BatchingTryonServer, TryonRequest, encode_person_latents
+from src.person_cache import PersonSession, PersonSessionCache, person_key
+from src.roi import select_roi
+from src.stage_timer import StageTimer
+from src.model_registry import ModelRegistry, load_model_mmap
+from src.staged_pipeline import Stage, StagedPipeline
+from src.samplers import SAMPLERS
+from src.mask_utils import pil_to_binary_mask, masked_gray, to_pil_images, to_uint8_tensor
 from src.unet_hacked_garmnet import UNet2DConditionModel as UNet2DConditionModel_ref
 from src.unet_hacked_tryon import UNet2DConditionModel
 from transformers import (
@@ -16,230 +24,329 @@ from typing import List
 
 import torch
 import os
+import json
+import threading
+import logging
+import time
+from contextlib import nullcontext
 from transformers import AutoTokenizer
 import numpy as np
 from utils_mask import get_mask_location
-from torchvision import transforms
 import apply_net
 from preprocess.humanparsing.run_parsing import Parsing
 from preprocess.openpose.run_openpose import OpenPose
 from detectron2.data.detection_utils import convert_PIL_to_numpy,_apply_exif_orientation
-from torchvision.transforms.functional import to_pil_image
 
-device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-
-def pil_to_binary_mask(pil_image, threshold=0):
-    np_image = np.array(pil_image)
-    grayscale_image = Image.fromarray(np_image).convert("L")
-    binary_mask = np.array(grayscale_image) > threshold
-    mask = np.zeros(binary_mask.shape, dtype=np.uint8)
-    for i in range(binary_mask.shape[0]):
-        for j in range(binary_mask.shape[1]):
-            if binary_mask[i,j] == True :
-                mask[i,j] = 1
-    mask = (mask*255).astype(np.uint8)
-    output_mask = Image.fromarray(mask)
-    return output_mask
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
+device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
 
 base_path = 'yisol/IDM-VTON'
 example_path = os.path.join(os.path.dirname(__file__), 'example')
 
-unet = UNet2DConditionModel.from_pretrained(
-    base_path,
-    subfolder="unet",
-    torch_dtype=torch.float16,
-)
-unet.requires_grad_(False)
-tokenizer_one = AutoTokenizer.from_pretrained(
-    base_path,
-    subfolder="tokenizer",
-    revision=None,
-    use_fast=False,
-)
-tokenizer_two = AutoTokenizer.from_pretrained(
-    base_path,
-    subfolder="tokenizer_2",
-    revision=None,
-    use_fast=False,
-)
-noise_scheduler = DDPMScheduler.from_pretrained(base_path, subfolder="scheduler")
+def frozen(model):
+    model.requires_grad_(False)
+    return model
 
-text_encoder_one = CLIPTextModel.from_pretrained(
+# independent components load concurrently, the diffusers models memory-mapped straight into float16 on the device;
+# the preprocessing models are only needed once the first request arrives and load in the background
+models = ModelRegistry(max_workers=int(os.environ.get("TRYON_LOAD_WORKERS", 4)))
+models.register("unet", lambda: frozen(load_model_mmap(UNet2DConditionModel, base_path, "unet", torch.float16, device)))
+# "stabilityai/stable-diffusion-xl-base-1.0",
+models.register("unet_encoder", lambda: frozen(load_model_mmap(UNet2DConditionModel_ref, base_path, "unet_encoder", torch.float16, device)))
+models.register("vae", lambda: frozen(load_model_mmap(AutoencoderKL, base_path, "vae", torch.float16, device)))
+models.register("text_encoder", lambda: frozen(CLIPTextModel.from_pretrained(
     base_path,
     subfolder="text_encoder",
     torch_dtype=torch.float16,
-)
-text_encoder_two = CLIPTextModelWithProjection.from_pretrained(
+    low_cpu_mem_usage=True,
+).to(device)))
+models.register("text_encoder_2", lambda: frozen(CLIPTextModelWithProjection.from_pretrained(
     base_path,
     subfolder="text_encoder_2",
     torch_dtype=torch.float16,
-)
-image_encoder = CLIPVisionModelWithProjection.from_pretrained(
+    low_cpu_mem_usage=True,
+).to(device)))
+models.register("image_encoder", lambda: frozen(CLIPVisionModelWithProjection.from_pretrained(
     base_path,
     subfolder="image_encoder",
     torch_dtype=torch.float16,
-    )
-vae = AutoencoderKL.from_pretrained(base_path,
-                                    subfolder="vae",
-                                    torch_dtype=torch.float16,
-)
-
-# "stabilityai/stable-diffusion-xl-base-1.0",
-UNet_Encoder = UNet2DConditionModel_ref.from_pretrained(
+    low_cpu_mem_usage=True,
+).to(device)))
+models.register("tokenizer", lambda: AutoTokenizer.from_pretrained(
     base_path,
-    subfolder="unet_encoder",
-    torch_dtype=torch.float16,
+    subfolder="tokenizer",
+    revision=None,
+    use_fast=False,
+))
+models.register("tokenizer_2", lambda: AutoTokenizer.from_pretrained(
+    base_path,
+    subfolder="tokenizer_2",
+    revision=None,
+    use_fast=False,
+))
+models.register("scheduler", lambda: DDPMScheduler.from_pretrained(base_path, subfolder="scheduler"))
+
+def load_openpose():
+    model = OpenPose(0)
+    model.preprocessor.body_estimation.model.to(device)
+    return model
+
+models.register("parsing", lambda: Parsing(0), lazy=True)
+models.register("openpose", load_openpose, lazy=True)
+models.register("densepose", lambda: apply_net.DensePoseService(
+    './configs/densepose_rcnn_R_50_FPN_s1x.yaml',
+    './ckpt/densepose/model_final_162be9.pkl',
+    visualizations='dp_segm',
+    opts=['MODEL.DEVICE', 'cuda' if torch.cuda.is_available() else 'cpu'],
+), lazy=True)
+models.load()
+
+pipe = TryonPipeline(
+        unet=models["unet"],
+        unet_encoder=models["unet_encoder"],
+        vae=models["vae"],
+        feature_extractor= CLIPImageProcessor(),
+        text_encoder = models["text_encoder"],
+        text_encoder_2 = models["text_encoder_2"],
+        tokenizer = models["tokenizer"],
+        tokenizer_2 = models["tokenizer_2"],
+        scheduler = models["scheduler"],
+        image_encoder=models["image_encoder"],
+)
+logger.info(json.dumps({"event": "startup_timeline", **models.timeline()}))
+if os.environ.get("TRYON_STARTUP_TIMELINE"):
+    models.save_timeline(os.environ["TRYON_STARTUP_TIMELINE"])
+# the negative prompt is constant and garment descriptions repeat across requests
+pipe.enable_prompt_cache(max_entries=256)
+pipe.enable_kv_cache()
+# concurrent requests within 50ms are run as one batch
+max_batch_size = 4
+tryon_server = BatchingTryonServer(pipe, max_batch_size=max_batch_size, max_wait_ms=50, step_buckets=(10, 15, 20, 25, 30, 35, 40))
+# TRYON_COMPILED_STEP=cuda_graph (or inductor, compiled first) replays the UNet/GarmentNet step as CUDA graphs, captured
+# for every batch size with and without guidance before serving; other shapes, e.g. regions of interest, run eagerly
+compiled_step_mode = os.environ.get("TRYON_COMPILED_STEP", "off")
+if compiled_step_mode not in ("off", "cuda_graph", "inductor"):
+    raise ValueError(f"TRYON_COMPILED_STEP has to be one of off, cuda_graph or inductor but is {compiled_step_mode}.")
+if compiled_step_mode != "off" and torch.cuda.is_available():
+    pipe.enable_compiled_step(compile=compiled_step_mode == "inductor", max_graphs=2 * max_batch_size)
+    logger.info(json.dumps({"event": "compiled_step_warmup", **tryon_server.warmup()}))
+# the preprocessing models load after the graph capture, which must not overlap with other GPU allocations or copies
+models.warm_lazy()
+# per-stage timings of every request are logged and returned; TRYON_TRACE_DIR additionally dumps profiler traces of the
+# first TRYON_TRACE_REQUESTS requests, one at a time since only one profiler can run in a process
+stage_timing = os.environ.get("TRYON_STAGE_TIMING", "1") != "0"
+trace_dir = os.environ.get("TRYON_TRACE_DIR")
+trace_requests = int(os.environ.get("TRYON_TRACE_REQUESTS", 8))
+trace_lock = threading.Lock()
+# pose, parsing, mask, DensePose and their VAE latents per shopper photo, reused for every further garment
+person_sessions = PersonSessionCache(
+    max_entries=int(os.environ.get("TRYON_PERSON_CACHE_SIZE", 64)),
+    ttl_seconds=float(os.environ.get("TRYON_PERSON_CACHE_TTL", 1800)),
 )
 
-parsing_model = Parsing(0)
-openpose_model = OpenPose(0)
-
-UNet_Encoder.requires_grad_(False)
-image_encoder.requires_grad_(False)
-vae.requires_grad_(False)
-unet.requires_grad_(False)
-text_encoder_one.requires_grad_(False)
-text_encoder_two.requires_grad_(False)
-tensor_transfrom = transforms.Compose(
-            [
-                transforms.ToTensor(),
-                transforms.Normalize([0.5], [0.5]),
-            ]
+def prepare_stage(job):
+    timer = job["timer"]
+    with timer.stage("load_inputs"):
+        garm_img= job["garm_img"].convert("RGB").resize((768,1024))
+        human_img_orig = job["dict"]["background"].convert("RGB")    
+
+        if job["is_checked_crop"]:
+            width, height = human_img_orig.size
+            target_width = int(min(width, height * (3 / 4)))
+            target_height = int(min(height, width * (4 / 3)))
+            left = (width - target_width) / 2
+            top = (height - target_height) / 2
+            right = (width + target_width) / 2
+            bottom = (height + target_height) / 2
+            cropped_img = human_img_orig.crop((left, top, right, bottom))
+            job["crop_size"] = cropped_img.size
+            job["crop_origin"] = (int(left), int(top))
+            human_img = cropped_img.resize((768,1024))
+        else:
+            human_img = human_img_orig.resize((768,1024))
+
+        session_key = person_key(
+            human_img,
+            auto_mask=bool(job["is_checked"]),
+            category="upper_body",
+            mask=None if job["is_checked"] else job["dict"]['layers'][0],
+            roi=bool(job["use_roi"]),
+        )
+    job.update(garm_img=garm_img, human_img_orig=human_img_orig, human_img=human_img, session_key=session_key)
+    job["session"] = person_sessions.get(session_key)
+    return job
+
+
+def pose_stage(job):
+    # the person stages only run for a new shopper photo
+    if job["session"] is None and job["is_checked"]:
+        with job["timer"].stage("openpose"):
+            job["keypoints"] = models["openpose"](job["human_img"].resize((384,512)))
+    return job
+
+
+def parse_stage(job):
+    if job["session"] is None and job["is_checked"]:
+        with job["timer"].stage("parsing"):
+            job["model_parse"], _ = models["parsing"](job["human_img"].resize((384,512)))
+    return job
+
+
+def mask_stage(job):
+    if job["session"] is not None:
+        return job
+    with job["timer"].stage("mask"):
+        if job["is_checked"]:
+            mask, mask_gray = get_mask_location('hd', "upper_body", job["model_parse"], job["keypoints"])
+            mask = mask.resize((768,1024))
+        else:
+            mask = pil_to_binary_mask(job["dict"]['layers'][0].convert("RGB").resize((768, 1024)))
+            # mask = transforms.ToTensor()(mask)
+            # mask = mask.unsqueeze(0)
+        mask_gray = masked_gray(job["human_img"], to_uint8_tensor(mask).float().div(255))
+        job["mask"] = mask
+        job["mask_gray"] = to_pil_images(mask_gray)[0]
+    return job
+
+
+def densepose_stage(job):
+    if job["session"] is not None:
+        return job
+    with job["timer"].stage("densepose"):
+        human_img_arg = _apply_exif_orientation(job["human_img"].resize((384,512)))
+        human_img_arg = convert_PIL_to_numpy(human_img_arg, format="BGR")
+
+        pose_img = models["densepose"](human_img_arg)
+        pose_img = pose_img[:,:,::-1]    
+        job["pose_img"] = Image.fromarray(pose_img).resize((768,1024))
+    return job
+
+
+def encode_stage(job):
+    if job["session"] is not None:
+        return job
+    human_img, mask, pose_img = job["human_img"], job["mask"], job["pose_img"]
+    # in region of interest mode only the padded garment region is denoised, at the frame's pixel density
+    roi = select_roi(mask) if job["use_roi"] else None
+    with job["timer"].stage("person_encode"):
+        if roi is not None:
+            latents = encode_person_latents(
+                pipe, [roi.crop(human_img)], [roi.crop(mask)], [roi.crop(pose_img)], height=roi.height, width=roi.width
+            )
+        else:
+            latents = encode_person_latents(pipe, [human_img], [mask], [pose_img], height=1024, width=768)
+    job["session"] = person_sessions.put(
+        job["session_key"],
+        PersonSession(
+            human_img=human_img,
+            mask=mask,
+            mask_gray=job["mask_gray"],
+            pose_img=pose_img,
+            keypoints=job.get("keypoints"),
+            model_parse=job.get("model_parse"),
+            latents=latents,
+            roi=roi,
+        ),
     )
-
-pipe = TryonPipeline.from_pretrained(
-        base_path,
-        unet=unet,
-        vae=vae,
-        feature_extractor= CLIPImageProcessor(),
-        text_encoder = text_encoder_one,
-        text_encoder_2 = text_encoder_two,
-        tokenizer = tokenizer_one,
-        tokenizer_2 = tokenizer_two,
-        scheduler = noise_scheduler,
-        image_encoder=image_encoder,
-        torch_dtype=torch.float16,
-)
-pipe.unet_encoder = UNet_Encoder
-
-def start_tryon(dict,garm_img,garment_des,is_checked,is_checked_crop,denoise_steps,seed):
-    
-    openpose_model.preprocessor.body_estimation.model.to(device)
-    pipe.to(device)
-    pipe.unet_encoder.to(device)
-
-    garm_img= garm_img.convert("RGB").resize((768,1024))
-    human_img_orig = dict["background"].convert("RGB")    
-    
-    if is_checked_crop:
-        width, height = human_img_orig.size
-        target_width = int(min(width, height * (3 / 4)))
-        target_height = int(min(height, width * (4 / 3)))
-        left = (width - target_width) / 2
-        top = (height - target_height) / 2
-        right = (width + target_width) / 2
-        bottom = (height + target_height) / 2
-        cropped_img = human_img_orig.crop((left, top, right, bottom))
-        crop_size = cropped_img.size
-        human_img = cropped_img.resize((768,1024))
-    else:
-        human_img = human_img_orig.resize((768,1024))
-
-
-    if is_checked:
-        keypoints = openpose_model(human_img.resize((384,512)))
-        model_parse, _ = parsing_model(human_img.resize((384,512)))
-        mask, mask_gray = get_mask_location('hd', "upper_body", model_parse, keypoints)
-        mask = mask.resize((768,1024))
-    else:
-        mask = pil_to_binary_mask(dict['layers'][0].convert("RGB").resize((768, 1024)))
-        # mask = transforms.ToTensor()(mask)
-        # mask = mask.unsqueeze(0)
-    mask_gray = (1-transforms.ToTensor()(mask)) * tensor_transfrom(human_img)
-    mask_gray = to_pil_image((mask_gray+1.0)/2.0)
-
-
-    human_img_arg = _apply_exif_orientation(human_img.resize((384,512)))
-    human_img_arg = convert_PIL_to_numpy(human_img_arg, format="BGR")
-     
-    
-
-    args = apply_net.create_argument_parser().parse_args(('show', './configs/densepose_rcnn_R_50_FPN_s1x.yaml', './ckpt/densepose/model_final_162be9.pkl', 'dp_segm', '-v', '--opts', 'MODEL.DEVICE', 'cuda'))
-    # verbosity = getattr(args, "verbosity", None)
-    pose_img = args.func(args,human_img_arg)    
-    pose_img = pose_img[:,:,::-1]    
-    pose_img = Image.fromarray(pose_img).resize((768,1024))
-    
-    with torch.no_grad():
-        # Extract the images
-        with torch.cuda.amp.autocast():
-            with torch.no_grad():
-                prompt = "model is wearing " + garment_des
-                negative_prompt = "monochrome, lowres, bad anatomy, worst quality, low quality"
-                with torch.inference_mode():
-                    (
-                        prompt_embeds,
-                        negative_prompt_embeds,
-                        pooled_prompt_embeds,
-                        negative_pooled_prompt_embeds,
-                    ) = pipe.encode_prompt(
-                        prompt,
-                        num_images_per_prompt=1,
-                        do_classifier_free_guidance=True,
-                        negative_prompt=negative_prompt,
-                    )
-                                    
-                    prompt = "a photo of " + garment_des
-                    negative_prompt = "monochrome, lowres, bad anatomy, worst quality, low quality"
-                    if not isinstance(prompt, List):
-                        prompt = [prompt] * 1
-                    if not isinstance(negative_prompt, List):
-                        negative_prompt = [negative_prompt] * 1
-                    with torch.inference_mode():
-                        (
-                            prompt_embeds_c,
-                            _,
-                            _,
-                            _,
-                        ) = pipe.encode_prompt(
-                            prompt,
-                            num_images_per_prompt=1,
-                            do_classifier_free_guidance=False,
-                            negative_prompt=negative_prompt,
-                        )
-
-
-
-                    pose_img =  tensor_transfrom(pose_img).unsqueeze(0).to(device,torch.float16)
-                    garm_tensor =  tensor_transfrom(garm_img).unsqueeze(0).to(device,torch.float16)
-                    generator = torch.Generator(device).manual_seed(seed) if seed is not None else None
-                    images = pipe(
-                        prompt_embeds=prompt_embeds.to(device,torch.float16),
-                        negative_prompt_embeds=negative_prompt_embeds.to(device,torch.float16),
-                        pooled_prompt_embeds=pooled_prompt_embeds.to(device,torch.float16),
-                        negative_pooled_prompt_embeds=negative_pooled_prompt_embeds.to(device,torch.float16),
-                        num_inference_steps=denoise_steps,
-                        generator=generator,
-                        strength = 1.0,
-                        pose_img = pose_img.to(device,torch.float16),
-                        text_embeds_cloth=prompt_embeds_c.to(device,torch.float16),
-                        cloth = garm_tensor.to(device,torch.float16),
-                        mask_image=mask,
-                        image=human_img, 
-                        height=1024,
-                        width=768,
-                        ip_adapter_image = garm_img.resize((768,1024)),
-                        guidance_scale=2.0,
-                    )[0]
-
-    if is_checked_crop:
-        out_img = images[0].resize(crop_size)        
-        human_img_orig.paste(out_img, (int(left), int(top)))    
-        return human_img_orig, mask_gray
-    else:
-        return images[0], mask_gray
-    # return images[0], mask_gray
+    return job
+
+
+def denoise_stage(job):
+    session = job["session"]
+    roi = session.roi
+    with job["timer"].stage("tryon"):
+        job["image"] = tryon_server(
+            TryonRequest(
+                human_img=roi.crop(session.human_img) if roi is not None else session.human_img,
+                mask=roi.crop(session.mask) if roi is not None else session.mask,
+                pose_img=roi.crop(session.pose_img) if roi is not None else session.pose_img,
+                garm_img=job["garm_img"],
+                garment_des=job["garment_des"],
+                num_inference_steps=int(job["denoise_steps"]),
+                seed=job["seed"],
+                sampler=job["sampler"],
+                cfg_truncation=float(job["cfg_fraction"]) if job["cfg_fraction"] < 1.0 else None,
+                stage_timer=job["timer"] if stage_timing else None,
+                person_latents=session.latents,
+                size=roi.size if roi is not None else None,
+            )
+        )
+    return job
+
+
+def postprocess_stage(job):
+    session = job["session"]
+    image = job["image"]
+    with job["timer"].stage("postprocess"):
+        if session.roi is not None:
+            image = session.roi.paste(session.human_img, image, session.mask)
+        if job["is_checked_crop"]:
+            out_img = image.resize(job["crop_size"])        
+            job["human_img_orig"].paste(out_img, job["crop_origin"])    
+            image = job["human_img_orig"]
+    job["output"] = image
+    return job
+
+
+# the request path as stages on their own threads with bounded queues: the CPU-side preprocessing of the next
+# requests overlaps with the denoising of the current ones, and a full queue holds back the stages before it
+serving_pipeline = StagedPipeline(
+    [
+        Stage("prepare", prepare_stage, workers=2, queue_size=max_batch_size),
+        Stage("pose", pose_stage, workers=1),
+        Stage("parse", parse_stage, workers=1),
+        Stage("mask", mask_stage, workers=2),
+        Stage("densepose", densepose_stage, workers=1),
+        Stage("encode", encode_stage, workers=1),
+        # as many denoise workers as the server batches, so concurrent requests land in one batch
+        Stage("denoise", denoise_stage, workers=max_batch_size, queue_size=max_batch_size),
+        Stage("postprocess", postprocess_stage, workers=2),
+    ]
+).start()
+
+
+def start_tryon(dict,garm_img,garment_des,is_checked,is_checked_crop,denoise_steps,seed,sampler="ddpm",cfg_fraction=1.0,use_roi=False):
+    # the models were loaded onto the device by the registry
+    # requests run concurrently, and the peak memory counters are process-wide
+    timer = StageTimer(enabled=stage_timing, track_memory=False)
+    global trace_requests
+    trace = nullcontext()
+    traced = False
+    # requests arriving while another one is traced run untraced. The trace covers the whole process: the stage
+    # threads of this request, labeled with its stages, and whatever other requests run at the same time.
+    if trace_dir is not None and trace_requests > 0 and trace_lock.acquire(blocking=False):
+        traced = True
+        trace_requests -= 1
+        os.makedirs(trace_dir, exist_ok=True)
+        trace = timer.trace(os.path.join(trace_dir, f"tryon_{time.strftime('%Y%m%d-%H%M%S')}_{id(timer):x}.json"))
+
+    job = {
+        "dict": dict,
+        "garm_img": garm_img,
+        "garment_des": garment_des,
+        "is_checked": is_checked,
+        "is_checked_crop": is_checked_crop,
+        "denoise_steps": denoise_steps,
+        "seed": seed,
+        "sampler": sampler,
+        "cfg_fraction": cfg_fraction,
+        "use_roi": use_roi,
+        "timer": timer,
+    }
+    try:
+        with trace:
+            job = serving_pipeline(job)
+    finally:
+        if traced:
+            trace_lock.release()
+
+    timings = {}
+    if stage_timing:
+        timings = {**timer.report(), "person_cache": person_sessions.stats(), "serving": serving_pipeline.metrics()}
+        logger.info(json.dumps({"event": "tryon_timings", **timings}))
+    return job["output"], job["session"].mask_gray, timings
 
 garm_list = os.listdir(os.path.join(example_path,"cloth"))
 garm_list_path = [os.path.join(example_path,"cloth",garm) for garm in garm_list]
@@ -258,7 +365,8 @@ for ex_human in human_list_path:
 ##default human
 
 
-image_blocks = gr.Blocks().queue()
+# enough concurrent requests to keep the preprocessing stages busy while a batch denoises
+image_blocks = gr.Blocks().queue(default_concurrency_limit=2 * max_batch_size)
 with image_blocks as demo:
     gr.Markdown("## IDM-VTON 👕👔👚")
     gr.Markdown("Virtual Try-on with your image and garment image. Check out the [source codes](https://github.com/yisol/IDM-VTON) and the [model](https://huggingface.co/yisol/IDM-VTON)")
@@ -299,12 +407,19 @@ with image_blocks as demo:
         try_button = gr.Button(value="Try-on")
         with gr.Accordion(label="Advanced Settings", open=False):
             with gr.Row():
-                denoise_steps = gr.Number(label="Denoising Steps", minimum=20, maximum=40, value=30, step=1)
+                denoise_steps = gr.Number(label="Denoising Steps", minimum=10, maximum=40, value=30, step=1)
                 seed = gr.Number(label="Seed", minimum=-1, maximum=2147483647, step=1, value=42)
+            with gr.Row():
+                sampler = gr.Dropdown(label="Sampler", choices=list(SAMPLERS), value="ddpm")
+                cfg_fraction = gr.Slider(label="Guided steps fraction", minimum=0.0, maximum=1.0, value=1.0, step=0.05)
+            with gr.Row():
+                use_roi = gr.Checkbox(label="Region of interest", info="Denoise only the padded garment region (faster for small masks)", value=False)
+        with gr.Accordion(label="Timings", open=False):
+            timings_out = gr.JSON(label="Per-stage timings (ms) and peak memory (MB)")
 
 
 
-    try_button.click(fn=start_tryon, inputs=[imgs, garm_img, prompt, is_checked,is_checked_crop, denoise_steps, seed], outputs=[image_out,masked_img], api_name='tryon')
+    try_button.click(fn=start_tryon, inputs=[imgs, garm_img, prompt, is_checked,is_checked_crop, denoise_steps, seed, sampler, cfg_fraction, use_roi], outputs=[image_out,masked_img,timings_out], api_name='tryon')
 
             
 
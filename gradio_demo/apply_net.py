@@ -6,7 +6,8 @@ import glob
 import logging
 import os
 import sys
-from typing import Any, ClassVar, Dict, List
+import threading
+from typing import Any, ClassVar, Dict, List, Optional
 import torch
 
 from detectron2.config import CfgNode, get_cfg
@@ -330,6 +331,53 @@ class ShowAction(InferenceAction):
         return context
 
 
+class DensePoseService:
+    """
+    Long-lived DensePose predictor for in-process serving.
+
+    The config, weights and visualizer/extractor context are set up once, so every call only runs
+    the forward pass and the visualization on an in-memory BGR image.
+    """
+
+    def __init__(
+        self,
+        cfg_fpath: str,
+        model_fpath: str,
+        visualizations: str = "dp_segm",
+        min_score: float = 0.8,
+        nms_thresh: Optional[float] = None,
+        opts: Optional[List[str]] = None,
+    ):
+        args = argparse.Namespace(
+            cfg=cfg_fpath,
+            model=model_fpath,
+            visualizations=visualizations,
+            min_score=min_score,
+            nms_thresh=nms_thresh,
+            texture_atlas=None,
+            texture_atlases_map=None,
+            output=None,
+            opts=list(opts) if opts is not None else [],
+        )
+        logger.info(f"Loading config from {cfg_fpath}")
+        self.cfg = ShowAction.setup_config(cfg_fpath, model_fpath, args, [])
+        logger.info(f"Loading model from {model_fpath}")
+        self.predictor = DefaultPredictor(self.cfg)
+        self.context = ShowAction.create_context(args, self.cfg)
+        self._lock = threading.Lock()
+
+    def __call__(self, human_img):
+        """
+        Args:
+            human_img (np.ndarray): HxWx3 uint8 image in BGR order
+        Return:
+            np.ndarray: HxWx3 visualization (``dp_segm`` by default) in BGR order
+        """
+        with self._lock, torch.no_grad():
+            outputs = self.predictor(human_img)["instances"]
+            return ShowAction.execute_on_outputs(self.context, {"image": human_img}, outputs)
+
+
 def create_argument_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description=DOC,
@@ -15,11 +15,13 @@ from typing import Any, Callable, Dict, List, Optional, Tuple, Union, Literal
 from ip_adapter.ip_adapter import Resampler
 
 import argparse
+import time
 import logging
 import os
 import torch.utils.data as data
 import torchvision
 import json
+from contextlib import nullcontext
 import accelerate
 import numpy as np
 import torch
@@ -41,6 +43,12 @@ from numpy.linalg import lstsq
 from src.unet_hacked_tryon import UNet2DConditionModel
 from src.unet_hacked_garmnet import UNet2DConditionModel as UNet2DConditionModel_ref
 from src.tryon_pipeline import StableDiffusionXLInpaintPipeline as TryonPipeline
+from src.deep_cache import DeepFeatureCache, DEEP_CACHE_POLICIES, compare_images
+from src.garment_cache import GarmentFeatureCache, GARMENT_CACHE_POLICIES
+from src.prompt_cache import prewarm_prompt_cache
+from src.samplers import SAMPLERS, load_scheduler
+from src.eval_runner import ImageWriterPool, ShardManifest, merge_manifests, pending_indices, shard_indices
+from src.stage_timer import StageTimer
 
 
 
@@ -82,6 +90,31 @@ def parse_args():
     parser.add_argument("--guidance_scale",type=float,default=2.0,)
     parser.add_argument("--mixed_precision",type=str,default=None,choices=["no", "fp16", "bf16"],)
     parser.add_argument("--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers.")
+    parser.add_argument("--garment_cache_policy",type=str,default="always",choices=GARMENT_CACHE_POLICIES, help="When to recompute GarmentNet features during denoising.")
+    parser.add_argument("--garment_cache_interval",type=int,default=5, help="Refresh period for the 'interval' garment cache policy.")
+    parser.add_argument("--garment_cache_steps",type=str,default="0,10,20", help="Comma separated step indices for the 'steps' garment cache policy.")
+    parser.add_argument("--garment_cache_report", action="store_true", help="Log encoder time and feature drift of the garment cache per batch.")
+    parser.add_argument("--prompt_cache_size",type=int,default=0, help="Cache this many prompt embeddings, pre-warmed with the dataset captions. 0 disables the cache.")
+    parser.add_argument("--offload_text_encoders", action="store_true", help="Move the text encoders to CPU once the prompt cache is warm.")
+    parser.add_argument("--kv_cache", action="store_true", help="Project the cross-attention keys/values of the text and IP tokens once per batch instead of at every step.")
+    parser.add_argument("--compiled_step",type=str,default="off",choices=["off", "cuda_graph", "inductor"], help="Replay the UNet/GarmentNet forward of each step as a CUDA graph captured per input shape; 'inductor' compiles it with torch.compile first.")
+    parser.add_argument("--deep_cache_policy",type=str,default="off",choices=DEEP_CACHE_POLICIES, help="When to run the full try-on UNet; the other steps reuse its deep features.")
+    parser.add_argument("--deep_cache_interval",type=int,default=3, help="Full step period for the 'interval' deep cache policy.")
+    parser.add_argument("--deep_cache_steps",type=str,default="0,5,10,15,20,25", help="Comma separated full step indices for the 'steps' deep cache policy.")
+    parser.add_argument("--deep_cache_branch",type=int,default=2, help="Number of shallow UNet levels recomputed on reused steps.")
+    parser.add_argument("--deep_cache_report", action="store_true", help="Also run the full UNet on every batch and report latency and PSNR of the deep cache against it.")
+    parser.add_argument("--sampler",type=str,default="ddpm",choices=SAMPLERS, help="Sampler built from the model's scheduler config.")
+    parser.add_argument("--cfg_truncation",type=float,default=None, help="Fraction of the steps run with classifier free guidance, the remaining steps run the conditional batch only.")
+    parser.add_argument("--vae_decoder",type=str,default=None, help="fp16-safe VAE (e.g. madebyollin/sdxl-vae-fp16-fix) kept resident in float16 for decoding.")
+    parser.add_argument("--vae_slicing", action="store_true", help="Decode the batch one image at a time.")
+    parser.add_argument("--vae_tiling", action="store_true", help="Decode large outputs in overlapping tiles.")
+    parser.add_argument("--num_shards",type=int,default=None, help="Split the test pairs into this many shards, defaults to the number of accelerate processes.")
+    parser.add_argument("--shard_index",type=int,default=None, help="Shard run by this process, defaults to the accelerate process index.")
+    parser.add_argument("--overwrite", action="store_true", help="Regenerate pairs whose output already exists instead of skipping them.")
+    parser.add_argument("--writer_threads",type=int,default=4, help="Background threads saving the output images.")
+    parser.add_argument("--dataloader_num_workers",type=int,default=4,)
+    parser.add_argument("--stage_timing", action="store_true", help="Write per-batch stage timings (prompt encoding, VAE, per-step UNet/GarmentNet, decode) and peak memory to stage_timings.jsonl.")
+    parser.add_argument("--profile_batches",type=int,default=0, help="Write a torch.profiler Chrome trace of the pipeline call for this many first batches.")
     args = parser.parse_args()
 
 
@@ -381,7 +414,7 @@ def main():
     #     args.mixed_precision = accelerator.mixed_precision
 
     # Load scheduler, tokenizer and models.
-    noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+    noise_scheduler = load_scheduler(args.sampler, args.pretrained_model_name_or_path, subfolder="scheduler")
     vae = AutoencoderKL.from_pretrained(
         args.pretrained_model_name_or_path,
         subfolder="vae",
@@ -459,12 +492,23 @@ def main():
         category = args.category,
         size=(args.height, args.width),
     )
+    # every process runs its own shard of the pairs file, pairs with an existing output are skipped
+    num_shards = args.num_shards if args.num_shards is not None else accelerator.num_processes
+    shard_index = args.shard_index if args.shard_index is not None else accelerator.process_index
+    os.makedirs(args.output_dir, exist_ok=True)
+    indices = shard_indices(len(test_dataset), num_shards, shard_index)
+    assigned, skipped = len(indices), 0
+    if not args.overwrite:
+        indices, skipped = pending_indices(test_dataset.im_names, indices, args.output_dir)
+    logger.info(f"shard {shard_index}/{num_shards}: {assigned} pairs, {skipped} already done", main_process_only=False)
     test_dataloader = torch.utils.data.DataLoader(
-        test_dataset,
+        torch.utils.data.Subset(test_dataset, indices),
         shuffle=False,
         batch_size=args.test_batch_size,
-        num_workers=4,
+        num_workers=args.dataloader_num_workers,
     )
+    writer = ImageWriterPool(num_workers=args.writer_threads)
+    manifest = ShardManifest(args.output_dir, shard_index, num_shards, assigned, skipped, device=str(accelerator.device))
 
     pipe = TryonPipeline.from_pretrained(
             args.pretrained_model_name_or_path,
@@ -483,15 +527,58 @@ def main():
 
     # pipe.enable_sequential_cpu_offload()
     # pipe.enable_model_cpu_offload()
-    # pipe.enable_vae_slicing()
-
+    if args.vae_decoder is not None:
+        pipe.set_vae_decoder(AutoencoderKL.from_pretrained(args.vae_decoder, torch_dtype=torch.float16))
+    if args.vae_slicing:
+        pipe.enable_vae_slicing()
+    if args.vae_tiling:
+        pipe.enable_vae_tiling()
+
+
+
+    if args.prompt_cache_size > 0:
+        pipe.enable_prompt_cache(max_entries=args.prompt_cache_size)
+        descriptions = set(test_dataset.annotation_pair.values()) | {args.category}
+        prewarm_prompt_cache(pipe, descriptions, person_template="model is wearing a ")
+        logger.info(f"prompt cache: {pipe.prompt_cache.stats()}")
+        if args.offload_text_encoders:
+            pipe.offload_text_encoders()
+    if args.kv_cache:
+        pipe.enable_kv_cache()
+    if args.compiled_step != "off":
+        pipe.enable_compiled_step(compile=args.compiled_step == "inductor")
+
+    garment_cache = None
+    if args.garment_cache_policy != "always" or args.garment_cache_report:
+        garment_cache = GarmentFeatureCache(
+            policy=args.garment_cache_policy,
+            interval=args.garment_cache_interval,
+            steps=[int(s) for s in args.garment_cache_steps.split(",") if s],
+            measure_drift=args.garment_cache_report,
+            sync_timing=args.garment_cache_report,
+        )
 
+    deep_cache = None
+    if args.deep_cache_policy != "off":
+        deep_cache = DeepFeatureCache(
+            policy=args.deep_cache_policy,
+            interval=args.deep_cache_interval,
+            steps=[int(s) for s in args.deep_cache_steps.split(",") if s],
+            branch=args.deep_cache_branch,
+        )
+    deep_cache_report = []
+    timings_name = "stage_timings.jsonl" if num_shards == 1 else f"stage_timings_shard{shard_index:03d}.jsonl"
+    timings_path = os.path.join(args.output_dir, timings_name)
 
     with torch.no_grad():
         # Extract the images
         with torch.cuda.amp.autocast():
             with torch.no_grad():
-                for sample in test_dataloader:
+                load_start = time.perf_counter()
+                for batch_index, sample in enumerate(test_dataloader):
+                    load_seconds = time.perf_counter() - load_start
+                    timer = StageTimer(enabled=args.stage_timing or batch_index < args.profile_batches)
+                    timer.add("load", load_seconds * 1000)
                     img_emb_list = []
                     for i in range(sample['cloth'].shape[0]):
                         img_emb_list.append(sample['cloth'][i])
@@ -509,17 +596,18 @@ def main():
                     image_embeds = torch.cat(img_emb_list,dim=0)
 
                     with torch.inference_mode():
-                        (
-                            prompt_embeds,
-                            negative_prompt_embeds,
-                            pooled_prompt_embeds,
-                            negative_pooled_prompt_embeds,
-                        ) = pipe.encode_prompt(
-                            prompt,
-                            num_images_per_prompt=1,
-                            do_classifier_free_guidance=True,
-                            negative_prompt=negative_prompt,
-                        )
+                        with timer.stage("encode_prompt"):
+                            (
+                                prompt_embeds,
+                                negative_prompt_embeds,
+                                pooled_prompt_embeds,
+                                negative_pooled_prompt_embeds,
+                            ) = pipe.encode_prompt(
+                                prompt,
+                                num_images_per_prompt=1,
+                                do_classifier_free_guidance=True,
+                                negative_prompt=negative_prompt,
+                            )
                     
                     
                         prompt = sample["caption_cloth"]
@@ -531,7 +619,7 @@ def main():
                             negative_prompt = [negative_prompt] * num_prompts
 
 
-                        with torch.inference_mode():
+                        with torch.inference_mode(), timer.stage("encode_prompt"):
                             (
                                 prompt_embeds_c,
                                 _,
@@ -546,14 +634,12 @@ def main():
                         
 
 
-                        generator = torch.Generator(pipe.device).manual_seed(args.seed) if args.seed is not None else None
-                        images = pipe(
+                        pipe_kwargs = dict(
                             prompt_embeds=prompt_embeds,
                             negative_prompt_embeds=negative_prompt_embeds,
                             pooled_prompt_embeds=pooled_prompt_embeds,
                             negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
                             num_inference_steps=args.num_inference_steps,
-                            generator=generator,
                             strength = 1.0,
                             pose_img = sample['pose_img'],
                             text_embeds_cloth=prompt_embeds_c,
@@ -564,12 +650,72 @@ def main():
                             width=args.width,
                             guidance_scale=args.guidance_scale,
                             ip_adapter_image = image_embeds,
-                        )[0]
+                            garment_cache=garment_cache,
+                            cfg_truncation=args.cfg_truncation,
+                        )
+                        generator = torch.Generator(accelerator.device).manual_seed(args.seed) if args.seed is not None else None
+                        # PIL outputs, the timings below include the device sync
+                        trace = nullcontext()
+                        if batch_index < args.profile_batches:
+                            trace = timer.trace(os.path.join(args.output_dir, f"trace_shard{shard_index:03d}_batch{batch_index:05d}.json"))
+                        start = time.perf_counter()
+                        with trace:
+                            images = pipe(**pipe_kwargs, generator=generator, deep_cache=deep_cache, stage_timer=timer)[0]
+                        seconds = time.perf_counter() - start
+                        if args.garment_cache_report:
+                            logger.info(f"garment cache: {garment_cache.report()}")
+                        if args.deep_cache_report:
+                            generator = torch.Generator(accelerator.device).manual_seed(args.seed) if args.seed is not None else None
+                            start = time.perf_counter()
+                            reference = pipe(**pipe_kwargs, generator=generator)[0]
+                            entry = {
+                                "seconds": seconds,
+                                "full_seconds": time.perf_counter() - start,
+                                "vs_full": compare_images(images, reference),
+                            }
+                            if not args.unpaired:
+                                ground_truth = [transforms.functional.to_pil_image((im + 1.0) / 2.0) for im in sample['image']]
+                                entry["vs_ground_truth"] = compare_images(images, ground_truth)
+                                entry["full_vs_ground_truth"] = compare_images(reference, ground_truth)
+                            deep_cache_report.append(entry)
+                            logger.info(f"deep cache: {entry} {deep_cache.report() if deep_cache is not None else ''}")
 
 
                     for i in range(len(images)):
-                        x_sample = pil_to_tensor(images[i])
-                        torchvision.utils.save_image(x_sample,os.path.join(args.output_dir,sample['im_name'][i]))
+                        writer.submit(images[i], os.path.join(args.output_dir,sample['im_name'][i]))
+                    manifest.record_batch(len(images), load_seconds, seconds, writer)
+                    if args.stage_timing:
+                        # resolving the CUDA events waits for the batch, which the PIL outputs already did
+                        with open(timings_path, "a") as f:
+                            f.write(json.dumps({"batch": batch_index, "images": sample['im_name'], **timer.report()}) + "\n")
+                    load_start = time.perf_counter()
+
+    writer.close()
+    manifest.finish(writer)
+    logger.info(f"shard {shard_index}/{num_shards}: {manifest.data}", main_process_only=False)
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        summary = merge_manifests(args.output_dir, num_shards)
+        logger.info(f"all shards: {summary}")
+        with open(os.path.join(args.output_dir, "manifest.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if deep_cache_report:
+        summary = {"batches": len(deep_cache_report), "deep_cache": deep_cache.report() if deep_cache is not None else None}
+        for key in ("seconds", "full_seconds"):
+            summary[key] = float(np.mean([entry[key] for entry in deep_cache_report]))
+        summary["speedup"] = summary["full_seconds"] / summary["seconds"]
+        for key in ("vs_full", "vs_ground_truth", "full_vs_ground_truth"):
+            if key in deep_cache_report[0]:
+                summary[key] = {
+                    metric: float(np.mean([entry[key][metric] for entry in deep_cache_report])) for metric in ("psnr", "mae")
+                }
+        logger.info(f"deep cache report: {summary}")
+        report_name = "deep_cache_report.json" if num_shards == 1 else f"deep_cache_report_shard{shard_index:03d}.json"
+        with open(os.path.join(args.output_dir, report_name), "w") as f:
+            json.dump(summary, f, indent=2)
+    if pipe.compiled_step is not None:
+        logger.info(f"compiled step: {pipe.compiled_step.report()}")
                 
 
 
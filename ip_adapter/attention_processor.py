@@ -8,6 +8,12 @@ from einops import rearrange
 
 from diffusers.models.transformer_2d import Transformer2DModel
 
+def split_heads(tensor, heads):
+    # (batch, tokens, heads * head_dim) -> (batch, heads, tokens, head_dim)
+    batch_size = tensor.shape[0]
+    return tensor.view(batch_size, -1, heads, tensor.shape[-1] // heads).transpose(1, 2)
+
+
 class AttnProcessor(nn.Module):
     r"""
     Default processor for performing attention-related computations.
@@ -199,6 +205,9 @@ class AttnProcessor2_0(torch.nn.Module):
         super().__init__()
         if not hasattr(F, "scaled_dot_product_attention"):
             raise ImportError("AttnProcessor2_0 requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0.")
+        # set by src.attention_kv_cache.CrossAttentionKVCache.attach, cross-attention K/V are reused while it is active
+        self.kv_cache = None
+        self.kv_cache_name = None
 
     def __call__(
         self,
@@ -237,22 +246,24 @@ class AttnProcessor2_0(torch.nn.Module):
         args = ()
         query = attn.to_q(hidden_states, *args)
 
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
-
-        key = attn.to_k(encoder_hidden_states, *args)
-        value = attn.to_v(encoder_hidden_states, *args)
+        def project_kv(encoder_hidden_states):
+            if attn.norm_cross:
+                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+            key = split_heads(attn.to_k(encoder_hidden_states, *args), attn.heads)
+            value = split_heads(attn.to_v(encoder_hidden_states, *args), attn.heads)
+            return key, value
 
-        inner_dim = key.shape[-1]
-        head_dim = inner_dim // attn.heads
+        if encoder_hidden_states is None:
+            key = split_heads(attn.to_k(hidden_states, *args), attn.heads)
+            value = split_heads(attn.to_v(hidden_states, *args), attn.heads)
+        elif self.kv_cache is not None and self.kv_cache.active:
+            key, value = self.kv_cache.get(self.kv_cache_name, lambda: project_kv(encoder_hidden_states))
+        else:
+            key, value = project_kv(encoder_hidden_states)
 
+        head_dim = key.shape[-1]
         query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
-        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
         hidden_states = F.scaled_dot_product_attention(
@@ -1769,6 +1780,8 @@ class IPAttnProcessor2_0_variant(torch.nn.Module):
         self.cross_attention_dim = cross_attention_dim
         self.scale = scale
         self.num_tokens = num_tokens
+        self.attn_map_recorder = None
+        self.attn_map_name = None
 
         self.to_k_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
@@ -1851,8 +1864,8 @@ class IPAttnProcessor2_0_variant(torch.nn.Module):
         ip_hidden_states = F.scaled_dot_product_attention(
             hidden_states, ip_key, ip_value, attn_mask=None, dropout_p=0.0, is_causal=False
         )
-        with torch.no_grad():
-            self.attn_map = query @ ip_key.transpose(-2, -1).softmax(dim=-1)
+        if self.attn_map_recorder is not None:
+            self.attn_map_recorder.record(self.attn_map_name, query, ip_key, attn.scale)
 
         ip_hidden_states = ip_hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
         ip_hidden_states = ip_hidden_states.to(query.dtype)
@@ -1900,6 +1913,11 @@ class IPAttnProcessor2_0(torch.nn.Module):
         self.cross_attention_dim = cross_attention_dim
         self.scale = scale
         self.num_tokens = num_tokens
+        # set by src.attention_maps.AttentionMapRecorder.attach, IP attention maps are only computed when enabled
+        self.attn_map_recorder = None
+        self.attn_map_name = None
+        self.kv_cache = None
+        self.kv_cache_name = None
 
         self.to_k_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
@@ -1942,9 +1960,7 @@ class IPAttnProcessor2_0(torch.nn.Module):
 
         query = attn.to_q(hidden_states, *args)
 
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        else:
+        def project_kv(encoder_hidden_states):
             # get encoder_hidden_states, ip_hidden_states
             end_pos = encoder_hidden_states.shape[1] - self.num_tokens
             encoder_hidden_states, ip_hidden_states = (
@@ -1953,18 +1969,23 @@ class IPAttnProcessor2_0(torch.nn.Module):
             )
             if attn.norm_cross:
                 encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+            return (
+                split_heads(attn.to_k(encoder_hidden_states, *args), attn.heads),
+                split_heads(attn.to_v(encoder_hidden_states, *args), attn.heads),
+                split_heads(self.to_k_ip(ip_hidden_states), attn.heads),
+                split_heads(self.to_v_ip(ip_hidden_states), attn.heads),
+            )
 
-        key = attn.to_k(encoder_hidden_states, *args)
-        value = attn.to_v(encoder_hidden_states, *args)
-
-        inner_dim = key.shape[-1]
-        head_dim = inner_dim // attn.heads
+        if self.kv_cache is not None and self.kv_cache.active:
+            key, value, ip_key, ip_value = self.kv_cache.get(
+                self.kv_cache_name, lambda: project_kv(encoder_hidden_states)
+            )
+        else:
+            key, value, ip_key, ip_value = project_kv(encoder_hidden_states)
 
+        head_dim = key.shape[-1]
         query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
-        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
         hidden_states = F.scaled_dot_product_attention(
@@ -1975,19 +1996,13 @@ class IPAttnProcessor2_0(torch.nn.Module):
         hidden_states = hidden_states.to(query.dtype)
 
         # for ip-adapter
-        ip_key = self.to_k_ip(ip_hidden_states)
-        ip_value = self.to_v_ip(ip_hidden_states)
-
-        ip_key = ip_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-        ip_value = ip_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
         ip_hidden_states = F.scaled_dot_product_attention(
             query, ip_key, ip_value, attn_mask=None, dropout_p=0.0, is_causal=False
         )
-        with torch.no_grad():
-            self.attn_map = query @ ip_key.transpose(-2, -1).softmax(dim=-1)
+        if self.attn_map_recorder is not None:
+            self.attn_map_recorder.record(self.attn_map_name, query, ip_key, attn.scale)
 
         ip_hidden_states = ip_hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
         ip_hidden_states = ip_hidden_states.to(query.dtype)
@@ -2041,6 +2056,8 @@ class IPAttnProcessor_referencenet_2_0(torch.nn.Module):
         self.cross_attention_dim = cross_attention_dim
         self.scale = scale
         self.num_tokens = num_tokens
+        self.attn_map_recorder = None
+        self.attn_map_name = None
         self.attn_head_dim=attn_head_dim
         self.to_k_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
         self.to_v_ip = nn.Linear(cross_attention_dim or hidden_size, hidden_size, bias=False)
@@ -2124,8 +2141,8 @@ class IPAttnProcessor_referencenet_2_0(torch.nn.Module):
         ip_hidden_states = F.scaled_dot_product_attention(
             query, ip_key, ip_value, attn_mask=None, dropout_p=0.0, is_causal=False
         )
-        with torch.no_grad():
-            self.attn_map = query @ ip_key.transpose(-2, -1).softmax(dim=-1)
+        if self.attn_map_recorder is not None:
+            self.attn_map_recorder.record(self.attn_map_name, query, ip_key, attn.scale)
 
         ip_hidden_states = ip_hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
         ip_hidden_states = ip_hidden_states.to(query.dtype)
@@ -0,0 +1,96 @@
+import argparse
+import os
+
+import torch
+from PIL import Image
+from diffusers import AutoencoderKL, DDPMScheduler
+from transformers import AutoTokenizer, CLIPImageProcessor, CLIPVisionModelWithProjection, CLIPTextModelWithProjection, CLIPTextModel
+
+from src.unet_hacked_tryon import UNet2DConditionModel
+from src.unet_hacked_garmnet import UNet2DConditionModel as UNet2DConditionModel_ref
+from src.tryon_pipeline import StableDiffusionXLInpaintPipeline as TryonPipeline
+from src.garment_cache import GarmentFeatureCache, GARMENT_CACHE_POLICIES
+from src.garment_store import GarmentFeatureStore, garment_refresh_timesteps
+from src.prompt_cache import vitonhd_garment_descriptions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Precompute garment features for a catalog into a GarmentFeatureStore.")
+    parser.add_argument("--pretrained_model_name_or_path",type=str,default= "yisol/IDM-VTON",required=False,)
+    parser.add_argument("--cloth_dir",type=str,required=True, help="Directory of garment images.")
+    parser.add_argument("--captions",type=str,default=None, help="vitonhd_*_tagged.json with the garment tags.")
+    parser.add_argument("--store_dir",type=str,default="garment_store",)
+    parser.add_argument("--width",type=int,default=768,)
+    parser.add_argument("--height",type=int,default=1024,)
+    parser.add_argument("--num_inference_steps",type=int,default=30,)
+    parser.add_argument("--no_reference_features", action="store_true", help="Only store latents, IP-adapter tokens and text embeddings.")
+    parser.add_argument("--garment_cache_policy",type=str,default="once",choices=GARMENT_CACHE_POLICIES, help="Policy the features will be served with; decides which timesteps are stored.")
+    parser.add_argument("--garment_cache_interval",type=int,default=5,)
+    parser.add_argument("--garment_cache_steps",type=str,default="0,10,20",)
+    parser.add_argument("--seed", type=int, default=42,)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", torch_dtype=torch.float16)
+    unet = UNet2DConditionModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet", torch_dtype=torch.float16)
+    image_encoder = CLIPVisionModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder", torch_dtype=torch.float16)
+    unet_encoder = UNet2DConditionModel_ref.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet_encoder", torch_dtype=torch.float16)
+    text_encoder_one = CLIPTextModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder", torch_dtype=torch.float16)
+    text_encoder_two = CLIPTextModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder_2", torch_dtype=torch.float16)
+    tokenizer_one = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer", revision=None, use_fast=False)
+    tokenizer_two = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer_2", revision=None, use_fast=False)
+    for model in (vae, unet, image_encoder, unet_encoder, text_encoder_one, text_encoder_two):
+        model.requires_grad_(False)
+
+    pipe = TryonPipeline.from_pretrained(
+            args.pretrained_model_name_or_path,
+            unet=unet,
+            vae=vae,
+            feature_extractor= CLIPImageProcessor(),
+            text_encoder = text_encoder_one,
+            text_encoder_2 = text_encoder_two,
+            tokenizer = tokenizer_one,
+            tokenizer_2 = tokenizer_two,
+            scheduler = noise_scheduler,
+            image_encoder=image_encoder,
+            unet_encoder = unet_encoder,
+            torch_dtype=torch.float16,
+    ).to(device)
+
+    timesteps = []
+    if not args.no_reference_features:
+        garment_cache = GarmentFeatureCache(
+            policy=args.garment_cache_policy,
+            interval=args.garment_cache_interval,
+            steps=[int(s) for s in args.garment_cache_steps.split(",") if s],
+        )
+        timesteps = garment_refresh_timesteps(pipe, args.num_inference_steps, garment_cache)
+    print(f"storing reference features for timesteps {timesteps}")
+
+    captions = vitonhd_garment_descriptions(args.captions) if args.captions is not None else {}
+    store = GarmentFeatureStore(args.store_dir, device=device, max_device_entries=1)
+    generator = torch.Generator(device).manual_seed(args.seed)
+
+    for c_name in sorted(os.listdir(args.cloth_dir)):
+        garment_image = Image.open(os.path.join(args.cloth_dir, c_name))
+        description = captions.get(c_name, "shirts")
+        store.get_or_compute(
+            pipe,
+            garment_image,
+            description,
+            timesteps=timesteps,
+            height=args.height,
+            width=args.width,
+            generator=generator,
+        )
+    print(store.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import random
+
+import torch
+from diffusers import AutoencoderKL
+from tqdm.auto import tqdm
+from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer, CLIPVisionModelWithProjection
+
+from src.train_cache import TrainCacheWriter, latent_mask
+from train_xl import VitonHDDataset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Precompute the VAE latents, CLIP image states and text embeddings of the VITON-HD train set for train_xl.py --train_cache_dir.")
+    parser.add_argument("--pretrained_model_name_or_path",type=str,default="diffusers/stable-diffusion-xl-1.0-inpainting-0.1",required=False,)
+    parser.add_argument("--image_encoder_path",type=str,default="ckpt/image_encoder",required=False,)
+    parser.add_argument("--data_dir",type=str,required=True,)
+    parser.add_argument("--cache_dir",type=str,required=True,)
+    parser.add_argument("--width",type=int,default=768,)
+    parser.add_argument("--height",type=int,default=1024,)
+    parser.add_argument("--num_views",type=int,default=1, help="View 0 is unaugmented, every further view is drawn with the dataset's flip/color jitter/scale/shift augmentation.")
+    parser.add_argument("--shard_size",type=int,default=256,)
+    parser.add_argument("--batch_size",type=int,default=8,)
+    parser.add_argument("--num_workers",type=int,default=8,)
+    parser.add_argument("--seed", type=int, default=42,)
+    args = parser.parse_args()
+    return args
+
+
+def encode_text(tokenizer, tokenizer_2, text_encoder, text_encoder_2, captions, device):
+    # the same embeddings the training step computes from `batch['caption']` / `batch['caption_cloth']`
+    text_input_ids = tokenizer(captions, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt").input_ids
+    text_input_ids_2 = tokenizer_2(captions, max_length=tokenizer_2.model_max_length, padding="max_length", truncation=True, return_tensors="pt").input_ids
+    encoder_output = text_encoder(text_input_ids.to(device), output_hidden_states=True)
+    encoder_output_2 = text_encoder_2(text_input_ids_2.to(device), output_hidden_states=True)
+    embeds = torch.concat([encoder_output.hidden_states[-2], encoder_output_2.hidden_states[-2]], dim=-1)
+    return embeds, encoder_output_2[0]
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    device = "cuda"
+    dtype = torch.float16
+
+    tokenizer = CLIPTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer")
+    tokenizer_2 = CLIPTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer_2")
+    text_encoder = CLIPTextModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder", torch_dtype=dtype).to(device)
+    text_encoder_2 = CLIPTextModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder_2", torch_dtype=dtype).to(device)
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", torch_dtype=dtype).to(device)
+    image_encoder = CLIPVisionModelWithProjection.from_pretrained(args.image_encoder_path, torch_dtype=dtype).to(device)
+
+    writer = TrainCacheWriter(args.cache_dir, shard_size=args.shard_size)
+    annotations = {}
+    num_samples = None
+    for view in range(args.num_views):
+        dataset = VitonHDDataset(
+            dataroot_path=args.data_dir,
+            phase="train",
+            order="paired",
+            size=(args.height, args.width),
+            augment=view > 0,
+        )
+        num_samples = len(dataset)
+        # views are reproducible, the dataloader workers derive their seeds from torch's
+        random.seed(args.seed + view)
+        torch.manual_seed(args.seed + view)
+        dataloader = torch.utils.data.DataLoader(dataset, shuffle=False, batch_size=args.batch_size, num_workers=args.num_workers)
+        for batch in tqdm(dataloader, desc=f"view {view}"):
+            bsz = batch["image"].shape[0]
+            images = torch.cat([batch["image"], batch["im_mask"], batch["pose_img"], batch["cloth_pure"]])
+            moments = vae.encode(images.to(device, dtype)).latent_dist.parameters.chunk(4)
+            clip_pixels = batch["cloth"].reshape(bsz, *batch["cloth"].shape[-3:]).to(device, dtype)
+            clip_hidden = image_encoder(clip_pixels, output_hidden_states=True).hidden_states[-2]
+            clip_hidden_flip = image_encoder(torch.flip(clip_pixels, dims=[-1]), output_hidden_states=True).hidden_states[-2]
+            annotation_idx = [annotations.setdefault(annotation, len(annotations)) for annotation in batch["annotation"]]
+            writer.add(
+                image_moments=moments[0].to(dtype),
+                masked_moments=moments[1].to(dtype),
+                pose_moments=moments[2].to(dtype),
+                cloth_moments=moments[3].to(dtype),
+                mask=latent_mask(batch["inpaint_mask"], args.height, args.width).to(torch.uint8),
+                clip_hidden=clip_hidden,
+                clip_hidden_flip=clip_hidden_flip,
+                annotation_idx=torch.tensor(annotation_idx, dtype=torch.int64),
+            )
+
+    annotation_list = list(annotations)
+    text_embeds = {"caption_embeds": [], "caption_pooled": [], "cloth_embeds": []}
+    for start in range(0, len(annotation_list), 64):
+        chunk = annotation_list[start : start + 64]
+        caption_embeds, caption_pooled = encode_text(
+            tokenizer, tokenizer_2, text_encoder, text_encoder_2, ["model is wearing " + a for a in chunk], device
+        )
+        cloth_embeds, _ = encode_text(
+            tokenizer, tokenizer_2, text_encoder, text_encoder_2, ["a photo of " + a for a in chunk], device
+        )
+        text_embeds["caption_embeds"].append(caption_embeds)
+        text_embeds["caption_pooled"].append(caption_pooled)
+        text_embeds["cloth_embeds"].append(cloth_embeds)
+    writer.finish(
+        {name: torch.cat(tensors) for name, tensors in text_embeds.items()},
+        annotation_list,
+        num_samples=num_samples,
+        num_views=args.num_views,
+        height=args.height,
+        width=args.width,
+        scaling_factor=vae.config.scaling_factor,
+        pretrained_model_name_or_path=args.pretrained_model_name_or_path,
+        image_encoder_path=args.image_encoder_path,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,9 @@ import os
 import torch
 import numpy as np
 import cv2
-import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
-from datasets.simple_extractor_dataset import SimpleFolderDataset
-from utils.transforms import transform_logits
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset
+from utils.transforms import get_affine_transform, transform_logits
 from tqdm import tqdm
 from PIL import Image
 
@@ -118,61 +117,81 @@ def refine_hole(parsing_result_filled, parsing_result, arm_mask):
             cv2.drawContours(refine_hole_mask, contours, i, color=255, thickness=-1)
     return refine_hole_mask + arm_mask
 
-def onnx_inference(session, lip_session, input_dir):
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.406, 0.456, 0.485], std=[0.225, 0.224, 0.229])
-    ])
-    dataset = SimpleFolderDataset(root=input_dir, input_size=[512, 512], transform=transform)
-    dataloader = DataLoader(dataset)
-    with torch.no_grad():
-        for _, batch in enumerate(tqdm(dataloader)):
-            image, meta = batch
-            c = meta['center'].numpy()[0]
-            s = meta['scale'].numpy()[0]
-            w = meta['width'].numpy()[0]
-            h = meta['height'].numpy()[0]
-            output = session.run(None, {"input.1": image.numpy().astype(np.float32)})
-            upsample = torch.nn.Upsample(size=[512, 512], mode='bilinear', align_corners=True)
-            upsample_output = upsample(torch.from_numpy(output[1][0]).unsqueeze(0))
-            upsample_output = upsample_output.squeeze()
-            upsample_output = upsample_output.permute(1, 2, 0)  # CHW -> HWC
-            logits_result = transform_logits(upsample_output.data.cpu().numpy(), c, s, w, h, input_size=[512, 512])
-            parsing_result = np.argmax(logits_result, axis=2)
-            parsing_result = np.pad(parsing_result, pad_width=1, mode='constant', constant_values=0)
-            # try holefilling the clothes part
-            arm_mask = (parsing_result == 14).astype(np.float32) \
-                       + (parsing_result == 15).astype(np.float32)
-            upper_cloth_mask = (parsing_result == 4).astype(np.float32) + arm_mask
-            img = np.where(upper_cloth_mask, 255, 0)
-            dst = hole_fill(img.astype(np.uint8))
-            parsing_result_filled = dst / 255 * 4
-            parsing_result_woarm = np.where(parsing_result_filled == 4, parsing_result_filled, parsing_result)
-            # add back arm and refined hole between arm and cloth
-            refine_hole_mask = refine_hole(parsing_result_filled.astype(np.uint8), parsing_result.astype(np.uint8),
-                                           arm_mask.astype(np.uint8))
-            parsing_result = np.where(refine_hole_mask, parsing_result, parsing_result_woarm)
-            # remove padding
-            parsing_result = parsing_result[1:-1, 1:-1]
-
-        dataset_lip = SimpleFolderDataset(root=input_dir, input_size=[473, 473], transform=transform)
-        dataloader_lip = DataLoader(dataset_lip)
-        with torch.no_grad():
-            for _, batch in enumerate(tqdm(dataloader_lip)):
-                image, meta = batch
-                c = meta['center'].numpy()[0]
-                s = meta['scale'].numpy()[0]
-                w = meta['width'].numpy()[0]
-                h = meta['height'].numpy()[0]
-
-                output_lip = lip_session.run(None, {"input.1": image.numpy().astype(np.float32)})
-                upsample = torch.nn.Upsample(size=[473, 473], mode='bilinear', align_corners=True)
-                upsample_output_lip = upsample(torch.from_numpy(output_lip[1][0]).unsqueeze(0))
-                upsample_output_lip = upsample_output_lip.squeeze()
-                upsample_output_lip = upsample_output_lip.permute(1, 2, 0)  # CHW -> HWC
-                logits_result_lip = transform_logits(upsample_output_lip.data.cpu().numpy(), c, s, w, h,
-                                                     input_size=[473, 473])
-                parsing_result_lip = np.argmax(logits_result_lip, axis=2)
+ATR_INPUT_SIZE = [512, 512]
+LIP_INPUT_SIZE = [473, 473]
+INPUT_MEAN = np.array([0.406, 0.456, 0.485], dtype=np.float32)
+INPUT_STD = np.array([0.225, 0.224, 0.229], dtype=np.float32)
+
+
+def person_center_scale(width, height, aspect_ratio=1.0):
+    """ Center and scale of the whole image as person box, same as SimpleFolderDataset._box2cs.
+    """
+    x, y, w, h = 0, 0, width - 1, height - 1
+    center = np.zeros((2), dtype=np.float32)
+    center[0] = x + w * 0.5
+    center[1] = y + h * 0.5
+    if w > aspect_ratio * h:
+        h = w * 1.0 / aspect_ratio
+    elif w < aspect_ratio * h:
+        w = h * aspect_ratio
+    scale = np.array([w, h], dtype=np.float32)
+    return center, scale
+
+
+def prepare_input(img, center, scale, input_size):
+    """ Affine warp of a BGR uint8 image to input_size and ToTensor/Normalize as one array pipeline.
+    Returns:
+        Float32 array (3, input_size[0], input_size[1])
+    """
+    trans = get_affine_transform(center, scale, 0, np.asarray(input_size))
+    warped = cv2.warpAffine(
+        img,
+        trans,
+        (int(input_size[1]), int(input_size[0])),
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=(0, 0, 0))
+    warped = (warped.astype(np.float32) / 255 - INPUT_MEAN) / INPUT_STD
+    return warped.transpose(2, 0, 1)
+
+
+def prepare_inputs(img):
+    """ ATR and LIP inputs plus the meta needed to project the logits back, for a BGR uint8 image.
+    """
+    h, w, _ = img.shape
+    center, scale = person_center_scale(w, h)
+    meta = {'center': center, 'scale': scale, 'width': w, 'height': h}
+    return prepare_input(img, center, scale, ATR_INPUT_SIZE), prepare_input(img, center, scale, LIP_INPUT_SIZE), meta
+
+
+def upsample_logits(logits, input_size):
+    """ Bilinear upsample of (B, C, h, w) logits to input_size, returned as a (B, H, W, C) host array.
+    """
+    logits = F.interpolate(logits, size=input_size, mode='bilinear', align_corners=True)
+    return logits.permute(0, 2, 3, 1).cpu().numpy()
+
+
+def postprocess(logits_result, logits_result_lip):
+    """ Parsing map with filled garment holes and the LIP neck label from the back-projected logits of one image.
+    """
+    parsing_result = np.argmax(logits_result, axis=2)
+    parsing_result = np.pad(parsing_result, pad_width=1, mode='constant', constant_values=0)
+    # try holefilling the clothes part
+    arm_mask = (parsing_result == 14).astype(np.float32) \
+               + (parsing_result == 15).astype(np.float32)
+    upper_cloth_mask = (parsing_result == 4).astype(np.float32) + arm_mask
+    img = np.where(upper_cloth_mask, 255, 0)
+    dst = hole_fill(img.astype(np.uint8))
+    parsing_result_filled = dst / 255 * 4
+    parsing_result_woarm = np.where(parsing_result_filled == 4, parsing_result_filled, parsing_result)
+    # add back arm and refined hole between arm and cloth
+    refine_hole_mask = refine_hole(parsing_result_filled.astype(np.uint8), parsing_result.astype(np.uint8),
+                                   arm_mask.astype(np.uint8))
+    parsing_result = np.where(refine_hole_mask, parsing_result, parsing_result_woarm)
+    # remove padding
+    parsing_result = parsing_result[1:-1, 1:-1]
+
+    parsing_result_lip = np.argmax(logits_result_lip, axis=2)
     # add neck parsing result
     neck_mask = np.logical_and(np.logical_not((parsing_result_lip == 13).astype(np.float32)),
                                (parsing_result == 11).astype(np.float32))
@@ -181,8 +200,82 @@ def onnx_inference(session, lip_session, input_dir):
     output_img = Image.fromarray(np.asarray(parsing_result, dtype=np.uint8))
     output_img.putpalette(palette)
     face_mask = torch.from_numpy((parsing_result == 11).astype(np.float32))
-
     return output_img, face_mask
 
 
+def _parse_prepared(engine, atr_inputs, lip_inputs, metas):
+    with torch.no_grad():
+        output, output_lip = engine(atr_inputs, lip_inputs)
+        upsample_output = upsample_logits(output, ATR_INPUT_SIZE)
+        upsample_output_lip = upsample_logits(output_lip, LIP_INPUT_SIZE)
+    results = []
+    for i, meta in enumerate(metas):
+        c, s, w, h = meta['center'], meta['scale'], meta['width'], meta['height']
+        logits_result = transform_logits(upsample_output[i], c, s, w, h, input_size=ATR_INPUT_SIZE)
+        logits_result_lip = transform_logits(upsample_output_lip[i], c, s, w, h, input_size=LIP_INPUT_SIZE)
+        results.append(postprocess(logits_result, logits_result_lip))
+    return results
+
+
+def parse_images(engine, images):
+    """ Human parsing of a batch of in-memory images with one ATR and one LIP session call.
+    Args:
+        engine: ParsingEngine
+        images: List of RGB PIL images or BGR uint8 arrays
+    Returns:
+        List of (palette parsing image, face mask) per image
+    """
+    prepared = [prepare_inputs(np.asarray(image)[:, :, [2, 1, 0]] if isinstance(image, Image.Image) else image)
+                for image in images]
+    atr_inputs = np.stack([p[0] for p in prepared])
+    lip_inputs = np.stack([p[1] for p in prepared])
+    return _parse_prepared(engine, atr_inputs, lip_inputs, [p[2] for p in prepared])
+
+
+def parse_image(engine, image):
+    return parse_images(engine, [image])[0]
+
 
+class ParsingFolderDataset(Dataset):
+    """ Images of a folder prepared for ATR and LIP, for offline bulk parsing with DataLoader workers.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.file_list = sorted(os.listdir(root))
+
+    def __len__(self):
+        return len(self.file_list)
+
+    def __getitem__(self, index):
+        img = cv2.imread(os.path.join(self.root, self.file_list[index]), cv2.IMREAD_COLOR)
+        atr_input, lip_input, meta = prepare_inputs(img)
+        meta['name'] = self.file_list[index]
+        return atr_input, lip_input, meta
+
+
+def parse_folder(engine, input_dir, batch_size=8, num_workers=4):
+    """ Offline human parsing of every image in input_dir; image loading and warping run in DataLoader workers.
+    Yields:
+        (file name, palette parsing image, face mask)
+    """
+    dataloader = DataLoader(ParsingFolderDataset(input_dir), batch_size=batch_size, num_workers=num_workers)
+    for atr_inputs, lip_inputs, meta in tqdm(dataloader):
+        metas = [
+            {'center': meta['center'][i].numpy(), 'scale': meta['scale'][i].numpy(),
+             'width': int(meta['width'][i]), 'height': int(meta['height'][i])}
+            for i in range(atr_inputs.shape[0])
+        ]
+        results = _parse_prepared(engine, atr_inputs.numpy(), lip_inputs.numpy(), metas)
+        for name, (output_img, face_mask) in zip(meta['name'], results):
+            yield name, output_img, face_mask
+
+
+def onnx_inference(engine, input_dir):
+    if isinstance(input_dir, Image.Image):
+        return parse_image(engine, input_dir)
+    if os.path.isfile(input_dir):
+        return parse_image(engine, cv2.imread(input_dir, cv2.IMREAD_COLOR))
+    # a folder keeps the last image, as before
+    for _, output_img, face_mask in parse_folder(engine, input_dir):
+        pass
+    return output_img, face_mask
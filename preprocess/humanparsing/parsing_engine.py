@@ -0,0 +1,103 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import onnxruntime as ort
+import torch
+
+
+ArrayLike = Union[np.ndarray, torch.Tensor]
+
+
+def default_providers(gpu_id: int = 0) -> List:
+    """ CUDA execution provider on `gpu_id` when onnxruntime has it, CPU otherwise.
+    """
+    if "CUDAExecutionProvider" in ort.get_available_providers():
+        return [("CUDAExecutionProvider", {"device_id": gpu_id}), "CPUExecutionProvider"]
+    return ["CPUExecutionProvider"]
+
+
+class ParsingEngine:
+    """ The ATR and LIP human-parsing ONNX sessions behind one batched call.
+    Args:
+        atr_path: Path of parsing_atr.onnx, run at 512x512.
+        lip_path: Path of parsing_lip.onnx, run at 473x473.
+        gpu_id: Device of the CUDA execution provider.
+        providers: onnxruntime execution providers, defaults to CUDA when available and CPU otherwise.
+        intra_op_num_threads: Threads per session; defaults to half of the cores for each of the two sessions when
+            they run in parallel.
+        parallel: Run ATR and LIP concurrently. onnxruntime releases the GIL while a session runs.
+        io_binding: Bind torch CUDA tensors directly as session inputs/outputs so the logits stay on the GPU.
+            Defaults to True when the CUDA execution provider is used.
+    """
+    output_index = 1
+
+    def __init__(self, atr_path: str, lip_path: str, gpu_id: int = 0, providers: Optional[Sequence] = None,
+                 intra_op_num_threads: Optional[int] = None, parallel: bool = True,
+                 io_binding: Optional[bool] = None):
+        self.gpu_id = gpu_id
+        self.providers = list(providers) if providers is not None else default_providers(gpu_id)
+        if intra_op_num_threads is None:
+            intra_op_num_threads = max(1, (os.cpu_count() or 2) // (2 if parallel else 1))
+
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        session_options.intra_op_num_threads = intra_op_num_threads
+        self.session = ort.InferenceSession(atr_path, sess_options=session_options, providers=self.providers)
+        self.lip_session = ort.InferenceSession(lip_path, sess_options=session_options, providers=self.providers)
+
+        uses_cuda = "CUDAExecutionProvider" in self.session.get_providers()
+        self.io_binding = uses_cuda and torch.cuda.is_available() if io_binding is None else io_binding
+        self.device = torch.device("cuda", gpu_id) if self.io_binding else torch.device("cpu")
+        self._executor = ThreadPoolExecutor(max_workers=2) if parallel else None
+        self._output_shapes: Dict[Tuple[int, int, int], Tuple[int, ...]] = {}
+
+    def _output_shape(self, session, input_shape) -> Tuple[int, ...]:
+        # per-sample shape of the parsing output, found once per session and input size
+        key = (id(session),) + tuple(input_shape[-2:])
+        if key not in self._output_shapes:
+            dummy = np.zeros((1,) + tuple(input_shape[1:]), dtype=np.float32)
+            output = session.run(None, {session.get_inputs()[0].name: dummy})[self.output_index]
+            self._output_shapes[key] = tuple(output.shape[1:])
+        return self._output_shapes[key]
+
+    def _run_bound(self, session, batch: torch.Tensor) -> torch.Tensor:
+        batch = batch.to(self.device, torch.float32).contiguous()
+        output = torch.empty((batch.shape[0],) + self._output_shape(session, batch.shape),
+                             dtype=torch.float32, device=self.device)
+        binding = session.io_binding()
+        binding.bind_input(name=session.get_inputs()[0].name, device_type="cuda", device_id=self.gpu_id,
+                           element_type=np.float32, shape=tuple(batch.shape), buffer_ptr=batch.data_ptr())
+        for i, out in enumerate(session.get_outputs()):
+            if i == self.output_index:
+                binding.bind_output(name=out.name, device_type="cuda", device_id=self.gpu_id,
+                                    element_type=np.float32, shape=tuple(output.shape), buffer_ptr=output.data_ptr())
+            else:
+                binding.bind_output(out.name, "cuda", self.gpu_id)
+        # onnxruntime runs on its own stream, make sure the input is written
+        torch.cuda.synchronize(self.device)
+        session.run_with_iobinding(binding)
+        return output
+
+    def _run(self, session, batch: ArrayLike) -> torch.Tensor:
+        if self.io_binding:
+            if isinstance(batch, np.ndarray):
+                batch = torch.from_numpy(batch)
+            return self._run_bound(session, batch)
+        if isinstance(batch, torch.Tensor):
+            batch = batch.detach().cpu().numpy()
+        output = session.run(None, {session.get_inputs()[0].name: batch.astype(np.float32, copy=False)})
+        return torch.from_numpy(output[self.output_index])
+
+    def __call__(self, atr_batch: ArrayLike, lip_batch: ArrayLike) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Runs ATR on a (B, 3, 512, 512) batch and LIP on a (B, 3, 473, 473) batch.
+        Returns:
+            The parsing logits of both models as torch tensors, on the GPU with IO binding and on the CPU otherwise.
+        """
+        if self._executor is None:
+            return self._run(self.session, atr_batch), self._run(self.lip_session, lip_batch)
+        atr = self._executor.submit(self._run, self.session, atr_batch)
+        lip = self._executor.submit(self._run, self.lip_session, lip_batch)
+        return atr.result(), lip.result()
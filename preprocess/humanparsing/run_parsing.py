@@ -2,28 +2,40 @@ import pdb
 from pathlib import Path
 import sys
 import os
-import onnxruntime as ort
 PROJECT_ROOT = Path(__file__).absolute().parents[0].absolute()
 sys.path.insert(0, str(PROJECT_ROOT))
-from parsing_api import onnx_inference
+from parsing_api import onnx_inference, parse_images, parse_folder
+from parsing_engine import ParsingEngine
 import torch
 
 
 class Parsing:
-    def __init__(self, gpu_id: int):
+    def __init__(self, gpu_id: int, providers=None, intra_op_num_threads=None, parallel=True, io_binding=None):
         self.gpu_id = gpu_id
-        torch.cuda.set_device(gpu_id)
-        session_options = ort.SessionOptions()
-        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-        session_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-        session_options.add_session_config_entry('gpu_id', str(gpu_id))
-        self.session = ort.InferenceSession(os.path.join(Path(__file__).absolute().parents[2].absolute(), 'ckpt/humanparsing/parsing_atr.onnx'),
-                                            sess_options=session_options, providers=['CPUExecutionProvider'])
-        self.lip_session = ort.InferenceSession(os.path.join(Path(__file__).absolute().parents[2].absolute(), 'ckpt/humanparsing/parsing_lip.onnx'),
-                                                sess_options=session_options, providers=['CPUExecutionProvider'])
-        
+        if torch.cuda.is_available():
+            torch.cuda.set_device(gpu_id)
+        ckpt_dir = os.path.join(Path(__file__).absolute().parents[2].absolute(), 'ckpt/humanparsing')
+        self.engine = ParsingEngine(os.path.join(ckpt_dir, 'parsing_atr.onnx'),
+                                    os.path.join(ckpt_dir, 'parsing_lip.onnx'),
+                                    gpu_id=gpu_id,
+                                    providers=providers,
+                                    intra_op_num_threads=intra_op_num_threads,
+                                    parallel=parallel,
+                                    io_binding=io_binding)
+        self.session = self.engine.session
+        self.lip_session = self.engine.lip_session
 
     def __call__(self, input_image):
         # torch.cuda.set_device(self.gpu_id)
-        parsed_image, face_mask = onnx_inference(self.session, self.lip_session, input_image)
+        parsed_image, face_mask = onnx_inference(self.engine, input_image)
         return parsed_image, face_mask
+
+    def batch(self, input_images):
+        """ Parses a list of PIL images with one engine call, returns a list of (parsed_image, face_mask).
+        """
+        return parse_images(self.engine, input_images)
+
+    def folder(self, input_dir, batch_size=8, num_workers=4):
+        """ Offline parsing of a folder, yields (file name, parsed_image, face_mask).
+        """
+        return parse_folder(self.engine, input_dir, batch_size=batch_size, num_workers=num_workers)
@@ -83,16 +83,17 @@ def transform_logits(logits, center, scale, width, height, input_size):
     trans = get_affine_transform(center, scale, 0, input_size, inv=1)
     channel = logits.shape[2]
     target_logits = []
-    for i in range(channel):
+    # warp 4 channels per call, channels are interpolated independently
+    for i in range(0, channel, 4):
         target_logit = cv2.warpAffine(
-            logits[:,:,i],
+            np.ascontiguousarray(logits[:,:,i:i + 4]),
             trans,
             (int(width), int(height)), #(int(width), int(height)),
             flags=cv2.INTER_LINEAR,
             borderMode=cv2.BORDER_CONSTANT,
             borderValue=(0))
-        target_logits.append(target_logit)
-    target_logits = np.stack(target_logits,axis=2)
+        target_logits.append(target_logit.reshape(int(height), int(width), -1))
+    target_logits = np.concatenate(target_logits,axis=2)
 
     return target_logits
 
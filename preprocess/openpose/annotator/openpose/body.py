@@ -17,8 +17,211 @@ from . import util
 from .model import bodypose_model
 
 
+# find connection in the specified sequence, center 29 is in the position 15
+limbSeq = np.array([[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
+                    [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
+                    [1, 16], [16, 18], [3, 17], [6, 18]])
+# the middle joints heatmap correpondence
+mapIdx = np.array([[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
+                   [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
+                   [55, 56], [37, 38], [45, 46]])
+mid_num = 10
+
+
+def _gaussian_filter_torch(maps, sigma, device):
+    # scipy.ndimage.gaussian_filter (mode='reflect', truncate=4.0) over the two spatial axes of (N, H, W) maps
+    radius = int(4.0 * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / (sigma * sigma) * x ** 2)
+    kernel = torch.from_numpy(kernel / kernel.sum()).to(device)
+    out = torch.from_numpy(np.ascontiguousarray(maps)).to(device)
+    for dim in (1, 2):
+        size = out.shape[dim]
+        index = np.arange(-radius, size + radius)
+        index = np.where(index < 0, -index - 1, index)
+        index = np.where(index >= size, 2 * size - index - 1, index)
+        padded = out.index_select(dim, torch.from_numpy(index).to(device))
+        windows = padded.unfold(dim, 2 * radius + 1, 1)
+        out = (windows * kernel).sum(-1)
+    return out
+
+
+def find_peaks(heatmap_avg, thre1=0.1, device=None):
+    """ Peaks of the 18 part heatmaps of a (H, W, 19) heatmap.
+    Returns:
+        all_peaks: per part a (n, 4) array of x, y, score, id
+    """
+    maps_ori = np.ascontiguousarray(np.transpose(heatmap_avg[:, :, :18], (2, 0, 1)))
+    if device is not None:
+        maps = _gaussian_filter_torch(maps_ori, 3, device)
+        neighbours = torch.zeros((4,) + maps.shape, dtype=maps.dtype, device=maps.device)
+        neighbours[0, :, 1:, :] = maps[:, :-1, :]
+        neighbours[1, :, :-1, :] = maps[:, 1:, :]
+        neighbours[2, :, :, 1:] = maps[:, :, :-1]
+        neighbours[3, :, :, :-1] = maps[:, :, 1:]
+        peaks_binary = ((maps >= neighbours).all(0) & (maps > thre1)).cpu().numpy()
+    else:
+        maps = gaussian_filter(maps_ori, sigma=(0, 3, 3))
+        peaks_binary = maps > thre1
+        peaks_binary[:, 1:, :] &= maps[:, 1:, :] >= maps[:, :-1, :]
+        peaks_binary[:, 0, :] &= maps[:, 0, :] >= 0
+        peaks_binary[:, :-1, :] &= maps[:, :-1, :] >= maps[:, 1:, :]
+        peaks_binary[:, -1, :] &= maps[:, -1, :] >= 0
+        peaks_binary[:, :, 1:] &= maps[:, :, 1:] >= maps[:, :, :-1]
+        peaks_binary[:, :, 0] &= maps[:, :, 0] >= 0
+        peaks_binary[:, :, :-1] &= maps[:, :, :-1] >= maps[:, :, 1:]
+        peaks_binary[:, :, -1] &= maps[:, :, -1] >= 0
+
+    part, y, x = np.nonzero(peaks_binary)
+    peaks = np.stack([x, y, maps_ori[part, y, x], np.arange(len(x))], axis=1).astype(np.float64)
+    bounds = np.searchsorted(part, np.arange(19))
+    return [peaks[bounds[k]:bounds[k + 1]] for k in range(18)]
+
+
+def score_limb(candA, candB, score_mid, image_height, thre2=0.05):
+    """ PAF line integral of every (A, B) candidate pair of one limb.
+    Returns:
+        (nA * nB, 3) array of i, j, score_with_dist_prior for the pairs passing both criteria, i-major order
+    """
+    nA, nB = len(candA), len(candB)
+    ax = candA[:, 0].astype(np.int64)[:, None]
+    ay = candA[:, 1].astype(np.int64)[:, None]
+    bx = candB[:, 0].astype(np.int64)[None, :]
+    by = candB[:, 1].astype(np.int64)[None, :]
+    vec_x, vec_y = bx - ax, by - ay
+    norm = np.sqrt((vec_x * vec_x + vec_y * vec_y).astype(np.float64))
+    norm = np.maximum(0.001, norm)
+    vec_x, vec_y = vec_x / norm, vec_y / norm
+
+    # np.linspace per pair, (nA, nB, mid_num)
+    steps = np.arange(0, mid_num, dtype=np.float64)
+    start_x, start_y = ax * 1.0, ay * 1.0
+    line_x = steps * ((bx - ax) / (mid_num - 1))[..., None] + start_x[..., None]
+    line_y = steps * ((by - ay) / (mid_num - 1))[..., None] + start_y[..., None]
+    line_x[..., -1] = bx * 1.0
+    line_y[..., -1] = by * 1.0
+    line_x = np.broadcast_to(line_x, (nA, nB, mid_num))
+    line_y = np.broadcast_to(line_y, (nA, nB, mid_num))
+    rows, cols = np.rint(line_y).astype(int), np.rint(line_x).astype(int)
+
+    score_midpts = np.multiply(score_mid[rows, cols, 0], vec_x[..., None]) \
+                   + np.multiply(score_mid[rows, cols, 1], vec_y[..., None])
+    # summed left to right like the builtin sum
+    total = score_midpts[..., 0]
+    for I in range(1, mid_num):
+        total = total + score_midpts[..., I]
+    score_with_dist_prior = total / mid_num + np.minimum(0.5 * image_height / norm - 1, 0)
+    criterion1 = (score_midpts > thre2).sum(-1) > 0.8 * mid_num
+    criterion2 = score_with_dist_prior > 0
+    i, j = np.nonzero(criterion1 & criterion2)
+    return i, j, score_with_dist_prior[i, j]
+
+
+def match_limb(candA, candB, i, j, score):
+    """ Greedy matching of the scored pairs by descending score.
+    Returns:
+        (n, 5) connection array of idA, idB, score, i, j
+    """
+    order = np.argsort(-score, kind='stable')
+    usedA = np.zeros(len(candA), dtype=bool)
+    usedB = np.zeros(len(candB), dtype=bool)
+    limit = min(len(candA), len(candB))
+    keep = []
+    for c in order:
+        if not usedA[i[c]] and not usedB[j[c]]:
+            usedA[i[c]] = usedB[j[c]] = True
+            keep.append(c)
+            if len(keep) >= limit:
+                break
+    keep = np.array(keep, dtype=np.int64)
+    return np.stack([candA[i[keep], 3], candB[j[keep], 3], score[keep], i[keep], j[keep]], axis=1).reshape(-1, 5)
+
+
+def assemble_subsets(candidate, connection_all, special_k):
+    subset = -1 * np.ones((max(1, len(candidate)), 20))
+    n = 0
+    for k in range(len(mapIdx)):
+        if k in special_k:
+            continue
+        connection = connection_all[k]
+        partAs = connection[:, 0]
+        partBs = connection[:, 1]
+        indexA, indexB = limbSeq[k] - 1
+
+        for i in range(len(connection)):
+            found_idx = np.nonzero((subset[:n, indexA] == partAs[i]) | (subset[:n, indexB] == partBs[i]))[0]
+            found = len(found_idx)
+
+            if found == 1:
+                j = found_idx[0]
+                if subset[j][indexB] != partBs[i]:
+                    subset[j][indexB] = partBs[i]
+                    subset[j][-1] += 1
+                    subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection[i][2]
+            elif found == 2:  # if found 2 and disjoint, merge them
+                j1, j2 = found_idx
+                membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
+                if len(np.nonzero(membership == 2)[0]) == 0:  # merge
+                    subset[j1][:-2] += (subset[j2][:-2] + 1)
+                    subset[j1][-2:] += subset[j2][-2:]
+                    subset[j1][-2] += connection[i][2]
+                    subset[j2:n - 1] = subset[j2 + 1:n]
+                    n -= 1
+                else:  # as like found == 1
+                    subset[j1][indexB] = partBs[i]
+                    subset[j1][-1] += 1
+                    subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection[i][2]
+
+            # if find no partA in the subset, create a new subset
+            elif not found and k < 17:
+                if n == len(subset):
+                    subset = np.concatenate([subset, -1 * np.ones_like(subset)])
+                row = subset[n]
+                row[:] = -1
+                row[indexA] = partAs[i]
+                row[indexB] = partBs[i]
+                row[-1] = 2
+                row[-2] = candidate[connection[i, 0].astype(int), 2] + candidate[connection[i, 1].astype(int), 2] \
+                          + connection[i][2]
+                n += 1
+    subset = subset[:n]
+    # delete some rows of subset which has few parts occur
+    delete = (subset[:, -1] < 4) | (subset[:, -2] / subset[:, -1] < 0.4)
+    return subset[~delete]
+
+
+def decode_body(heatmap_avg, paf_avg, image_height, thre1=0.1, thre2=0.05, device=None):
+    """ Keypoint candidates and person subsets from the averaged heatmaps and PAFs.
+    Returns:
+        candidate: n*4 array of x, y, score, id
+        subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
+    """
+    all_peaks = find_peaks(heatmap_avg, thre1=thre1, device=device)
+
+    connection_all = []
+    special_k = []
+    for k in range(len(mapIdx)):
+        candA = all_peaks[limbSeq[k][0] - 1]
+        candB = all_peaks[limbSeq[k][1] - 1]
+        if len(candA) != 0 and len(candB) != 0:
+            score_mid = paf_avg[:, :, mapIdx[k] - 19]
+            i, j, score = score_limb(candA, candB, score_mid, image_height, thre2=thre2)
+            connection_all.append(match_limb(candA, candB, i, j, score))
+        else:
+            special_k.append(k)
+            connection_all.append([])
+
+    candidate = np.concatenate(all_peaks)
+    if len(candidate) == 0:
+        candidate = np.array([])
+    return candidate, assemble_subsets(candidate, connection_all, special_k)
+
+
 class Body(object):
-    def __init__(self, model_path):
+    def __init__(self, model_path, gpu_decode=False):
+        # gpu_decode runs the gaussian filter and peak search on the GPU, peaks may then differ from the CPU decode
+        # in the last bits of their scores
+        self.decode_device = 'cuda' if gpu_decode and torch.cuda.is_available() else None
         self.model = bodypose_model()
         if torch.cuda.is_available():
             self.model = self.model.cuda()
@@ -73,149 +276,8 @@ class Body(object):
             heatmap_avg += heatmap_avg + heatmap / len(multiplier)
             paf_avg += + paf / len(multiplier)
 
-        all_peaks = []
-        peak_counter = 0
-
-        for part in range(18):
-            map_ori = heatmap_avg[:, :, part]
-            one_heatmap = gaussian_filter(map_ori, sigma=3)
-
-            map_left = np.zeros(one_heatmap.shape)
-            map_left[1:, :] = one_heatmap[:-1, :]
-            map_right = np.zeros(one_heatmap.shape)
-            map_right[:-1, :] = one_heatmap[1:, :]
-            map_up = np.zeros(one_heatmap.shape)
-            map_up[:, 1:] = one_heatmap[:, :-1]
-            map_down = np.zeros(one_heatmap.shape)
-            map_down[:, :-1] = one_heatmap[:, 1:]
-
-            peaks_binary = np.logical_and.reduce(
-                (one_heatmap >= map_left, one_heatmap >= map_right, one_heatmap >= map_up, one_heatmap >= map_down,
-                 one_heatmap > thre1))
-            peaks = list(zip(np.nonzero(peaks_binary)[1], np.nonzero(peaks_binary)[0]))  # note reverse
-            peaks_with_score = [x + (map_ori[x[1], x[0]],) for x in peaks]
-            peak_id = range(peak_counter, peak_counter + len(peaks))
-            peaks_with_score_and_id = [peaks_with_score[i] + (peak_id[i],) for i in range(len(peak_id))]
-
-            all_peaks.append(peaks_with_score_and_id)
-            peak_counter += len(peaks)
-
-        # find connection in the specified sequence, center 29 is in the position 15
-        limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
-                   [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
-                   [1, 16], [16, 18], [3, 17], [6, 18]]
-        # the middle joints heatmap correpondence
-        mapIdx = [[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
-                  [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
-                  [55, 56], [37, 38], [45, 46]]
-
-        connection_all = []
-        special_k = []
-        mid_num = 10
-
-        for k in range(len(mapIdx)):
-            score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
-            candA = all_peaks[limbSeq[k][0] - 1]
-            candB = all_peaks[limbSeq[k][1] - 1]
-            nA = len(candA)
-            nB = len(candB)
-            indexA, indexB = limbSeq[k]
-            if (nA != 0 and nB != 0):
-                connection_candidate = []
-                for i in range(nA):
-                    for j in range(nB):
-                        vec = np.subtract(candB[j][:2], candA[i][:2])
-                        norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
-                        norm = max(0.001, norm)
-                        vec = np.divide(vec, norm)
-
-                        startend = list(zip(np.linspace(candA[i][0], candB[j][0], num=mid_num), \
-                                            np.linspace(candA[i][1], candB[j][1], num=mid_num)))
-
-                        vec_x = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 0] \
-                                          for I in range(len(startend))])
-                        vec_y = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 1] \
-                                          for I in range(len(startend))])
-
-                        score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(vec_y, vec[1])
-                        score_with_dist_prior = sum(score_midpts) / len(score_midpts) + min(
-                            0.5 * oriImg.shape[0] / norm - 1, 0)
-                        criterion1 = len(np.nonzero(score_midpts > thre2)[0]) > 0.8 * len(score_midpts)
-                        criterion2 = score_with_dist_prior > 0
-                        if criterion1 and criterion2:
-                            connection_candidate.append(
-                                [i, j, score_with_dist_prior, score_with_dist_prior + candA[i][2] + candB[j][2]])
-
-                connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
-                connection = np.zeros((0, 5))
-                for c in range(len(connection_candidate)):
-                    i, j, s = connection_candidate[c][0:3]
-                    if (i not in connection[:, 3] and j not in connection[:, 4]):
-                        connection = np.vstack([connection, [candA[i][3], candB[j][3], s, i, j]])
-                        if (len(connection) >= min(nA, nB)):
-                            break
-
-                connection_all.append(connection)
-            else:
-                special_k.append(k)
-                connection_all.append([])
-
-        # last number in each row is the total parts number of that person
-        # the second last number in each row is the score of the overall configuration
-        subset = -1 * np.ones((0, 20))
-        candidate = np.array([item for sublist in all_peaks for item in sublist])
-
-        for k in range(len(mapIdx)):
-            if k not in special_k:
-                partAs = connection_all[k][:, 0]
-                partBs = connection_all[k][:, 1]
-                indexA, indexB = np.array(limbSeq[k]) - 1
-
-                for i in range(len(connection_all[k])):  # = 1:size(temp,1)
-                    found = 0
-                    subset_idx = [-1, -1]
-                    for j in range(len(subset)):  # 1:size(subset,1):
-                        if subset[j][indexA] == partAs[i] or subset[j][indexB] == partBs[i]:
-                            subset_idx[found] = j
-                            found += 1
-
-                    if found == 1:
-                        j = subset_idx[0]
-                        if subset[j][indexB] != partBs[i]:
-                            subset[j][indexB] = partBs[i]
-                            subset[j][-1] += 1
-                            subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-                    elif found == 2:  # if found 2 and disjoint, merge them
-                        j1, j2 = subset_idx
-                        membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
-                        if len(np.nonzero(membership == 2)[0]) == 0:  # merge
-                            subset[j1][:-2] += (subset[j2][:-2] + 1)
-                            subset[j1][-2:] += subset[j2][-2:]
-                            subset[j1][-2] += connection_all[k][i][2]
-                            subset = np.delete(subset, j2, 0)
-                        else:  # as like found == 1
-                            subset[j1][indexB] = partBs[i]
-                            subset[j1][-1] += 1
-                            subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-
-                    # if find no partA in the subset, create a new subset
-                    elif not found and k < 17:
-                        row = -1 * np.ones(20)
-                        row[indexA] = partAs[i]
-                        row[indexB] = partBs[i]
-                        row[-1] = 2
-                        row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
-                        subset = np.vstack([subset, row])
-        # delete some rows of subset which has few parts occur
-        deleteIdx = []
-        for i in range(len(subset)):
-            if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
-                deleteIdx.append(i)
-        subset = np.delete(subset, deleteIdx, axis=0)
-
-        # subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
-        # candidate: x, y, score, id
-        return candidate, subset
+        return decode_body(heatmap_avg, paf_avg, oriImg.shape[0], thre1=thre1, thre2=thre2,
+                           device=self.decode_device)
 
 
 # if __name__ == "__main__":
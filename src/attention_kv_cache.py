@@ -0,0 +1,109 @@
+import time
+from typing import Callable, Dict, Tuple
+
+import torch
+
+
+class CrossAttentionKVCache:
+    r"""
+    Per-request cache of the cross-attention key/value projections of the try-on UNet and GarmentNet.
+
+    The text embeddings and IP-adapter tokens fed to the cross-attention layers are fixed for a whole pipeline call,
+    so `attn.to_k` / `attn.to_v` (and `to_k_ip` / `to_v_ip` of the IP processors) only have to run on the first step.
+    The cache is only used between [`~CrossAttentionKVCache.begin`] and [`~CrossAttentionKVCache.end`], which the
+    pipeline calls around its denoising loop; outside of it the processors project as usual.
+
+    Args:
+        sync_timing (`bool`, defaults to `False`):
+            Synchronize CUDA around projections so `project_seconds` in the report is accurate.
+    """
+
+    def __init__(self, sync_timing: bool = False):
+        self.sync_timing = sync_timing
+        self.active = False
+        self._attached: Dict[str, Tuple[torch.nn.Module, Dict]] = {}
+        self.entries: Dict[str, Tuple[torch.Tensor, ...]] = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.project_seconds = 0.0
+        self.cached_layers = 0
+        self.cached_bytes = 0
+
+    def attach(self, model, prefix: str) -> "CrossAttentionKVCache":
+        r"""
+        Hooks the cache into the cross-attention (`attn2`) processors of `model`. Processors without cache support
+        (the diffusers defaults of GarmentNet) are replaced by the equivalent `ip_adapter` `AttnProcessor2_0`.
+        """
+        from ip_adapter.attention_processor import AttnProcessor2_0
+
+        original = model.attn_processors
+        processors = dict(original)
+        for name, processor in original.items():
+            if not name.endswith("attn2.processor"):
+                continue
+            if not hasattr(processor, "kv_cache"):
+                processor = processors[name] = AttnProcessor2_0()
+            processor.kv_cache = self
+            processor.kv_cache_name = f"{prefix}.{name}"
+        if any(processors[name] is not original[name] for name in original):
+            model.set_attn_processor(dict(processors))
+        self._attached[prefix] = (model, original)
+        return self
+
+    def detach(self):
+        for model, original in self._attached.values():
+            for processor in model.attn_processors.values():
+                if getattr(processor, "kv_cache", None) is self:
+                    processor.kv_cache = None
+            if any(model.attn_processors[name] is not original[name] for name in original):
+                model.set_attn_processor(dict(original))
+        self._attached = {}
+        self.end()
+
+    def begin(self):
+        self.entries = {}
+        self.active = True
+
+    def end(self):
+        if self.entries:
+            self.cached_layers = len(self.entries)
+            self.cached_bytes = sum(t.numel() * t.element_size() for entry in self.entries.values() for t in entry)
+        self.entries = {}
+        self.active = False
+
+    def invalidate(self):
+        r"""
+        Drops the cached projections, e.g. when a step callback replaced the prompt embeddings.
+        """
+        self.entries = {}
+
+    def get(self, name: str, project_fn: Callable[[], Tuple[torch.Tensor, ...]]) -> Tuple[torch.Tensor, ...]:
+        if name in self.entries:
+            self.hits += 1
+            return self.entries[name]
+        self.misses += 1
+        if self.sync_timing and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        projections = project_fn()
+        if self.sync_timing and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.project_seconds += time.perf_counter() - start
+        self.entries[name] = projections
+        return projections
+
+    def report(self) -> Dict[str, float]:
+        r"""
+        Hit/miss counts and projection time since the last `reset_stats`, and the number of layers and bytes cached
+        by the last request.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "project_seconds": self.project_seconds,
+            "cached_layers": self.cached_layers,
+            "cached_bytes": self.cached_bytes,
+        }
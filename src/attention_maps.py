@@ -0,0 +1,138 @@
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+class AttentionMapRecorder:
+    r"""
+    Opt-in capture of the IP-adapter cross-attention maps of the try-on UNet.
+
+    The IP attention processors only call [`~AttentionMapRecorder.record`] while a recorder is attached to them, so
+    nothing is computed or kept alive on the serving path. When attached, the map `softmax(q @ ip_k^T * scale)` is
+    computed for the selected layers and denoising steps only, averaged over heads, pooled down to `size` and copied
+    to pinned CPU memory on a side CUDA stream without blocking the denoising loop.
+
+    Args:
+        layers (`Sequence[str]`, *optional*):
+            Processor name prefixes to record, e.g. `("up_blocks.0", "mid_block")`. All IP processors by default.
+        steps (`Sequence[int]`, *optional*):
+            Step indices (0-based, in denoising order) to record. All steps by default.
+        size (`Tuple[int, int]`, defaults to `(32, 24)`):
+            `(height, width)` the maps are average pooled to. Layers with a smaller resolution are kept as they are.
+    """
+
+    def __init__(
+        self,
+        layers: Optional[Sequence[str]] = None,
+        steps: Optional[Sequence[int]] = None,
+        size: Tuple[int, int] = (32, 24),
+    ):
+        self.layers = tuple(layers) if layers is not None else None
+        self.steps = set(steps) if steps is not None else None
+        self.size = tuple(size)
+
+        self._processors: List[torch.nn.Module] = []
+        self._stream: Optional[torch.cuda.Stream] = None
+        self._latent_size: Optional[Tuple[int, int]] = None
+        self._step: Optional[int] = None
+        self._timestep: Optional[int] = None
+        self.clear()
+
+    def clear(self):
+        self._records: List[Tuple[int, int, str, torch.Tensor, Optional[torch.cuda.Event]]] = []
+
+    def selects(self, name: str) -> bool:
+        return self.layers is None or any(name.startswith(prefix) for prefix in self.layers)
+
+    def attach(self, unet) -> "AttentionMapRecorder":
+        r"""
+        Hooks the recorder into the IP attention processors of `unet` whose name is selected by `layers`.
+        """
+        self.detach()
+        for name, processor in unet.attn_processors.items():
+            if hasattr(processor, "attn_map_recorder") and self.selects(name):
+                processor.attn_map_recorder = self
+                processor.attn_map_name = name
+                self._processors.append(processor)
+        return self
+
+    def detach(self):
+        for processor in self._processors:
+            processor.attn_map_recorder = None
+        self._processors = []
+
+    def begin(self, latent_height: int, latent_width: int):
+        r"""
+        Called by the pipeline before the denoising loop with the latent resolution, used to fold the query tokens
+        of every layer back into a 2D map.
+        """
+        self._latent_size = (latent_height, latent_width)
+        self._step = None
+
+    def set_step(self, step_index: int, timestep):
+        self._step = step_index
+        self._timestep = int(timestep)
+
+    def end(self):
+        self._step = None
+
+    @property
+    def active(self) -> bool:
+        return self._step is not None and (self.steps is None or self._step in self.steps)
+
+    @torch.no_grad()
+    def record(self, name: str, query: torch.Tensor, ip_key: torch.Tensor, scale: float):
+        r"""
+        Records the map of one attention call. `query` is `(batch, heads, tokens, head_dim)` and `ip_key` is
+        `(batch, heads, ip_tokens, head_dim)`.
+        """
+        if not self.active:
+            return
+        attn_map = (query.float() @ ip_key.float().transpose(-2, -1) * scale).softmax(dim=-1).mean(dim=1)
+
+        batch_size, num_tokens, num_ip_tokens = attn_map.shape
+        latent_height, latent_width = self._latent_size
+        downsample = math.sqrt(latent_height * latent_width / num_tokens)
+        height, width = round(latent_height / downsample), round(latent_width / downsample)
+        attn_map = attn_map.transpose(1, 2).reshape(batch_size, num_ip_tokens, height, width)
+        if height > self.size[0] or width > self.size[1]:
+            attn_map = F.adaptive_avg_pool2d(attn_map, (min(height, self.size[0]), min(width, self.size[1])))
+
+        host, event = self._offload(attn_map)
+        self._records.append((self._step, self._timestep, name, host, event))
+
+    def _offload(self, tensor: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+        if tensor.device.type != "cuda":
+            return tensor.clone(), None
+        if self._stream is None or self._stream.device != tensor.device:
+            self._stream = torch.cuda.Stream(tensor.device)
+        self._stream.wait_stream(torch.cuda.current_stream(tensor.device))
+        with torch.cuda.stream(self._stream):
+            host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            host.copy_(tensor, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        # keep the device buffer alive until the copy on the side stream is done
+        tensor.record_stream(self._stream)
+        return host, event
+
+    def maps(self) -> Dict[int, Dict[str, torch.Tensor]]:
+        r"""
+        Waits for the pending copies and returns the recorded maps as `{step_index: {layer_name: map}}`, every map
+        being a `(batch, ip_tokens, height, width)` float32 CPU tensor. With classifier free guidance the leading half
+        of the batch is the unconditional one.
+        """
+        maps: Dict[int, Dict[str, torch.Tensor]] = {}
+        for step, _, name, host, event in self._records:
+            if event is not None:
+                event.synchronize()
+            maps.setdefault(step, {})[name] = host
+        return maps
+
+    def timesteps(self) -> Dict[int, int]:
+        return {step: timestep for step, timestep, _, _, _ in self._records}
+
+    def save(self, path: str):
+        torch.save({"maps": self.maps(), "timesteps": self.timesteps(), "size": self.size}, path)
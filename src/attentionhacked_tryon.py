@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import math
 from typing import Any, Dict, Optional
 
 import torch
@@ -281,6 +282,53 @@ class BasicTransformerBlock(nn.Module):
         self._chunk_size = chunk_size
         self._chunk_dim = dim
 
+    def _garment_self_attention(
+        self,
+        norm_hidden_states: torch.FloatTensor,
+        garment_feature: torch.FloatTensor,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        cross_attention_kwargs: Dict[str, Any] = None,
+    ) -> torch.FloatTensor:
+        r"""
+        Self-attention of the person tokens over `[person tokens, garment tokens]`.
+
+        Only the person tokens are used as queries, the garment rows of the output were sliced off anyway. When
+        `garment_feature` has fewer rows than `norm_hidden_states`, the leading rows are the unconditional half of a
+        classifier free guidance batch and their garment tokens are taken to be zeros. With bias-free `to_k` / `to_v`
+        the M zero tokens each add a logit of 0 and a value of 0, which is exactly one zero key with a logit bias of
+        log(M), so the unconditional rows attend over N + 1 keys instead of N + M.
+        """
+        num_uncond = norm_hidden_states.shape[0] - garment_feature.shape[0]
+        if num_uncond < 0:
+            raise ValueError(
+                f"`garment_features` have batch size {garment_feature.shape[0]} but the hidden states only {norm_hidden_states.shape[0]}."
+            )
+        null_key = attention_mask is None and self.attn1.to_k.bias is None and self.attn1.to_v.bias is None
+        if num_uncond > 0 and not null_key:
+            garment_feature = torch.cat([garment_feature.new_zeros((num_uncond, *garment_feature.shape[1:])), garment_feature])
+            num_uncond = 0
+
+        norm_uncond, norm_cond = norm_hidden_states[:num_uncond], norm_hidden_states[num_uncond:]
+        attn_output = self.attn1(
+            norm_cond,
+            encoder_hidden_states=torch.cat([norm_cond, garment_feature], dim=1),
+            attention_mask=attention_mask,
+            **cross_attention_kwargs,
+        )
+        if num_uncond == 0:
+            return attn_output
+
+        seq_len = norm_uncond.shape[1]
+        null_bias = norm_uncond.new_zeros(num_uncond, 1, seq_len + 1)
+        null_bias[..., -1] = math.log(garment_feature.shape[1])
+        uncond_output = self.attn1(
+            norm_uncond,
+            encoder_hidden_states=torch.cat([norm_uncond, norm_uncond.new_zeros(num_uncond, 1, norm_uncond.shape[2])], dim=1),
+            attention_mask=null_bias,
+            **cross_attention_kwargs,
+        )
+        return torch.cat([uncond_output, attn_output])
+
     def forward(
         self,
         hidden_states: torch.FloatTensor,
@@ -331,15 +379,22 @@ class BasicTransformerBlock(nn.Module):
         gligen_kwargs = cross_attention_kwargs.pop("gligen", None)
 
 
-        modify_norm_hidden_states = torch.cat([norm_hidden_states,garment_features[curr_garment_feat_idx]], dim=1)
+        if self.only_cross_attention:
+            # garment tokens would only be queries here and their rows are dropped
+            attn_output = self.attn1(
+                norm_hidden_states,
+                encoder_hidden_states=encoder_hidden_states,
+                attention_mask=attention_mask,
+                **cross_attention_kwargs,
+            )
+        else:
+            attn_output = self._garment_self_attention(
+                norm_hidden_states,
+                garment_features[curr_garment_feat_idx],
+                attention_mask=attention_mask,
+                cross_attention_kwargs=cross_attention_kwargs,
+            )
         curr_garment_feat_idx +=1
-        attn_output = self.attn1(
-            #norm_hidden_states,
-            modify_norm_hidden_states,
-            encoder_hidden_states=encoder_hidden_states if self.only_cross_attention else None,
-            attention_mask=attention_mask,
-            **cross_attention_kwargs,
-        )
         if self.use_ada_layer_norm_zero:
             attn_output = gate_msa.unsqueeze(1) * attn_output
         elif self.use_ada_layer_norm_single:
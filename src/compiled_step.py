@@ -0,0 +1,222 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from diffusers.utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+# inputs of one denoising step, in the order they make up the shape key
+STEP_INPUTS = (
+    "latent_model_input",
+    "timestep",
+    "prompt_embeds",
+    "text_embeds",
+    "time_ids",
+    "image_embeds",
+    "timestep_cond",
+    "cloth",
+    "text_embeds_cloth",
+)
+
+
+def _shape_key(inputs: Dict[str, Optional[torch.Tensor]]) -> Tuple:
+    shapes = tuple(
+        None if inputs[name] is None else (tuple(inputs[name].shape), inputs[name].dtype, str(inputs[name].device))
+        for name in STEP_INPUTS
+    )
+    # autocast decides the kernels that are captured
+    return shapes + (torch.is_autocast_enabled(),)
+
+
+class _GraphedStep:
+    r"""
+    Static inputs, outputs and CUDA graphs of GarmentNet and the try-on UNet for one shape key.
+    """
+
+    def __init__(self, inputs: Dict[str, Optional[torch.Tensor]]):
+        self.inputs = {name: None if inputs[name] is None else inputs[name].clone() for name in STEP_INPUTS}
+        self.garment_features: List[torch.Tensor] = []
+        self.noise_pred: Optional[torch.Tensor] = None
+        self.garment_graph = torch.cuda.CUDAGraph()
+        self.unet_graph = torch.cuda.CUDAGraph()
+        # a private pool per shape: steps of different shapes never overwrite each other's outputs
+        self.pool = torch.cuda.graph_pool_handle()
+        self.replays = 0
+
+    def load(self, inputs: Dict[str, Optional[torch.Tensor]]):
+        with torch.inference_mode():
+            for name in STEP_INPUTS:
+                if inputs[name] is not None:
+                    self.inputs[name].copy_(inputs[name])
+
+    def garment(self) -> List[torch.Tensor]:
+        r"""
+        Replays GarmentNet on the loaded inputs. The returned features are the static outputs of the graph, valid
+        until its next replay.
+        """
+        self.garment_graph.replay()
+        return self.garment_features
+
+    def unet(self, garment_features: List[torch.Tensor]) -> Optional[torch.Tensor]:
+        r"""
+        Replays the try-on UNet with `garment_features` and returns the noise prediction, or `None` when the features
+        (e.g. precomputed ones) do not match the captured shapes.
+        """
+        if len(garment_features) != len(self.garment_features) or any(
+            feature.shape != static.shape or feature.dtype != static.dtype
+            for feature, static in zip(garment_features, self.garment_features)
+        ):
+            return None
+        with torch.inference_mode():
+            for feature, static in zip(garment_features, self.garment_features):
+                # features from the garment graph already are its outputs
+                if feature is not static:
+                    static.copy_(feature)
+        self.unet_graph.replay()
+        self.replays += 1
+        # the scheduler may keep the prediction across steps, the static output is overwritten by the next replay
+        return self.noise_pred.clone()
+
+
+class CompiledDenoisingStep:
+    r"""
+    Runs the GarmentNet and try-on UNet forward of a denoising step as captured CUDA graphs, one pair per input
+    shape, so a step launches two graphs instead of thousands of small kernels from Python.
+
+    A step is captured the first time its shapes (batch size, latent size, CFG on or off, timestep dtype, IP-adapter
+    tokens) are seen, after a few eager warm-up runs on a side stream; with `compile` the modules are compiled with
+    `torch.compile` first and the compiled kernels are captured. Later steps of the same shapes copy their inputs into
+    the static buffers of the graph and replay it. The garment features are the static outputs of the GarmentNet graph
+    and the inputs of the UNet graph, so they are not copied unless they come from a cache or a garment store.
+
+    Graph capture freezes Python control flow, which is sound here because it only depends on the shapes: the
+    `curr_garment_feat_idx` threaded through the hacked UNet blocks counts the transformer blocks in module order
+    and is the same on every call, so each block reads a fixed entry of the fixed-length garment feature list.
+    Python state that changes between steps is kept out of the graphs: the cross-attention K/V cache is suspended
+    during capture (the graph projects keys and values itself), and the pipeline runs steps eagerly with a deep
+    feature cache (whose restore point moves `curr_garment_feat_idx` per step), attention map recording, custom
+    `cross_attention_kwargs` or garment drift measurement.
+
+    Shapes that are not captured run eagerly: on CPU, after [`~CompiledDenoisingStep.freeze`], once `max_graphs`
+    shapes are captured, and when capture of a shape failed. Every captured shape holds a private memory pool of
+    about the peak activation memory of one step, so a server captures its shapes in a warm-up at start (see
+    [`~tryon_server.BatchingTryonServer.warmup`]) and freezes the set, rather than capturing on request paths.
+
+    Args:
+        unet (`UNet2DConditionModel`): The try-on UNet.
+        unet_encoder (`UNet2DConditionModel`): GarmentNet.
+        compile (`bool`, defaults to `False`): Compile both modules with `torch.compile` before capturing.
+        max_graphs (`int`, defaults to 8): Number of shapes captured.
+        warmup_iters (`int`, defaults to 2): Eager (or compiling) runs before a capture.
+    """
+
+    def __init__(self, unet, unet_encoder, compile: bool = False, max_graphs: int = 8, warmup_iters: int = 2):
+        if max_graphs < 1:
+            raise ValueError(f"`max_graphs` has to be a positive integer but is {max_graphs}.")
+        if warmup_iters < 1:
+            raise ValueError(f"`warmup_iters` has to be a positive integer but is {warmup_iters}.")
+        self.unet = torch.compile(unet, dynamic=False) if compile else unet
+        self.unet_encoder = torch.compile(unet_encoder, dynamic=False) if compile else unet_encoder
+        self.max_graphs = max_graphs
+        self.warmup_iters = warmup_iters
+        self.frozen = False
+        self.steps: Dict[Tuple, _GraphedStep] = {}
+        self.failed: Dict[Tuple, str] = {}
+        self.fallbacks = 0
+        self.capture_seconds = 0.0
+
+    def freeze(self):
+        r"""
+        Stops capturing new shapes; steps of other shapes run eagerly from now on.
+        """
+        self.frozen = True
+
+    def lookup(self, inputs: Dict[str, Optional[torch.Tensor]], kv_cache=None) -> Optional[_GraphedStep]:
+        r"""
+        The graphed step for the shapes of `inputs` (a tensor or `None` per name in `STEP_INPUTS`) with the inputs
+        loaded into it, capturing it if needed, or `None` when the step has to run eagerly.
+        """
+        if inputs["latent_model_input"].device.type != "cuda":
+            return None
+        key = _shape_key(inputs)
+        step = self.steps.get(key)
+        if step is None:
+            if self.frozen or key in self.failed or len(self.steps) >= self.max_graphs:
+                self.fallbacks += 1
+                return None
+            try:
+                step = self._capture(inputs, kv_cache)
+            except Exception as e:
+                self.failed[key] = str(e)
+                self.fallbacks += 1
+                logger.warning(f"Capturing the denoising step failed, steps of these shapes run eagerly: {e}")
+                return None
+            self.steps[key] = step
+        step.load(inputs)
+        return step
+
+    def _capture(self, inputs: Dict[str, Optional[torch.Tensor]], kv_cache=None) -> _GraphedStep:
+        start = time.perf_counter()
+        step = _GraphedStep(inputs)
+        x = step.inputs
+
+        def run_garment():
+            _, reference_features = self.unet_encoder(x["cloth"], x["timestep"], x["text_embeds_cloth"], return_dict=False)
+            return list(reference_features)
+
+        def run_unet(garment_features):
+            added_cond_kwargs = {"text_embeds": x["text_embeds"], "time_ids": x["time_ids"]}
+            if x["image_embeds"] is not None:
+                added_cond_kwargs["image_embeds"] = x["image_embeds"]
+            return self.unet(
+                x["latent_model_input"],
+                x["timestep"],
+                encoder_hidden_states=x["prompt_embeds"],
+                timestep_cond=x["timestep_cond"],
+                added_cond_kwargs=added_cond_kwargs,
+                return_dict=False,
+                garment_features=garment_features,
+            )[0]
+
+        kv_cache_active = kv_cache is not None and kv_cache.active
+        if kv_cache_active:
+            kv_cache.active = False
+        try:
+            with torch.inference_mode():
+                # cuBLAS/cuDNN workspaces, autotuning and compilation happen outside the graph
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    for _ in range(self.warmup_iters):
+                        run_unet(run_garment())
+                torch.cuda.current_stream().wait_stream(stream)
+
+                with torch.cuda.graph(step.garment_graph, pool=step.pool):
+                    step.garment_features = run_garment()
+                with torch.cuda.graph(step.unet_graph, pool=step.pool):
+                    step.noise_pred = run_unet(step.garment_features)
+        finally:
+            if kv_cache_active:
+                kv_cache.active = True
+        self.capture_seconds += time.perf_counter() - start
+        return step
+
+    def report(self) -> Dict:
+        r"""
+        Captured shapes with their replay counts, failed captures, eager fallbacks and total capture time.
+        """
+        return {
+            "graphs": len(self.steps),
+            "frozen": self.frozen,
+            "replays": sum(step.replays for step in self.steps.values()),
+            "fallbacks": self.fallbacks,
+            "failed": len(self.failed),
+            "capture_seconds": round(self.capture_seconds, 3),
+            "shapes": [
+                {"latents": list(key[0][0]), "timestep_dtype": str(key[1][1]), "replays": step.replays}
+                for key, step in self.steps.items()
+            ],
+        }
@@ -0,0 +1,138 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import PIL.Image
+import torch
+
+
+DEEP_CACHE_POLICIES = ("off", "interval", "steps")
+
+
+class DeepFeatureCache:
+    r"""
+    DeepCache-style feature reuse for the try-on UNet inside the denoising loop.
+
+    On full steps the whole UNet runs and the input of the shallowest `branch` up blocks is cached. On the other
+    steps only the first `branch` down blocks and the last `branch` up blocks run, on top of the cached deep
+    features. With the SDXL layout and `branch=2` this skips the 32x24 down block, the mid block and the first up
+    block (the 10-layer transformer stacks), while the 64x48 transformer blocks that consume garment features are
+    still recomputed every step.
+
+    The cached entry is keyed on the `curr_garment_feat_idx` reached after the shallow down blocks and stores the index
+    the shallow up blocks resume from, so the garment features consumed by the skipped blocks are stepped over and the
+    remaining ones are injected into the same layers as on a full step.
+
+    Args:
+        policy (`str`, defaults to `"interval"`):
+            `"off"` runs the full UNet every step, `"interval"` runs it every `interval` steps and `"steps"` on the
+            step indices in `steps`. The first step is always a full step.
+        interval (`int`, defaults to 3):
+            Full step period used by the `"interval"` policy.
+        steps (`Sequence[int]`, *optional*):
+            Step indices (0-based, in denoising order) of the full steps, used by the `"steps"` policy.
+        branch (`int`, defaults to 2):
+            Number of shallow resolution levels recomputed on reused steps.
+    """
+
+    def __init__(
+        self,
+        policy: str = "interval",
+        interval: int = 3,
+        steps: Optional[Sequence[int]] = None,
+        branch: int = 2,
+    ):
+        if policy not in DEEP_CACHE_POLICIES:
+            raise ValueError(f"`policy` has to be one of {DEEP_CACHE_POLICIES} but is {policy}.")
+        if policy == "interval" and interval < 1:
+            raise ValueError(f"`interval` has to be a positive integer but is {interval}.")
+        if policy == "steps" and not steps:
+            raise ValueError("`steps` has to be a non-empty list of step indices for the 'steps' policy.")
+        if branch < 1:
+            raise ValueError(f"`branch` has to be a positive integer but is {branch}.")
+
+        self.policy = policy
+        self.interval = interval
+        self.steps = set(steps) if steps is not None else set()
+        self.branch = branch
+        self.reset()
+
+    def reset(self):
+        self.entries: Dict[int, Tuple[torch.Tensor, int, int]] = {}
+        self.step_index = 0
+        self.num_full = 0
+        self.num_reused = 0
+
+    def invalidate(self):
+        r"""
+        Drops the cached features so the next step is a full step, e.g. when the batch changes within a call.
+        """
+        self.entries = {}
+
+    def _policy_full(self, step_index: int) -> bool:
+        if self.policy == "off":
+            return True
+        if self.policy == "interval":
+            return step_index % self.interval == 0
+        return step_index in self.steps
+
+    def full_steps(self, num_steps: int) -> List[int]:
+        r"""
+        Step indices on which the full UNet runs for a run of `num_steps` steps.
+        """
+        return [i for i in range(num_steps) if i == 0 or self._policy_full(i)]
+
+    def set_step(self, step_index: int):
+        self.step_index = step_index
+        if self.reuse:
+            self.num_reused += 1
+        else:
+            self.num_full += 1
+
+    @property
+    def reuse(self) -> bool:
+        return bool(self.entries) and not self._policy_full(self.step_index)
+
+    def store(self, sample: torch.Tensor, shallow_garment_feat_idx: int, curr_garment_feat_idx: int, num_res_samples: int):
+        r"""
+        Called by the UNet on full steps with the input of the first recomputed up block, the garment feature indices
+        at the end of the shallow down blocks and at this point, and the number of down block residuals left.
+        """
+        self.entries = {shallow_garment_feat_idx: (sample, curr_garment_feat_idx, num_res_samples)}
+
+    def restore(self, curr_garment_feat_idx: int, down_block_res_samples: Tuple[torch.Tensor, ...]):
+        r"""
+        Called by the UNet on reused steps after the shallow down blocks. Returns the cached deep features, the garment
+        feature index to resume from and the down block residuals the recomputed up blocks consume.
+        """
+        if curr_garment_feat_idx not in self.entries:
+            raise ValueError(
+                f"No cached deep features for garment feature index {curr_garment_feat_idx}, the UNet layout does not"
+                f" match the one of the last full step (cached: {list(self.entries)})."
+            )
+        sample, resume_idx, num_res_samples = self.entries[curr_garment_feat_idx]
+        return sample, resume_idx, down_block_res_samples[:num_res_samples]
+
+    def report(self) -> Dict[str, float]:
+        total = self.num_full + self.num_reused
+        return {
+            "policy": self.policy,
+            "branch": self.branch,
+            "steps": total,
+            "full": self.num_full,
+            "reused": self.num_reused,
+            "reused_fraction": self.num_reused / total if total else 0.0,
+        }
+
+
+def compare_images(images: Sequence[PIL.Image.Image], references: Sequence[PIL.Image.Image]) -> Dict[str, float]:
+    r"""
+    Mean PSNR (dB) and mean absolute error (0-255 scale) of `images` against `references`.
+    """
+    psnr, mae = [], []
+    for image, reference in zip(images, references):
+        a = np.asarray(image, dtype=np.float64)
+        b = np.asarray(reference.resize(image.size), dtype=np.float64)
+        mse = np.mean((a - b) ** 2)
+        psnr.append(10 * np.log10(255.0 ** 2 / mse) if mse > 0 else float("inf"))
+        mae.append(np.mean(np.abs(a - b)))
+    return {"psnr": float(np.mean(psnr)), "mae": float(np.mean(mae))}
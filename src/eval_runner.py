@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import PIL.Image
+
+
+MANIFEST_PREFIX = "manifest_shard"
+
+
+def shard_indices(num_items: int, num_shards: int, shard_index: int) -> List[int]:
+    r"""
+    Indices of the test pairs handled by shard `shard_index` of `num_shards`. Pairs are dealt round-robin so shards
+    differ by at most one pair and each sees the same mix of the (often sorted) pairs file.
+    """
+    if num_shards < 1:
+        raise ValueError(f"`num_shards` has to be a positive integer but is {num_shards}.")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"`shard_index` has to be in [0, {num_shards}) but is {shard_index}.")
+    return list(range(shard_index, num_items, num_shards))
+
+
+def pending_indices(names: Sequence[str], indices: Sequence[int], output_dir: str) -> Tuple[List[int], int]:
+    r"""
+    Drops the indices whose output `output_dir/names[i]` already exists. Returns the remaining indices and the number
+    of skipped ones.
+    """
+    existing = set(os.listdir(output_dir)) if os.path.isdir(output_dir) else set()
+    pending = [i for i in indices if names[i] not in existing]
+    return pending, len(indices) - len(pending)
+
+
+class ImageWriterPool:
+    r"""
+    Saves output images from a pool of background threads so the GPU loop does not wait on PNG/JPEG encoding and disk.
+
+    Each image is written to a hidden temporary file and renamed into place, so an interrupted run never leaves a
+    truncated output that a resumed run would skip. At most `max_pending` images are in flight; `submit` blocks
+    beyond that, which bounds the memory held by the queue.
+
+    Args:
+        num_workers (`int`, defaults to 4): Number of writer threads.
+        max_pending (`int`, *optional*): In-flight image limit, `4 * num_workers` by default.
+    """
+
+    def __init__(self, num_workers: int = 4, max_pending: Optional[int] = None):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="image-writer")
+        self._slots = threading.Semaphore(max_pending or 4 * num_workers)
+        self._lock = threading.Lock()
+        self._futures: List[Future] = []
+        self.written = 0
+        self.write_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _write(self, image: PIL.Image.Image, path: str):
+        try:
+            start = time.perf_counter()
+            directory, name = os.path.split(path)
+            tmp_path = os.path.join(directory, f".tmp-{name}")
+            image.save(tmp_path)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self.written += 1
+                self.write_seconds += time.perf_counter() - start
+        finally:
+            self._slots.release()
+
+    def submit(self, image: PIL.Image.Image, path: str):
+        start = time.perf_counter()
+        self._slots.acquire()
+        self.wait_seconds += time.perf_counter() - start
+        self._futures.append(self.executor.submit(self._write, image, path))
+        # surface write errors early instead of at close
+        done = [f for f in self._futures if f.done()]
+        self._futures = [f for f in self._futures if not f.done()]
+        for future in done:
+            future.result()
+
+    def close(self):
+        start = time.perf_counter()
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        self.executor.shutdown(wait=True)
+        self.wait_seconds += time.perf_counter() - start
+
+
+class ShardManifest:
+    r"""
+    Progress and timing of one shard, rewritten to `output_dir/manifest_shard{index:03d}-of-{num_shards:03d}.json`
+    after every batch so a crashed or still running shard can be inspected. [`merge_manifests`] combines the shards.
+
+    Args:
+        output_dir (`str`): Directory of the outputs and the manifest.
+        shard_index (`int`): Index of this shard.
+        num_shards (`int`): Total number of shards.
+        assigned (`int`): Pairs assigned to this shard.
+        skipped (`int`): Assigned pairs skipped because their output already existed.
+        device (`str`, *optional*): Device the shard runs on.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        shard_index: int,
+        num_shards: int,
+        assigned: int,
+        skipped: int,
+        device: Optional[str] = None,
+    ):
+        self.path = os.path.join(output_dir, f"{MANIFEST_PREFIX}{shard_index:03d}-of-{num_shards:03d}.json")
+        self.start = time.perf_counter()
+        self.data = {
+            "shard_index": shard_index,
+            "num_shards": num_shards,
+            "device": device,
+            "assigned": assigned,
+            "skipped": skipped,
+            "completed": 0,
+            "batches": 0,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "finished": None,
+            "wall_seconds": 0.0,
+            "load_seconds": 0.0,
+            "pipeline_seconds": 0.0,
+            "write_seconds": 0.0,
+            "writer_wait_seconds": 0.0,
+            "images_per_second": 0.0,
+        }
+
+    def record_batch(self, num_images: int, load_seconds: float, pipeline_seconds: float, writer: ImageWriterPool):
+        self.data["completed"] += num_images
+        self.data["batches"] += 1
+        self.data["load_seconds"] += load_seconds
+        self.data["pipeline_seconds"] += pipeline_seconds
+        self.save(writer)
+
+    def finish(self, writer: ImageWriterPool):
+        self.data["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.save(writer)
+
+    def save(self, writer: ImageWriterPool):
+        wall_seconds = time.perf_counter() - self.start
+        self.data["wall_seconds"] = wall_seconds
+        self.data["write_seconds"] = writer.write_seconds
+        self.data["writer_wait_seconds"] = writer.wait_seconds
+        self.data["images_per_second"] = self.data["completed"] / wall_seconds if wall_seconds > 0 else 0.0
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def merge_manifests(output_dir: str, num_shards: int) -> Dict:
+    r"""
+    Combines the manifests of the `num_shards` shards of a run found in `output_dir`. Manifests left by an earlier run
+    with a different number of shards are ignored. The total throughput is the sum over the shards, the wall time the
+    one of the slowest shard.
+    """
+    suffix = f"-of-{num_shards:03d}.json"
+    shards = []
+    for name in sorted(os.listdir(output_dir)):
+        if name.startswith(MANIFEST_PREFIX) and name.endswith(suffix):
+            with open(os.path.join(output_dir, name)) as f:
+                shards.append(json.load(f))
+    summary = {
+        "shards": len(shards),
+        "finished": sum(shard["finished"] is not None for shard in shards),
+    }
+    for key in ("assigned", "skipped", "completed", "batches", "pipeline_seconds", "load_seconds", "write_seconds"):
+        summary[key] = sum(shard[key] for shard in shards)
+    summary["wall_seconds"] = max((shard["wall_seconds"] for shard in shards), default=0.0)
+    summary["images_per_second"] = sum(shard["images_per_second"] for shard in shards)
+    summary["per_shard"] = [
+        {key: shard[key] for key in ("shard_index", "device", "completed", "wall_seconds", "images_per_second")}
+        for shard in shards
+    ]
+    return summary
@@ -0,0 +1,120 @@
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import torch
+
+
+GARMENT_CACHE_POLICIES = ("always", "once", "interval", "steps")
+
+
+class GarmentFeatureCache:
+    r"""
+    Reuse policy for the GarmentNet (`unet_encoder`) reference features inside the denoising loop.
+
+    The garment latent fed to `unet_encoder` is the same clean latent at every step, only the timestep changes, so
+    the `reference_features` list can be computed on a coarse schedule and reused in between.
+
+    Args:
+        policy (`str`, defaults to `"always"`):
+            `"always"` recomputes every step (original behaviour), `"once"` computes on the first step only,
+            `"interval"` recomputes every `interval` steps and `"steps"` recomputes on the step indices in `steps`.
+            The first step is always computed.
+        interval (`int`, defaults to 1):
+            Refresh period used by the `"interval"` policy.
+        steps (`Sequence[int]`, *optional*):
+            Step indices (0-based, in denoising order) to refresh on, used by the `"steps"` policy.
+        measure_drift (`bool`, defaults to `False`):
+            Also run `unet_encoder` on reused steps and record the relative L2 distance between the cached and the
+            fresh features. This is a quality probe only and removes the speed-up.
+        sync_timing (`bool`, defaults to `False`):
+            Synchronize CUDA around encoder calls so `encoder_seconds` in the report is accurate.
+    """
+
+    def __init__(
+        self,
+        policy: str = "always",
+        interval: int = 1,
+        steps: Optional[Sequence[int]] = None,
+        measure_drift: bool = False,
+        sync_timing: bool = False,
+    ):
+        if policy not in GARMENT_CACHE_POLICIES:
+            raise ValueError(f"`policy` has to be one of {GARMENT_CACHE_POLICIES} but is {policy}.")
+        if policy == "interval" and interval < 1:
+            raise ValueError(f"`interval` has to be a positive integer but is {interval}.")
+        if policy == "steps" and not steps:
+            raise ValueError("`steps` has to be a non-empty list of step indices for the 'steps' policy.")
+
+        self.policy = policy
+        self.interval = interval
+        self.steps = set(steps) if steps is not None else set()
+        self.measure_drift = measure_drift
+        self.sync_timing = sync_timing
+        self.reset()
+
+    def reset(self):
+        self.features: Optional[List[torch.Tensor]] = None
+        self.num_computed = 0
+        self.num_reused = 0
+        self.encoder_seconds = 0.0
+        self.drift: List[float] = []
+
+    def _policy_refresh(self, step_index: int) -> bool:
+        if self.policy == "always":
+            return True
+        if self.policy == "once":
+            return False
+        if self.policy == "interval":
+            return step_index % self.interval == 0
+        return step_index in self.steps
+
+    def should_refresh(self, step_index: int) -> bool:
+        return self.features is None or self._policy_refresh(step_index)
+
+    def refresh_steps(self, num_steps: int) -> List[int]:
+        r"""
+        Step indices on which features are computed for a run of `num_steps` steps.
+        """
+        return [i for i in range(num_steps) if i == 0 or self._policy_refresh(i)]
+
+    def _run(self, compute_fn: Callable[[], List[torch.Tensor]]) -> List[torch.Tensor]:
+        if self.sync_timing and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        features = list(compute_fn())
+        if self.sync_timing and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.encoder_seconds += time.perf_counter() - start
+        return features
+
+    def get(self, step_index: int, compute_fn: Callable[[], List[torch.Tensor]]) -> List[torch.Tensor]:
+        r"""
+        Returns the reference features for `step_index`, calling `compute_fn` only when the policy asks for it.
+        """
+        if self.should_refresh(step_index):
+            self.features = self._run(compute_fn)
+            self.num_computed += 1
+            return self.features
+
+        if self.measure_drift:
+            fresh = self._run(compute_fn)
+            num = sum((c.float() - f.float()).norm().item() for c, f in zip(self.features, fresh))
+            den = sum(f.float().norm().item() for f in fresh)
+            self.drift.append(num / max(den, 1e-12))
+        self.num_reused += 1
+        return self.features
+
+    def report(self) -> Dict[str, float]:
+        total = self.num_computed + self.num_reused
+        report = {
+            "policy": self.policy,
+            "steps": total,
+            "computed": self.num_computed,
+            "reused": self.num_reused,
+            "encoder_calls_saved": self.num_reused / total if total else 0.0,
+            "encoder_seconds": self.encoder_seconds,
+        }
+        if self.drift:
+            report["mean_drift"] = sum(self.drift) / len(self.drift)
+            report["max_drift"] = max(self.drift)
+        return report
@@ -0,0 +1,274 @@
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Union
+
+import PIL.Image
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from diffusers.models import ImageProjection
+
+from src.prompt_cache import GARMENT_PROMPT_TEMPLATE
+
+
+def garment_key(image: PIL.Image.Image, description: str) -> str:
+    r"""
+    Content hash of a garment image and its description, used as the key of the feature store.
+    """
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    h.update(image.tobytes())
+    h.update(description.encode())
+    return h.hexdigest()
+
+
+@dataclass
+class GarmentFeatures:
+    r"""
+    Everything the try-on pipeline derives from a garment image and its description.
+
+    Args:
+        cloth_latents (`torch.FloatTensor`): VAE latents of the garment, `(batch, 4, height / 8, width / 8)`.
+        ip_tokens (`torch.FloatTensor`): IP-adapter tokens after `unet.encoder_hid_proj`.
+        negative_ip_tokens (`torch.FloatTensor`): Unconditional IP-adapter tokens used with classifier free guidance.
+        text_embeds_cloth (`torch.FloatTensor`): Prompt embeddings of the garment description for GarmentNet.
+        reference_features (`Dict[int, List[torch.FloatTensor]]`):
+            GarmentNet reference features keyed by timestep. Only the timesteps on which the pipeline refreshes the
+            features have to be present; missing ones are computed on the fly.
+    """
+
+    cloth_latents: torch.Tensor
+    ip_tokens: torch.Tensor
+    negative_ip_tokens: torch.Tensor
+    text_embeds_cloth: torch.Tensor
+    reference_features: Dict[int, List[torch.Tensor]] = field(default_factory=dict)
+
+    def ip_adapter_image_embeds(self, do_classifier_free_guidance: bool = True) -> torch.Tensor:
+        if do_classifier_free_guidance:
+            return torch.cat([self.negative_ip_tokens, self.ip_tokens])
+        return self.ip_tokens
+
+    def to(self, device=None, dtype=None) -> "GarmentFeatures":
+        return GarmentFeatures(
+            cloth_latents=self.cloth_latents.to(device=device, dtype=dtype),
+            ip_tokens=self.ip_tokens.to(device=device, dtype=dtype),
+            negative_ip_tokens=self.negative_ip_tokens.to(device=device, dtype=dtype),
+            text_embeds_cloth=self.text_embeds_cloth.to(device=device, dtype=dtype),
+            reference_features={
+                t: [f.to(device=device, dtype=dtype) for f in feats] for t, feats in self.reference_features.items()
+            },
+        )
+
+    @classmethod
+    def cat(cls, items: Sequence["GarmentFeatures"]) -> "GarmentFeatures":
+        r"""
+        Stacks per-garment features along the batch dimension. Reference features are kept for the timesteps that
+        all items share.
+        """
+        timesteps = set.intersection(*[set(item.reference_features) for item in items])
+        return cls(
+            cloth_latents=torch.cat([item.cloth_latents for item in items]),
+            ip_tokens=torch.cat([item.ip_tokens for item in items]),
+            negative_ip_tokens=torch.cat([item.negative_ip_tokens for item in items]),
+            text_embeds_cloth=torch.cat([item.text_embeds_cloth for item in items]),
+            reference_features={
+                t: [torch.cat(feats) for feats in zip(*[item.reference_features[t] for item in items])]
+                for t in sorted(timesteps)
+            },
+        )
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        tensors = {
+            "cloth_latents": self.cloth_latents,
+            "ip_tokens": self.ip_tokens,
+            "negative_ip_tokens": self.negative_ip_tokens,
+            "text_embeds_cloth": self.text_embeds_cloth,
+        }
+        for t, feats in self.reference_features.items():
+            for idx, feat in enumerate(feats):
+                tensors[f"reference_features.{t}.{idx}"] = feat
+        return {k: v.detach().to("cpu").contiguous() for k, v in tensors.items()}
+
+    @classmethod
+    def from_state_dict(cls, tensors: Dict[str, torch.Tensor]) -> "GarmentFeatures":
+        reference_features: Dict[int, Dict[int, torch.Tensor]] = {}
+        for name, tensor in tensors.items():
+            if name.startswith("reference_features."):
+                _, t, idx = name.split(".")
+                reference_features.setdefault(int(t), {})[int(idx)] = tensor
+        return cls(
+            cloth_latents=tensors["cloth_latents"],
+            ip_tokens=tensors["ip_tokens"],
+            negative_ip_tokens=tensors["negative_ip_tokens"],
+            text_embeds_cloth=tensors["text_embeds_cloth"],
+            reference_features={t: [feats[i] for i in sorted(feats)] for t, feats in reference_features.items()},
+        )
+
+
+@torch.no_grad()
+def precompute_garment_features(
+    pipe,
+    garment_image: PIL.Image.Image,
+    description: str,
+    timesteps: Sequence[int] = (),
+    height: int = 1024,
+    width: int = 768,
+    generator: Optional[torch.Generator] = None,
+) -> GarmentFeatures:
+    r"""
+    Runs the garment side of the try-on pipeline once: the VAE encode of the garment, the CLIP image encoder and
+    `encoder_hid_proj` for the IP-adapter tokens, the text encoders for `"a photo of " + description`, and
+    GarmentNet for each timestep in `timesteps`.
+    """
+    device = pipe._execution_device
+    dtype = pipe.unet.dtype
+
+    garment_image = garment_image.convert("RGB").resize((width, height))
+    cloth = pipe.image_processor.preprocess(garment_image, height=height, width=width).to(device, dtype)
+    cloth_latents = pipe._encode_vae_image(cloth, generator=generator)
+
+    output_hidden_state = not isinstance(pipe.unet.encoder_hid_proj, ImageProjection)
+    image_embeds, negative_image_embeds = pipe.encode_image(garment_image, device, 1, output_hidden_state)
+    ip_tokens = pipe.unet.encoder_hid_proj(image_embeds).to(dtype)
+    negative_ip_tokens = pipe.unet.encoder_hid_proj(negative_image_embeds).to(dtype)
+
+    text_embeds_cloth, _, _, _ = pipe.encode_prompt(
+        [GARMENT_PROMPT_TEMPLATE + description],
+        num_images_per_prompt=1,
+        do_classifier_free_guidance=False,
+    )
+    text_embeds_cloth = text_embeds_cloth.to(device, dtype)
+
+    reference_features = {}
+    for t in timesteps:
+        t = int(t)
+        _, feats = pipe.unet_encoder(
+            cloth_latents, torch.tensor(t, device=device), text_embeds_cloth, return_dict=False
+        )
+        reference_features[t] = list(feats)
+
+    return GarmentFeatures(
+        cloth_latents=cloth_latents,
+        ip_tokens=ip_tokens,
+        negative_ip_tokens=negative_ip_tokens,
+        text_embeds_cloth=text_embeds_cloth,
+        reference_features=reference_features,
+    )
+
+
+class GarmentFeatureStore:
+    r"""
+    On-disk garment feature store with an LRU tier on the device.
+
+    Every garment is one safetensors file under `root/<key[:2]>/<key>.safetensors`; files are opened memory-mapped
+    and only copied to `device` on a miss of the in-memory tier.
+
+    Args:
+        root (`str`): Directory of the store.
+        device (`str` or `torch.device`, defaults to `"cuda"`): Device of the in-memory tier.
+        dtype (`torch.dtype`, defaults to `torch.float16`): Dtype of the in-memory tier.
+        max_device_entries (`int`, defaults to 32):
+            Number of garments kept on `device`. Reference features take ~150MB per stored timestep at 768x1024,
+            so size this to the GPU memory left after the models.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        device: Union[str, torch.device] = "cuda",
+        dtype: torch.dtype = torch.float16,
+        max_device_entries: int = 32,
+    ):
+        self.root = root
+        self.device = device
+        self.dtype = dtype
+        self.max_device_entries = max_device_entries
+        self._device_cache: "OrderedDict[str, GarmentFeatures]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".safetensors")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._device_cache or os.path.exists(self.path(key))
+
+    def _insert(self, key: str, features: GarmentFeatures):
+        self._device_cache[key] = features
+        self._device_cache.move_to_end(key)
+        while len(self._device_cache) > self.max_device_entries:
+            self._device_cache.popitem(last=False)
+
+    def put(self, key: str, features: GarmentFeatures, description: str = ""):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        save_file(features.state_dict(), tmp_path, metadata={"key": key, "description": description})
+        os.replace(tmp_path, path)
+        self._insert(key, features.to(self.device, self.dtype))
+
+    def get(self, key: str) -> Optional[GarmentFeatures]:
+        if key in self._device_cache:
+            self.hits += 1
+            self._device_cache.move_to_end(key)
+            return self._device_cache[key]
+
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        self.disk_hits += 1
+        with safe_open(path, framework="pt", device="cpu") as f:
+            tensors = {name: f.get_tensor(name) for name in f.keys()}
+        features = GarmentFeatures.from_state_dict(tensors).to(self.device, self.dtype)
+        self._insert(key, features)
+        return features
+
+    def get_or_compute(
+        self,
+        pipe,
+        garment_image: PIL.Image.Image,
+        description: str,
+        timesteps: Sequence[int] = (),
+        **kwargs,
+    ) -> GarmentFeatures:
+        r"""
+        Looks the garment up by content hash and runs `precompute_garment_features` on a miss. A stored entry that
+        lacks some of `timesteps` is recomputed and overwritten.
+        """
+        key = garment_key(garment_image, description)
+        features = self.get(key)
+        if features is not None and all(int(t) in features.reference_features for t in timesteps):
+            return features
+        features = precompute_garment_features(pipe, garment_image, description, timesteps=timesteps, **kwargs)
+        self.put(key, features, description=description)
+        return self._device_cache[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "device_entries": len(self._device_cache),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+
+def garment_refresh_timesteps(pipe, num_inference_steps: int, garment_cache=None, strength: float = 1.0) -> List[int]:
+    r"""
+    Timesteps on which the pipeline needs GarmentNet features for a run with `num_inference_steps`, i.e. the ones
+    worth precomputing. Without a `garment_cache` every timestep of the schedule is returned.
+    """
+    from src.tryon_pipeline import retrieve_timesteps
+
+    device = pipe._execution_device
+    timesteps, num_inference_steps = retrieve_timesteps(pipe.scheduler, num_inference_steps, device)
+    timesteps, num_inference_steps = pipe.get_timesteps(num_inference_steps, strength, device)
+    timesteps = [int(t) for t in timesteps]
+    if garment_cache is None:
+        return timesteps
+    return [timesteps[i] for i in garment_cache.refresh_steps(len(timesteps))]
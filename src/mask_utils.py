@@ -0,0 +1,165 @@
+import time
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import PIL.Image
+import torch
+import torch.nn.functional as F
+
+
+ImageBatch = Union[PIL.Image.Image, Sequence[PIL.Image.Image], np.ndarray, torch.Tensor]
+
+
+def pil_to_binary_mask(pil_image: PIL.Image.Image, threshold: int = 0) -> PIL.Image.Image:
+    r"""
+    Grayscale `pil_image`, threshold it at `threshold` and return an `L` mask with values 0 / 255.
+    """
+    binary_mask = np.asarray(pil_image.convert("L")) > threshold
+    return PIL.Image.fromarray(binary_mask.astype(np.uint8) * 255)
+
+
+def to_uint8_tensor(images: ImageBatch, device: Optional[Union[str, torch.device]] = None) -> torch.Tensor:
+    r"""
+    Stacks PIL images, `(H, W, C)` / `(B, H, W, C)` arrays or tensors into a `(B, C, H, W)` uint8 tensor on `device`.
+    Tensors with 3 or 4 dimensions are taken to be channel first already.
+    """
+    if isinstance(images, torch.Tensor):
+        tensor = images if images.ndim == 4 else images.unsqueeze(0)
+        return tensor.to(device)
+    if isinstance(images, PIL.Image.Image):
+        images = [images]
+    if isinstance(images, np.ndarray):
+        array = images if images.ndim == 4 else images[None]
+    else:
+        array = np.stack([np.asarray(image) for image in images])
+    if array.ndim == 3:
+        array = array[..., None]
+    return torch.from_numpy(np.ascontiguousarray(array)).permute(0, 3, 1, 2).to(device)
+
+
+def rgb_to_gray(images: torch.Tensor) -> torch.Tensor:
+    r"""
+    ITU-R 601-2 luma of `(B, C, H, W)` uint8 images with the fixed point weights of PIL's `convert("L")`, so the
+    result is bit-identical to it. Alpha channels are dropped, single channel input is returned as is.
+    """
+    if images.shape[1] == 1:
+        return images
+    rgb = images[:, :3].to(torch.int32)
+    gray = (rgb[:, 0:1] * 19595 + rgb[:, 1:2] * 38470 + rgb[:, 2:3] * 7471 + 0x8000) >> 16
+    return gray.to(torch.uint8)
+
+
+def binarize(gray: torch.Tensor, threshold: int = 0) -> torch.Tensor:
+    r"""
+    `(B, 1, H, W)` float mask in {0, 1} of the pixels of `gray` above `threshold`.
+    """
+    return (gray > threshold).to(torch.float32)
+
+
+def resize_masks(masks: torch.Tensor, size: Tuple[int, int], mode: str = "nearest") -> torch.Tensor:
+    r"""
+    Resizes a `(B, C, H, W)` batch to `size` given as `(width, height)` like `PIL.Image.resize`.
+    """
+    width, height = size
+    if masks.shape[-2:] == (height, width):
+        return masks
+    dtype = masks.dtype
+    kwargs = {} if mode == "nearest" else {"align_corners": False}
+    resized = F.interpolate(masks.float(), size=(height, width), mode=mode, **kwargs)
+    if dtype == torch.uint8:
+        resized = resized.round().clamp(0, 255)
+    return resized.to(dtype)
+
+
+def binary_masks(
+    masks: ImageBatch,
+    size: Optional[Tuple[int, int]] = None,
+    threshold: int = 0,
+    device: Optional[Union[str, torch.device]] = None,
+) -> torch.Tensor:
+    r"""
+    Batched `pil_to_binary_mask`: grayscale, optional resize to `size` (`(width, height)`, bilinear) and threshold,
+    returning a `(B, 1, H, W)` float mask in {0, 1} on `device`. The resize happens on the grayscale image, so it only
+    matches the PIL path up to interpolation differences; without `size` the result is exact.
+    """
+    gray = rgb_to_gray(to_uint8_tensor(masks, device))
+    if size is not None:
+        gray = resize_masks(gray, size, mode="bilinear")
+    return binarize(gray, threshold)
+
+
+def masked_gray(images: ImageBatch, masks: torch.Tensor, device: Optional[Union[str, torch.device]] = None) -> torch.Tensor:
+    r"""
+    Batched `mask_gray` of the demo: the person images with the masked area set to gray, `(B, 3, H, W)` uint8.
+
+    Uses the same float32 operations as `ToTensor`, `Normalize([0.5], [0.5])` and `to_pil_image` so the output is
+    bit-identical to the PIL path.
+
+    Args:
+        images (`PIL.Image.Image`, list of them, `np.ndarray` or `torch.Tensor`): RGB person images.
+        masks (`torch.Tensor`): `(B, 1, H, W)` mask in [0, 1], 1 where the garment is inpainted.
+    """
+    images = to_uint8_tensor(images, device)[:, :3]
+    images = images.to(torch.float32).div(255).sub(0.5).div(0.5)
+    out = (1 - masks.to(images.device, torch.float32)) * images
+    return ((out + 1.0) / 2.0).mul(255).to(torch.uint8)
+
+
+def to_pil_images(images: torch.Tensor) -> List[PIL.Image.Image]:
+    r"""
+    `(B, C, H, W)` uint8 tensor to a list of PIL images (`L` for one channel, `RGB` for three).
+    """
+    array = images.permute(0, 2, 3, 1).cpu().numpy()
+    if array.shape[-1] == 1:
+        return [PIL.Image.fromarray(a[..., 0]) for a in array]
+    return [PIL.Image.fromarray(a) for a in array]
+
+
+def _pil_to_binary_mask_loop(pil_image, threshold=0):
+    # per pixel reference kept for the benchmark below
+    np_image = np.array(pil_image)
+    grayscale_image = PIL.Image.fromarray(np_image).convert("L")
+    binary_mask = np.array(grayscale_image) > threshold
+    mask = np.zeros(binary_mask.shape, dtype=np.uint8)
+    for i in range(binary_mask.shape[0]):
+        for j in range(binary_mask.shape[1]):
+            if binary_mask[i, j] == True:
+                mask[i, j] = 1
+    mask = (mask * 255).astype(np.uint8)
+    return PIL.Image.fromarray(mask)
+
+
+def benchmark(batch_size: int = 8, width: int = 768, height: int = 1024, repeats: int = 5):
+    rng = np.random.default_rng(0)
+    layers = [
+        PIL.Image.fromarray((rng.random((height, width, 3)) > 0.7).astype(np.uint8) * 255) for _ in range(batch_size)
+    ]
+    devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+    def timed(fn):
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / repeats * 1000
+
+    loop_ms = timed(lambda: _pil_to_binary_mask_loop(layers[0]))
+    print(f"pil_to_binary_mask, per-pixel loop:  {loop_ms:9.2f} ms / mask")
+    pil_ms = timed(lambda: pil_to_binary_mask(layers[0]))
+    print(f"pil_to_binary_mask, vectorized:      {pil_ms:9.2f} ms / mask")
+    for device in devices:
+        batch = to_uint8_tensor(layers, device)
+        ms = timed(lambda: binarize(rgb_to_gray(batch)))
+        print(f"binary_masks on {device:4s}, batch {batch_size}: {ms / batch_size:9.2f} ms / mask")
+
+    reference = np.stack([np.asarray(_pil_to_binary_mask_loop(layer)) for layer in layers[:2]])
+    vectorized = binarize(rgb_to_gray(to_uint8_tensor(layers[:2]))).mul(255).to(torch.uint8)[:, 0].numpy()
+    assert np.array_equal(reference, vectorized)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,204 @@
+import glob
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from huggingface_hub import snapshot_download
+from safetensors import safe_open
+
+
+def _weights_files(pretrained_model_name_or_path: str, subfolder: Optional[str]) -> List[str]:
+    if os.path.isdir(pretrained_model_name_or_path):
+        root = pretrained_model_name_or_path
+    else:
+        pattern = f"{subfolder}/*" if subfolder else "*"
+        root = snapshot_download(pretrained_model_name_or_path, allow_patterns=[pattern])
+    directory = os.path.join(root, subfolder) if subfolder else root
+    # non-variant weights only, e.g. not `diffusion_pytorch_model.fp16.safetensors`
+    return sorted(
+        path
+        for path in glob.glob(os.path.join(directory, "*.safetensors"))
+        if os.path.basename(path).count(".") == 1
+    )
+
+
+def load_model_mmap(
+    model_cls,
+    pretrained_model_name_or_path: str,
+    subfolder: Optional[str] = None,
+    torch_dtype: Optional[torch.dtype] = None,
+    device: Optional[torch.device] = None,
+):
+    r"""
+    Loads a diffusers model by memory-mapping its safetensors weights straight into `torch_dtype` on `device`.
+
+    The model is built on the meta device, so no randomly initialized weights are allocated, and every tensor is read
+    from the mapped file, cast and placed once. Floating point weights are cast, others keep their dtype. Falls back
+    to `model_cls.from_pretrained` when there are no (non-variant) safetensors weights or they do not match the
+    model's parameters exactly.
+
+    Args:
+        model_cls (`type`): A diffusers `ModelMixin` subclass, e.g. the try-on or garment UNet.
+        pretrained_model_name_or_path (`str`): Hub repository id or local directory.
+        subfolder (`str`, *optional*): Subfolder of the model, e.g. `"unet"`.
+        torch_dtype (`torch.dtype`, *optional*): Dtype of the floating point weights.
+        device (`torch.device`, *optional*): Target device, CPU by default.
+    """
+    device = torch.device(device or "cpu")
+    files = _weights_files(pretrained_model_name_or_path, subfolder)
+    config = model_cls.load_config(pretrained_model_name_or_path, subfolder=subfolder)
+    with init_empty_weights():
+        model = model_cls.from_config(config)
+    expected = set(model.state_dict().keys())
+
+    found = set()
+    handles = [safe_open(path, framework="pt", device="cpu") for path in files]
+    for handle in handles:
+        found.update(handle.keys())
+    if not files or found != expected:
+        return model_cls.from_pretrained(pretrained_model_name_or_path, subfolder=subfolder, torch_dtype=torch_dtype).to(device)
+
+    for handle in handles:
+        for name in handle.keys():
+            tensor = handle.get_tensor(name)
+            dtype = torch_dtype if torch_dtype is not None and tensor.is_floating_point() else tensor.dtype
+            set_module_tensor_to_device(model, name, device, value=tensor, dtype=dtype)
+    model.eval()
+    return model
+
+
+@dataclass
+class _Entry:
+    name: str
+    loader: Callable[[], Any]
+    lazy: bool
+    after: Sequence[str]
+    future: Optional[Future] = None
+    start: Optional[float] = None
+    end: Optional[float] = None
+    thread: Optional[str] = None
+    trigger: Optional[str] = None
+
+
+class ModelRegistry:
+    r"""
+    Loads the models of a server concurrently and on demand, and records a startup timeline.
+
+    Components are registered with a loader function. [`~ModelRegistry.load`] starts the eager ones on a thread pool
+    as soon as the components they depend on (`after`) are loaded, and returns when they are all ready. Lazy
+    components are loaded on their first [`~ModelRegistry.get`], or in the background with `warm_lazy=True` once the
+    eager ones are ready; a `get` during a background load waits for it instead of loading twice.
+
+    Loading threads overlap disk reads, host-to-device copies and CPU-side model construction, which all release the
+    GIL for the most part, so startup approaches the time of the largest component instead of the sum.
+
+    Args:
+        max_workers (`int`, defaults to 4): Components loaded at the same time.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self._entries: Dict[str, _Entry] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-loader")
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self.ready_seconds: Optional[float] = None
+
+    def register(self, name: str, loader: Callable[[], Any], lazy: bool = False, after: Sequence[str] = ()):
+        if name in self._entries:
+            raise ValueError(f"A model named {name!r} is already registered.")
+        for dependency in after:
+            if dependency not in self._entries:
+                raise ValueError(f"{name!r} depends on {dependency!r}, which has to be registered first.")
+        self._entries[name] = _Entry(name=name, loader=loader, lazy=lazy, after=tuple(after))
+        return self
+
+    def _run(self, entry: _Entry):
+        for dependency in entry.after:
+            self._entries[dependency].future.result()
+        entry.thread = threading.current_thread().name
+        entry.start = time.perf_counter()
+        try:
+            return entry.loader()
+        finally:
+            entry.end = time.perf_counter()
+
+    def _schedule(self, name: str, trigger: str) -> Future:
+        with self._lock:
+            self._submit(name, trigger)
+            return self._entries[name].future
+
+    def _submit(self, name: str, trigger: str):
+        entry = self._entries[name]
+        if entry.future is None:
+            # dependencies are submitted first, so a worker never waits on a load queued behind it
+            for dependency in entry.after:
+                self._submit(dependency, trigger)
+            entry.trigger = trigger
+            entry.future = self._executor.submit(self._run, entry)
+
+    def load(self, warm_lazy: bool = False) -> "ModelRegistry":
+        r"""
+        Loads all eager components and waits for them. With `warm_lazy`, the lazy components are then loaded in the
+        background.
+        """
+        self._t0 = time.perf_counter()
+        futures = [self._schedule(name, "startup") for name, entry in self._entries.items() if not entry.lazy]
+        for future in futures:
+            future.result()
+        self.ready_seconds = time.perf_counter() - self._t0
+        if warm_lazy:
+            self.warm_lazy()
+        return self
+
+    def warm_lazy(self) -> "ModelRegistry":
+        r"""
+        Starts loading the lazy components that are not loaded yet in the background.
+        """
+        for name, entry in self._entries.items():
+            if entry.lazy:
+                self._schedule(name, "background")
+        return self
+
+    def get(self, name: str) -> Any:
+        if name not in self._entries:
+            raise KeyError(f"No model named {name!r} is registered.")
+        return self._schedule(name, "first_use").result()
+
+    def __getitem__(self, name: str) -> Any:
+        return self.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    def is_loaded(self, name: str) -> bool:
+        future = self._entries[name].future
+        return future is not None and future.done()
+
+    def timeline(self) -> Dict[str, Any]:
+        r"""
+        Start and end of every component load in seconds since `load` was called, the loading thread, whether it
+        was loaded at startup, in the background or on first use, and `ready_seconds`, the time until all eager
+        components were loaded.
+        """
+        components = []
+        for entry in self._entries.values():
+            item = {"name": entry.name, "lazy": entry.lazy, "trigger": entry.trigger, "thread": entry.thread}
+            if entry.start is not None:
+                item["start"] = round(entry.start - self._t0, 3)
+            if entry.end is not None:
+                item["end"] = round(entry.end - self._t0, 3)
+                item["seconds"] = round(entry.end - entry.start, 3)
+            components.append(item)
+        components.sort(key=lambda item: item.get("start", float("inf")))
+        return {"ready_seconds": self.ready_seconds, "components": components}
+
+    def save_timeline(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.timeline(), f, indent=2)
@@ -0,0 +1,171 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+import PIL.Image
+import torch
+
+from src.roi import RoiCrop
+
+
+def image_digest(image: PIL.Image.Image) -> str:
+    r"""
+    Content hash of a PIL image: its mode, size and pixel data.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def person_key(human_img: PIL.Image.Image, **settings) -> str:
+    r"""
+    Session key of a (cropped and resized) person image and the settings its mask was derived with. Image values in
+    `settings`, e.g. a hand-drawn mask, are hashed by content.
+    """
+    digest = hashlib.sha256(image_digest(human_img).encode())
+    for name in sorted(settings):
+        value = settings[name]
+        if isinstance(value, PIL.Image.Image):
+            value = image_digest(value)
+        digest.update(f"|{name}={value}".encode())
+    return digest.hexdigest()
+
+
+def _nbytes(value: Any) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, PIL.Image.Image):
+        return value.width * value.height * len(value.getbands())
+    return 0
+
+
+@dataclass(eq=False)
+class PersonSession:
+    r"""
+    Person-side preprocessing of one shopper photo, reusable for every garment tried on it.
+
+    Args:
+        human_img (`PIL.Image.Image`): Person image at the output resolution.
+        mask (`PIL.Image.Image`): Agnostic inpainting mask at the output resolution.
+        mask_gray (`PIL.Image.Image`): Person image with the masked area grayed out, as shown in the demo.
+        pose_img (`PIL.Image.Image`): DensePose image at the output resolution.
+        keypoints (`Dict`, *optional*): OpenPose keypoints, when the mask was generated automatically.
+        model_parse (`PIL.Image.Image`, *optional*): Human parsing map, when the mask was generated automatically.
+        latents (`Dict[str, torch.Tensor]`):
+            VAE latents of the masked person (`"masked_image"`) and of the pose image (`"pose_img"`), batch size 1,
+            see [`~tryon_server.encode_person_latents`]. With `roi`, the latents of the region.
+        roi (`RoiCrop`, *optional*): Region of the frame denoised in region of interest mode.
+    """
+
+    human_img: PIL.Image.Image
+    mask: PIL.Image.Image
+    mask_gray: PIL.Image.Image
+    pose_img: PIL.Image.Image
+    keypoints: Optional[Dict] = None
+    model_parse: Optional[PIL.Image.Image] = None
+    latents: Dict[str, torch.Tensor] = field(default_factory=dict)
+    roi: Optional[RoiCrop] = None
+
+    def nbytes(self) -> int:
+        images = (self.human_img, self.mask, self.mask_gray, self.pose_img, self.model_parse)
+        return sum(_nbytes(image) for image in images) + sum(_nbytes(t) for t in self.latents.values())
+
+
+class PersonSessionCache:
+    r"""
+    Bounded LRU cache of [`PersonSession`]s with a time-to-live, safe to use from concurrent request threads.
+
+    Entries are dropped when they have not been used for `ttl_seconds`, and the least recently used ones when the
+    cache holds more than `max_entries` sessions or more than `max_bytes` of images and latents. Latents count at
+    their size on the device they live on; a 768x1024 session holds ~200KB of float16 latents and ~6MB of images.
+
+    Args:
+        max_entries (`int`, defaults to 64): Number of sessions kept.
+        max_bytes (`int`, defaults to `1 << 30`): Total size of the sessions kept.
+        ttl_seconds (`float`, defaults to 1800.0): Idle time after which a session expires.
+    """
+
+    def __init__(self, max_entries: int = 64, max_bytes: int = 1 << 30, ttl_seconds: float = 1800.0):
+        if max_entries < 1:
+            raise ValueError(f"`max_entries` has to be a positive integer but is {max_entries}.")
+        if ttl_seconds <= 0:
+            raise ValueError(f"`ttl_seconds` has to be positive but is {ttl_seconds}.")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, PersonSession]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._last_used: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def _remove(self, key: str):
+        del self._entries[key]
+        del self._last_used[key]
+        self.nbytes -= self._sizes.pop(key)
+
+    def _evict(self, now: float):
+        # entries are in order of last use, so expired ones are at the front
+        while self._entries:
+            key = next(iter(self._entries))
+            expired = now - self._last_used[key] > self.ttl_seconds
+            if not expired and len(self._entries) <= self.max_entries and self.nbytes <= self.max_bytes:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[PersonSession]:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            session = self._entries.get(key)
+            if session is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            self._last_used[key] = now
+            return session
+
+    def put(self, key: str, session: PersonSession) -> PersonSession:
+        size = session.nbytes()
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = session
+            self._sizes[key] = size
+            self._last_used[key] = now
+            self.nbytes += size
+            self._evict(now)
+        return session
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._last_used.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,134 @@
+import json
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+import torch
+
+
+NEGATIVE_PROMPT = "monochrome, lowres, bad anatomy, worst quality, low quality"
+PERSON_PROMPT_TEMPLATE = "model is wearing "
+GARMENT_PROMPT_TEMPLATE = "a photo of "
+
+PromptEmbeddings = Tuple[torch.Tensor, Optional[torch.Tensor], torch.Tensor, Optional[torch.Tensor]]
+
+
+class PromptEmbeddingCache:
+    r"""
+    Bounded LRU cache of `encode_prompt` outputs for single prompts.
+
+    Entries are keyed on `(prompt, prompt_2, negative_prompt, negative_prompt_2, do_classifier_free_guidance,
+    clip_skip, encoder identity)` and hold the four embeddings of one prompt before the `num_images_per_prompt`
+    repeat. One entry takes ~1MB in float16 with guidance.
+
+    Args:
+        max_entries (`int`, defaults to 512):
+            Number of prompts kept. The least recently used entry is dropped first.
+    """
+
+    def __init__(self, max_entries: int = 512):
+        if max_entries < 1:
+            raise ValueError(f"`max_entries` has to be a positive integer but is {max_entries}.")
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, PromptEmbeddings]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def encoder_key(pipe) -> Tuple:
+        r"""
+        Identity of the text encoders of `pipe`; swapping or re-casting an encoder invalidates its entries.
+        """
+        return tuple(
+            None if encoder is None else (id(encoder), str(encoder.dtype))
+            for encoder in (pipe.text_encoder, pipe.text_encoder_2)
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, key: Hashable) -> Optional[PromptEmbeddings]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Hashable, entry: PromptEmbeddings, device: Optional[torch.device] = None) -> PromptEmbeddings:
+        entry = tuple(None if e is None else e.to(device) for e in entry)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def vitonhd_garment_descriptions(path: str) -> Dict[str, str]:
+    r"""
+    Garment descriptions of a `vitonhd_*_tagged.json` file keyed by file name, built the same way as in
+    `VitonHDTestDataset`.
+    """
+    annotation_list = [
+        "sleeveLength",
+        "neckLine",
+        "item",
+    ]
+    with open(path, "r") as f:
+        data = json.load(f)
+    descriptions = {}
+    for k, v in data.items():
+        for elem in v:
+            annotation_str = ""
+            for template in annotation_list:
+                for tag in elem["tag_info"]:
+                    if tag["tag_name"] == template and tag["tag_category"] is not None:
+                        annotation_str += tag["tag_category"]
+                        annotation_str += " "
+            descriptions[elem["file_name"]] = annotation_str
+    return descriptions
+
+
+@torch.no_grad()
+def prewarm_prompt_cache(
+    pipe,
+    descriptions: Iterable[str],
+    person_template: str = PERSON_PROMPT_TEMPLATE,
+    garment_template: str = GARMENT_PROMPT_TEMPLATE,
+    negative_prompt: str = NEGATIVE_PROMPT,
+    batch_size: int = 32,
+) -> int:
+    r"""
+    Fills `pipe.prompt_cache` with the two prompts the try-on scripts encode per garment: `person_template +
+    description` with `negative_prompt` and guidance, and `garment_template + description` without guidance.
+    Returns the number of distinct descriptions.
+    """
+    if pipe.prompt_cache is None:
+        raise ValueError("Call `pipe.enable_prompt_cache()` before pre-warming it.")
+
+    descriptions: List[str] = sorted(set(descriptions))
+    for start in range(0, len(descriptions), batch_size):
+        batch = descriptions[start : start + batch_size]
+        pipe.encode_prompt(
+            [person_template + d for d in batch],
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=True,
+            negative_prompt=[negative_prompt] * len(batch),
+        )
+        pipe.encode_prompt(
+            [garment_template + d for d in batch],
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=False,
+            negative_prompt=[negative_prompt] * len(batch),
+        )
+    return len(descriptions)
+
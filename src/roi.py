@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+
+import PIL.Image
+import PIL.ImageFilter
+
+
+# (width, height) the region of interest is denoised at, multiples of 64 up to the full 768x1024 frame. Few sizes
+# keep the number of distinct UNet shapes small.
+ROI_BUCKETS = tuple(
+    sorted(((w, h) for w in (384, 512, 640, 768) for h in (512, 640, 768, 896, 1024)), key=lambda s: (s[0] * s[1], s))
+)
+
+
+def mask_bbox(mask: PIL.Image.Image, threshold: int = 127) -> Optional[Tuple[int, int, int, int]]:
+    r"""
+    Bounding box `(left, top, right, bottom)` of the pixels of `mask` above `threshold`, `None` for an empty mask.
+    """
+    return mask.convert("L").point(lambda v: 255 if v > threshold else 0).getbbox()
+
+
+@dataclass(frozen=True)
+class RoiCrop:
+    r"""
+    A window of the try-on frame that is denoised instead of the full frame.
+
+    Args:
+        box (`Tuple[int, int, int, int]`): `(left, top, right, bottom)` of the window in frame pixels.
+    """
+
+    box: Tuple[int, int, int, int]
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.box[2] - self.box[0], self.box[3] - self.box[1]
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def crop(self, image: PIL.Image.Image) -> PIL.Image.Image:
+        return image.crop(self.box)
+
+    def paste(
+        self, frame: PIL.Image.Image, output: PIL.Image.Image, mask: PIL.Image.Image, feather: int = 16
+    ) -> PIL.Image.Image:
+        r"""
+        Composites the try-on `output` of the window back into a copy of `frame`. The output is blended in over the
+        inpainting `mask` grown and softened by about `feather` pixels, so the unmasked person keeps its original
+        pixels and the window has no visible edge.
+        """
+        alpha = self.crop(mask).convert("L")
+        if feather > 0:
+            # blurring and doubling a binary mask keeps it opaque inside and grows a soft edge of ~feather pixels
+            alpha = alpha.filter(PIL.ImageFilter.GaussianBlur(feather / 2)).point(lambda v: min(255, 2 * v))
+        if output.size != self.size:
+            output = output.resize(self.size)
+        composite = frame.copy()
+        composite.paste(output, self.box[:2], alpha)
+        return composite
+
+
+def select_roi(
+    mask: PIL.Image.Image,
+    pad: int = 48,
+    buckets: Sequence[Tuple[int, int]] = ROI_BUCKETS,
+) -> Optional[RoiCrop]:
+    r"""
+    The smallest bucket window of the frame that holds the mask bounding box padded by `pad` pixels.
+
+    The window is cut at the frame's own resolution and is not resized, so the garment region is denoised at the
+    same pixel density as in the full-frame mode; only the surroundings are dropped. The window is centered on the
+    mask and shifted inside the frame at the borders. Returns `None` (use the full frame) for an empty mask or when
+    no bucket smaller than the frame fits.
+
+    Args:
+        mask (`PIL.Image.Image`): Inpainting mask at the frame resolution.
+        pad (`int`, defaults to 48): Context kept around the mask, in frame pixels.
+        buckets (`Sequence[Tuple[int, int]]`, defaults to `ROI_BUCKETS`): Candidate `(width, height)` sizes.
+    """
+    bbox = mask_bbox(mask)
+    if bbox is None:
+        return None
+    frame_width, frame_height = mask.size
+    left, top = max(bbox[0] - pad, 0), max(bbox[1] - pad, 0)
+    right, bottom = min(bbox[2] + pad, frame_width), min(bbox[3] + pad, frame_height)
+    for width, height in sorted(buckets, key=lambda s: s[0] * s[1]):
+        if width < right - left or height < bottom - top or width > frame_width or height > frame_height:
+            continue
+        if (width, height) == (frame_width, frame_height):
+            return None
+        x = min(max((left + right - width) // 2, 0), frame_width - width)
+        y = min(max((top + bottom - height) // 2, 0), frame_height - height)
+        return RoiCrop(box=(x, y, x + width, y + height))
+    return None
@@ -0,0 +1,55 @@
+from typing import Dict, Optional
+
+from diffusers import (
+    DDIMScheduler,
+    DDPMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    UniPCMultistepScheduler,
+)
+
+
+# scheduler class and the config overrides applied on top of the model's scheduler config
+_SAMPLERS = {
+    "ddpm": (DDPMScheduler, {}),
+    "ddim": (DDIMScheduler, {}),
+    "euler": (EulerDiscreteScheduler, {}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "dpmpp_2m": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "solver_order": 2}),
+    "dpmpp_2m_karras": (
+        DPMSolverMultistepScheduler,
+        {"algorithm_type": "dpmsolver++", "solver_order": 2, "use_karras_sigmas": True},
+    ),
+    "unipc": (UniPCMultistepScheduler, {}),
+}
+SAMPLERS = tuple(_SAMPLERS)
+
+
+def make_scheduler(name: str, config: Dict):
+    r"""
+    Builds the `name` sampler from a scheduler config, usually the `DDPMScheduler` config the try-on model ships
+    with, so the noise schedule (betas, timestep spacing, prediction type) stays the one the model was trained with.
+    """
+    if name not in _SAMPLERS:
+        raise ValueError(f"`name` has to be one of {SAMPLERS} but is {name}.")
+    scheduler_class, overrides = _SAMPLERS[name]
+    return scheduler_class.from_config(config, **overrides)
+
+
+def load_scheduler(name: str, pretrained_model_name_or_path: str, subfolder: Optional[str] = "scheduler"):
+    config = DDPMScheduler.load_config(pretrained_model_name_or_path, subfolder=subfolder)
+    return make_scheduler(name, config)
+
+
+def cfg_truncation_step(num_steps: int, cfg_truncation: Optional[float]) -> Optional[int]:
+    r"""
+    Index of the first step that runs without the unconditional branch, `None` when guidance is never truncated.
+    `cfg_truncation` is the fraction of the steps that keep classifier free guidance.
+    """
+    if cfg_truncation is None:
+        return None
+    if not 0.0 <= cfg_truncation <= 1.0:
+        raise ValueError(f"`cfg_truncation` has to be in [0.0, 1.0] but is {cfg_truncation}.")
+    step = int(round(cfg_truncation * num_steps))
+    return step if step < num_steps else None
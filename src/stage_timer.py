@@ -0,0 +1,197 @@
+import json
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import torch
+
+
+@dataclass(eq=False)
+class _Stage:
+    name: str
+    step: Optional[int]
+    depth: int
+    cpu_start: float
+    cpu_ms: float = 0.0
+    gpu_ms: Optional[float] = None
+    start_event: Optional[torch.cuda.Event] = None
+    end_event: Optional[torch.cuda.Event] = None
+    peak_bytes: int = 0
+    batch_size: Optional[int] = None
+
+
+class StageTimer:
+    r"""
+    Named stage timers for one try-on request or batch.
+
+    `with timer.stage("unet", step=i):` records the host wall time of the block and, on CUDA, a pair of CUDA events
+    around it plus the peak allocated memory inside it. The events are only read in [`~StageTimer.report`], with a
+    single synchronize, so timing adds no host-device synchronization to the measured code; together with a few
+    allocator counter reads per stage this is cheap enough to leave enabled. Stages can be nested; a parent's peak
+    memory includes its children.
+
+    The GPU time of a stage is the time the stream took from the start to the end event, i.e. the kernels launched in
+    the stage plus any queued work it waited for. It is what `report()` calls `ms`; `cpu_ms` is the host wall time.
+
+    Args:
+        enabled (`bool`, defaults to `True`): A disabled timer records nothing, `stage` is a no-op.
+        cuda_events (`bool`, *optional*): Time with CUDA events. Defaults to whether CUDA is available.
+        track_memory (`bool`, defaults to `True`):
+            Record the peak allocated CUDA memory per stage. This resets the allocator's peak statistics, which are
+            process-wide, so the values are only valid while no other timer tracks memory concurrently; turn it off
+            for timers of concurrent requests.
+        record_functions (`bool`, defaults to `False`):
+            Label every stage with `torch.profiler.record_function`, so it shows up in a profiler trace. Set during
+            [`~StageTimer.trace`]; set it on timers used in other threads while one is tracing.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        cuda_events: Optional[bool] = None,
+        track_memory: bool = True,
+        record_functions: bool = False,
+    ):
+        self.enabled = enabled
+        self.cuda_events = torch.cuda.is_available() if cuda_events is None else cuda_events
+        self.track_memory = track_memory and self.cuda_events
+        self.record_functions = record_functions
+        self.stages: List[_Stage] = []
+        self._open: List[_Stage] = []
+
+    @contextmanager
+    def stage(self, name: str, step: Optional[int] = None):
+        if not self.enabled:
+            yield
+            return
+        record = _Stage(name=name, step=step, depth=len(self._open), cpu_start=time.perf_counter())
+        self.stages.append(record)
+        if self.track_memory:
+            # the running peak belongs to the enclosing stages, fold it in before resetting it for this one
+            peak = torch.cuda.max_memory_allocated()
+            for parent in self._open:
+                parent.peak_bytes = max(parent.peak_bytes, peak)
+            torch.cuda.reset_peak_memory_stats()
+        if self.cuda_events:
+            record.start_event = torch.cuda.Event(enable_timing=True)
+            record.end_event = torch.cuda.Event(enable_timing=True)
+            record.start_event.record()
+        self._open.append(record)
+        label = None
+        if self.record_functions:
+            label = torch.profiler.record_function(name if step is None else f"{name}[{step}]")
+            label.__enter__()
+        try:
+            yield
+        finally:
+            if label is not None:
+                label.__exit__(None, None, None)
+            self._open.pop()
+            if self.cuda_events:
+                record.end_event.record()
+            if self.track_memory:
+                record.peak_bytes = max(record.peak_bytes, torch.cuda.max_memory_allocated())
+                for parent in self._open:
+                    parent.peak_bytes = max(parent.peak_bytes, record.peak_bytes)
+            record.cpu_ms = (time.perf_counter() - record.cpu_start) * 1000
+
+    def add(self, name: str, ms: float, step: Optional[int] = None):
+        r"""
+        Records a stage measured elsewhere, e.g. the queue wait of a request, as `ms` of host time.
+        """
+        if self.enabled:
+            self.stages.append(_Stage(name=name, step=step, depth=len(self._open), cpu_start=0.0, cpu_ms=ms))
+
+    def merge(self, other: "StageTimer", batch_size: Optional[int] = None):
+        r"""
+        Appends the (resolved) stages of `other`, nested under the currently open stage. Used to give every request of
+        a batch the stages of the batch it ran in; `batch_size` is recorded with them.
+        """
+        if not self.enabled:
+            return
+        other.resolve()
+        for record in other.stages:
+            self.stages.append(
+                _Stage(
+                    name=record.name,
+                    step=record.step,
+                    depth=record.depth + len(self._open),
+                    cpu_start=record.cpu_start,
+                    cpu_ms=record.cpu_ms,
+                    gpu_ms=record.gpu_ms,
+                    peak_bytes=record.peak_bytes,
+                    batch_size=batch_size if batch_size is not None else record.batch_size,
+                )
+            )
+
+    def resolve(self):
+        r"""
+        Reads the elapsed time of all finished stages from their CUDA events, after one device synchronize.
+        """
+        pending = [r for r in self.stages if r.end_event is not None and r not in self._open]
+        if not pending:
+            return
+        torch.cuda.synchronize()
+        for record in pending:
+            record.gpu_ms = record.start_event.elapsed_time(record.end_event)
+            record.start_event = record.end_event = None
+
+    @contextmanager
+    def trace(self, path: str, record_shapes: bool = False):
+        r"""
+        Runs the block under `torch.profiler` and writes a Chrome trace (viewable in `chrome://tracing` or Perfetto)
+        to `path`. The stages entered inside show up as labeled ranges. Tracing is not cheap; use it for single
+        requests, not in production.
+        """
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        record_functions = self.record_functions
+        with torch.profiler.profile(activities=activities, record_shapes=record_shapes) as profiler:
+            self.record_functions = True
+            try:
+                yield profiler
+            finally:
+                self.record_functions = record_functions
+        profiler.export_chrome_trace(path)
+
+    def report(self) -> Dict:
+        r"""
+        Structured timings: `stages` aggregates the records per name in order of first use (`count`, `ms` and
+        `cpu_ms` summed, `peak_mb` the maximum), `steps` lists the per-step `ms` of the stages recorded with a step,
+        and `total_ms` sums the top-level stages.
+        """
+        self.resolve()
+        stages: Dict[str, Dict] = {}
+        steps: Dict[str, List[float]] = {}
+        total_ms = 0.0
+        for record in self.stages:
+            ms = record.gpu_ms if record.gpu_ms is not None else record.cpu_ms
+            if record.depth == 0:
+                total_ms += ms
+            entry = stages.setdefault(
+                record.name, {"count": 0, "ms": 0.0, "cpu_ms": 0.0, "peak_mb": None, "depth": record.depth}
+            )
+            entry["count"] += 1
+            entry["ms"] += ms
+            entry["cpu_ms"] += record.cpu_ms
+            if record.peak_bytes:
+                entry["peak_mb"] = max(entry["peak_mb"] or 0.0, record.peak_bytes / 2**20)
+            if record.batch_size is not None:
+                entry["batch_size"] = record.batch_size
+            if record.step is not None:
+                steps.setdefault(record.name, []).append(ms)
+        for entry in stages.values():
+            entry["ms"] = round(entry["ms"], 3)
+            entry["cpu_ms"] = round(entry["cpu_ms"], 3)
+            if entry["peak_mb"] is not None:
+                entry["peak_mb"] = round(entry["peak_mb"], 1)
+        return {
+            "total_ms": round(total_ms, 3),
+            "stages": stages,
+            "steps": {name: [round(ms, 3) for ms in values] for name, values in steps.items()},
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.report(), **kwargs)
@@ -0,0 +1,217 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+
+@dataclass
+class Stage:
+    r"""
+    One step of a [`StagedPipeline`].
+
+    Args:
+        name (`str`): Stage name used in the metrics.
+        fn (`Callable`): Takes the payload of a request and returns the payload passed to the next stage.
+        workers (`int`, defaults to 1): Threads running `fn` concurrently.
+        queue_size (`int`, defaults to 2): Capacity of the input queue of the stage. A full queue blocks the
+            previous stage (or `submit` for the first stage), which bounds the requests in flight.
+    """
+
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    queue_size: int = 2
+
+
+@dataclass(eq=False)
+class _Job:
+    payload: Any
+    future: Future = field(default_factory=Future)
+    submitted_at: float = field(default_factory=time.perf_counter)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+_STOP = object()
+
+
+class _StageMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.queue_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.max_queue_depth = 0
+
+
+class StagedPipeline:
+    r"""
+    Runs requests through a chain of stages connected by bounded queues, each stage on its own worker threads, so
+    the stages of consecutive requests overlap: while the GPU denoises one request, the CPU-side preprocessing of the
+    next ones runs.
+
+    Threads rather than processes run the stages, because the preprocessing models (OpenPose, parsing, DensePose)
+    and the try-on pipeline live in this process and release the GIL in their native kernels.
+
+    Every stage records the requests it handled, its busy time, the time requests waited in its input queue and the
+    time it was blocked on a full downstream queue (backpressure). In steady state the stage with the highest
+    `utilization` sets the throughput; with enough workers in front of it that is the denoising stage.
+
+    A stage that raises fails the request's future; the request is not passed on.
+
+    Args:
+        stages (`Sequence[Stage]`): The stages in order.
+    """
+
+    def __init__(self, stages: Sequence[Stage]):
+        if not stages:
+            raise ValueError("`stages` has to contain at least one stage.")
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Stage names have to be unique but are {names}.")
+        for stage in stages:
+            if stage.workers < 1 or stage.queue_size < 1:
+                raise ValueError(f"Stage {stage.name!r} needs at least one worker and a queue size of at least one.")
+        self.stages = list(stages)
+        self._queues: List[queue.Queue] = []
+        self._threads: List[List[threading.Thread]] = []
+        self._lock = threading.Lock()
+        self._running = False
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self._metrics = {stage.name: _StageMetrics() for stage in self.stages}
+        # end-to-end latencies of the most recent requests, for the percentiles
+        self._latencies: deque = deque(maxlen=1024)
+        self._completed = 0
+        self._started = time.perf_counter()
+
+    def start(self) -> "StagedPipeline":
+        with self._lock:
+            if self._running:
+                return self
+            self._queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+            self._threads = []
+            for index, stage in enumerate(self.stages):
+                threads = [
+                    threading.Thread(target=self._work, args=(index,), name=f"stage-{stage.name}-{i}", daemon=True)
+                    for i in range(stage.workers)
+                ]
+                for thread in threads:
+                    thread.start()
+                self._threads.append(threads)
+            self._running = True
+        return self
+
+    def stop(self):
+        r"""
+        Finishes the requests already submitted and stops the workers, stage by stage.
+        """
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        # the last stage takes `_lock` to complete a request, so the workers are joined without holding it
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                self._queues[index].put(_STOP)
+            for thread in self._threads[index]:
+                thread.join()
+
+    def submit(self, payload: Any) -> Future:
+        r"""
+        Queues a request; blocks while the first stage's queue is full.
+        """
+        if not self._running:
+            raise RuntimeError("The staged pipeline is not running, call `start()` first.")
+        job = _Job(payload)
+        self._put(0, job)
+        return job.future
+
+    def __call__(self, payload: Any) -> Any:
+        return self.submit(payload).result()
+
+    def _put(self, index: int, job: _Job):
+        q = self._queues[index]
+        job.enqueued_at = time.perf_counter()
+        q.put(job)
+        metrics = self._metrics[self.stages[index].name]
+        with metrics.lock:
+            metrics.max_queue_depth = max(metrics.max_queue_depth, q.qsize())
+
+    def _work(self, index: int):
+        stage = self.stages[index]
+        q = self._queues[index]
+        while True:
+            job = q.get()
+            if job is _STOP:
+                return
+            metrics = self._metrics[stage.name]
+            start = time.perf_counter()
+            queued = start - job.enqueued_at
+            try:
+                job.payload = stage.fn(job.payload)
+            except Exception as e:
+                with metrics.lock:
+                    metrics.errors += 1
+                job.future.set_exception(e)
+                continue
+            busy = time.perf_counter() - start
+
+            blocked = 0.0
+            if index + 1 < len(self.stages):
+                put_start = time.perf_counter()
+                self._put(index + 1, job)
+                blocked = time.perf_counter() - put_start
+            else:
+                with self._lock:
+                    self._latencies.append(time.perf_counter() - job.submitted_at)
+                    self._completed += 1
+                job.future.set_result(job.payload)
+            with metrics.lock:
+                metrics.items += 1
+                metrics.busy_seconds += busy
+                metrics.queue_seconds += queued
+                metrics.blocked_seconds += blocked
+
+    def metrics(self) -> Dict[str, Any]:
+        r"""
+        Per-stage counters since the last `reset_metrics`: `items`, `errors`, mean `busy_ms`, `queue_ms` and
+        `blocked_ms` per request, current and maximum `queue_depth`, and `utilization` (busy time over wall time and
+        workers). `bottleneck` names the stage with the highest utilization; the end-to-end latency percentiles are
+        over the last 1024 requests.
+        """
+        wall = time.perf_counter() - self._started
+        stages = {}
+        for index, stage in enumerate(self.stages):
+            m = self._metrics[stage.name]
+            with m.lock:
+                items = max(m.items, 1)
+                stages[stage.name] = {
+                    "items": m.items,
+                    "errors": m.errors,
+                    "busy_ms": round(m.busy_seconds * 1000 / items, 3),
+                    "queue_ms": round(m.queue_seconds * 1000 / items, 3),
+                    "blocked_ms": round(m.blocked_seconds * 1000 / items, 3),
+                    "queue_depth": self._queues[index].qsize() if self._queues else 0,
+                    "max_queue_depth": m.max_queue_depth,
+                    "utilization": round(m.busy_seconds / (wall * stage.workers), 4) if wall > 0 else 0.0,
+                }
+        with self._lock:
+            completed = self._completed
+            latencies = sorted(self._latencies)
+        bottleneck: Optional[str] = max(stages, key=lambda name: stages[name]["utilization"]) if completed else None
+        summary = {
+            "completed": completed,
+            "throughput": completed / wall if wall > 0 else 0.0,
+            "bottleneck": bottleneck,
+        }
+        if latencies:
+            summary["p50_latency"] = latencies[int(0.5 * (len(latencies) - 1))]
+            summary["p99_latency"] = latencies[int(0.99 * (len(latencies) - 1))]
+        summary["stages"] = stages
+        return summary
@@ -0,0 +1,248 @@
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+
+
+TRAIN_AUGMENT_MODES = ("off", "pixel", "latent")
+# normalization of the CLIP image processor, the garment CLIP input is jittered in [0, 1]
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+@dataclass
+class AugmentParams:
+    r"""
+    Per-sample augmentation parameters of one batch.
+
+    Args:
+        flip (`torch.BoolTensor`): Horizontal flip, `(batch,)`.
+        scale (`torch.FloatTensor`): Zoom factor about the image center, `(batch,)`.
+        shift (`torch.FloatTensor`): Translation as a fraction of width and height, `(batch, 2)`.
+        color (`List[Optional[Tuple[float, float, float, float]]]`):
+            Brightness, contrast, saturation and hue factors of the color jitter, `None` for samples without it.
+    """
+
+    flip: torch.Tensor
+    scale: torch.Tensor
+    shift: torch.Tensor
+    color: list
+
+    def theta(self) -> torch.Tensor:
+        r"""
+        The `(batch, 2, 3)` matrix for `F.affine_grid` that flips, scales and shifts in one resampling. It works in
+        normalized coordinates, so the same matrix applies at pixel and at latent resolution.
+        """
+        sign = 1.0 - 2.0 * self.flip.float()
+        inv_scale = 1.0 / self.scale
+        theta = torch.zeros(self.scale.shape[0], 2, 3, device=self.scale.device)
+        # output pixel x is read from input (x - t) / s, mirrored when flipped; t is 2 * shift in [-1, 1] coordinates
+        theta[:, 0, 0] = sign * inv_scale
+        theta[:, 0, 2] = -sign * 2 * self.shift[:, 0] * inv_scale
+        theta[:, 1, 1] = inv_scale
+        theta[:, 1, 2] = -2 * self.shift[:, 1] * inv_scale
+        return theta
+
+
+class BatchAugmenter:
+    r"""
+    The flip, color jitter, scale and shift augmentation of `VitonHDDataset`, applied batch-wise on the device instead
+    of per sample with PIL in the dataloader workers.
+
+    Flip, scale and shift of the person image, inpainting mask and pose map are folded into one affine grid per
+    sample and applied with a single `grid_sample` over the concatenated channels, so the three stay aligned. The
+    grid is in normalized coordinates and can be applied to the VAE latents instead (`"latent"` mode), after the
+    encoder. The garment is only flipped and color jittered, together with the person image.
+
+    Args:
+        flip_prob (`float`, defaults to 0.5): Probability of the horizontal flip of person, mask, pose and garment.
+        color_prob (`float`, defaults to 0.5): Probability of the color jitter of person and garment.
+        scale_prob (`float`, defaults to 0.5): Probability of the zoom of person, mask and pose.
+        scale_range (`Tuple[float, float]`, defaults to `(0.8, 1.2)`): Range of the zoom factor.
+        shift_prob (`float`, defaults to 0.5): Probability of the translation of person, mask and pose.
+        shift_range (`float`, defaults to 0.2): Maximum translation as a fraction of width and height.
+        brightness, contrast, saturation, hue (`float`): Color jitter strengths, as in `transforms.ColorJitter`.
+    """
+
+    def __init__(
+        self,
+        flip_prob: float = 0.5,
+        color_prob: float = 0.5,
+        scale_prob: float = 0.5,
+        scale_range: Tuple[float, float] = (0.8, 1.2),
+        shift_prob: float = 0.5,
+        shift_range: float = 0.2,
+        brightness: float = 0.5,
+        contrast: float = 0.3,
+        saturation: float = 0.5,
+        hue: float = 0.5,
+    ):
+        self.flip_prob = flip_prob
+        self.color_prob = color_prob
+        self.scale_prob = scale_prob
+        self.scale_range = scale_range
+        self.shift_prob = shift_prob
+        self.shift_range = shift_range
+        self.brightness = (max(0.0, 1 - brightness), 1 + brightness)
+        self.contrast = (max(0.0, 1 - contrast), 1 + contrast)
+        self.saturation = (max(0.0, 1 - saturation), 1 + saturation)
+        self.hue = (-hue, hue)
+        # per-channel latents of the fill colors, see `set_latent_fill`
+        self.latent_fill: Dict[str, torch.Tensor] = {}
+
+    def sample(self, batch_size: int, device: torch.device) -> AugmentParams:
+        def coin(p):
+            return torch.rand(batch_size, device=device) < p
+
+        def uniform(low, high, *shape):
+            return torch.empty(batch_size, *shape, device=device).uniform_(low, high)
+
+        scale = torch.where(coin(self.scale_prob), uniform(*self.scale_range), torch.ones(batch_size, device=device))
+        shift = torch.where(
+            coin(self.shift_prob)[:, None],
+            uniform(-self.shift_range, self.shift_range, 2),
+            torch.zeros(batch_size, 2, device=device),
+        )
+        color = []
+        for jitter in coin(self.color_prob).tolist():
+            if not jitter:
+                color.append(None)
+                continue
+            factors = [torch.empty(1).uniform_(*r).item() for r in (self.brightness, self.contrast, self.saturation, self.hue)]
+            color.append(tuple(factors))
+        return AugmentParams(flip=coin(self.flip_prob), scale=scale, shift=shift, color=color)
+
+    @staticmethod
+    def _jitter(images: torch.Tensor, color) -> torch.Tensor:
+        # `images` in [0, 1]; same order of adjustments as the dataset
+        out = []
+        for image, factors in zip(images, color):
+            if factors is not None:
+                b, c, s, h = factors
+                image = TF.adjust_contrast(image, c)
+                image = TF.adjust_brightness(image, b)
+                image = TF.adjust_hue(image, h)
+                image = TF.adjust_saturation(image, s)
+            out.append(image)
+        return torch.stack(out)
+
+    def color_jitter(self, images: torch.Tensor, params: AugmentParams) -> torch.Tensor:
+        r"""
+        Color jitter of images in [-1, 1].
+        """
+        if all(factors is None for factors in params.color):
+            return images
+        dtype = images.dtype
+        images = self._jitter((images.float() + 1.0) / 2.0, params.color)
+        return (images * 2.0 - 1.0).to(dtype)
+
+    def color_jitter_clip(self, pixel_values: torch.Tensor, params: AugmentParams) -> torch.Tensor:
+        r"""
+        Color jitter of CLIP-normalized images.
+        """
+        if all(factors is None for factors in params.color):
+            return pixel_values
+        mean = torch.tensor(CLIP_MEAN, device=pixel_values.device)[:, None, None]
+        std = torch.tensor(CLIP_STD, device=pixel_values.device)[:, None, None]
+        dtype = pixel_values.dtype
+        images = self._jitter((pixel_values.float() * std + mean).clamp(0, 1), params.color)
+        return ((images - mean) / std).to(dtype)
+
+    @staticmethod
+    def flip(images: torch.Tensor, params: AugmentParams) -> torch.Tensor:
+        flip = params.flip.view(-1, *([1] * (images.dim() - 1)))
+        return torch.where(flip, torch.flip(images, dims=[-1]), images)
+
+    def warp(
+        self,
+        tensors: Dict[str, torch.Tensor],
+        params: AugmentParams,
+        fill: Optional[Dict[str, torch.Tensor]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        r"""
+        Flips, scales and shifts all `tensors` (same batch size and spatial size) with one shared grid. Areas moved in
+        from outside the image take the value in `fill` (a scalar or per-channel tensor), 0 by default.
+        """
+        fill = fill or {}
+        names = list(tensors)
+        stacked = torch.cat(
+            [(tensors[name].float() - torch.as_tensor(fill.get(name, 0.0), device=tensors[name].device).float()) for name in names],
+            dim=1,
+        )
+        grid = F.affine_grid(params.theta(), list(stacked.shape), align_corners=False)
+        warped = F.grid_sample(stacked, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+        out = {}
+        start = 0
+        for name in names:
+            end = start + tensors[name].shape[1]
+            value = warped[:, start:end] + torch.as_tensor(fill.get(name, 0.0), device=warped.device).float()
+            out[name] = value.to(tensors[name].dtype)
+            start = end
+        return out
+
+    @torch.no_grad()
+    def set_latent_fill(self, vae):
+        r"""
+        Encodes the fill colors of the pixel-space augmentation, gray for the person image and black for the pose map,
+        so areas shifted in from outside the latents match what pixel-space shifting would have produced.
+        """
+        param = next(vae.parameters())
+        constant = torch.zeros(2, 3, 64, 64, device=param.device, dtype=param.dtype)
+        constant[1] = -1.0
+        latents = vae.encode(constant).latent_dist.mean * vae.config.scaling_factor
+        fill = latents.float().mean(dim=(2, 3), keepdim=True)
+        self.latent_fill = {"image": fill[0:1], "masked": fill[0:1], "pose": fill[1:2], "mask": torch.zeros(1)}
+
+    def augment_garment(self, batch: Dict[str, torch.Tensor], params: AugmentParams) -> Dict[str, torch.Tensor]:
+        r"""
+        Color jitter and flip of the garment (`cloth_pure` and the CLIP input `cloth`) and color jitter of the person
+        image, with `im_mask` recomputed. Used on its own when the geometric transforms are applied to the latents.
+        """
+        batch = dict(batch)
+        batch["image"] = self.color_jitter(batch["image"], params)
+        batch["im_mask"] = batch["image"] * (1 - batch["inpaint_mask"])
+        batch["cloth_pure"] = self.flip(self.color_jitter(batch["cloth_pure"], params), params)
+        clip_shape = batch["cloth"].shape
+        cloth = batch["cloth"].reshape(clip_shape[0], *clip_shape[-3:])
+        batch["cloth"] = self.flip(self.color_jitter_clip(cloth, params), params).reshape(clip_shape)
+        return batch
+
+    def augment_pixels(self, batch: Dict[str, torch.Tensor], params: AugmentParams) -> Dict[str, torch.Tensor]:
+        r"""
+        Full augmentation of an unaugmented `VitonHDDataset` batch on its device. `im_mask` is recomputed from the
+        augmented image and mask.
+        """
+        batch = self.augment_garment(batch, params)
+        warped = self.warp(
+            {"image": batch["image"], "pose_img": batch["pose_img"], "inpaint_mask": batch["inpaint_mask"]},
+            params,
+            fill={"pose_img": -1.0},
+        )
+        inpaint_mask = (warped["inpaint_mask"] >= 0.5).to(warped["inpaint_mask"].dtype)
+        batch["image"] = warped["image"]
+        batch["pose_img"] = warped["pose_img"]
+        batch["inpaint_mask"] = inpaint_mask
+        batch["im_mask"] = warped["image"] * (1 - inpaint_mask)
+        return batch
+
+    def augment_latents(
+        self,
+        model_input: torch.Tensor,
+        masked_latents: torch.Tensor,
+        pose_map: torch.Tensor,
+        mask: torch.Tensor,
+        params: AugmentParams,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        r"""
+        Flip, scale and shift of the person, masked person and pose latents and the latent-size mask with the shared
+        grid. Call [`~BatchAugmenter.set_latent_fill`] first.
+        """
+        warped = self.warp(
+            {"image": model_input, "masked": masked_latents, "pose": pose_map, "mask": mask},
+            params,
+            fill=self.latent_fill,
+        )
+        mask = (warped["mask"] >= 0.5).to(mask.dtype)
+        return warped["image"], warped["masked"], warped["pose"], mask
@@ -0,0 +1,162 @@
+import json
+import os
+import random
+from typing import Dict, List
+
+import torch
+import torch.nn.functional as F
+import torch.utils.data as data
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+TRAIN_CACHE_VERSION = 1
+# VAE posterior moments (mean and logvar) stored per row, sampled again at every step like `latent_dist.sample()`
+MOMENT_FIELDS = ("image_moments", "masked_moments", "pose_moments", "cloth_moments")
+ROW_FIELDS = MOMENT_FIELDS + ("mask", "clip_hidden", "clip_hidden_flip", "annotation_idx")
+TEXT_FIELDS = ("caption_embeds", "caption_pooled", "cloth_embeds")
+
+
+class TrainCacheWriter:
+    r"""
+    Writes the precomputed training inputs as safetensors shards of `shard_size` rows plus an `index.json`.
+
+    A row holds everything the training step derives from one (possibly augmented) sample with frozen models: the
+    VAE posterior moments of the person, masked person, pose and garment images, the inpainting mask at latent
+    resolution, the CLIP hidden states of the garment and of the horizontally flipped garment, and the index of the
+    garment annotation. Text embeddings only depend on the annotation and are stored once per annotation.
+
+    Args:
+        cache_dir (`str`): Output directory.
+        shard_size (`int`, defaults to 256): Rows per shard file.
+    """
+
+    def __init__(self, cache_dir: str, shard_size: int = 256):
+        self.cache_dir = cache_dir
+        self.shard_size = shard_size
+        self.shards: List[Dict] = []
+        self._rows: Dict[str, List[torch.Tensor]] = {name: [] for name in ROW_FIELDS}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def add(self, **rows: torch.Tensor):
+        r"""
+        Appends a batch of rows, every field of `ROW_FIELDS` with the batch as first dimension.
+        """
+        for name in ROW_FIELDS:
+            self._rows[name].extend(rows[name].detach().to("cpu").contiguous().unbind(0))
+        while len(self._rows[ROW_FIELDS[0]]) >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def _flush(self, num_rows: int):
+        name = f"shard_{len(self.shards):05d}.safetensors"
+        tensors = {}
+        for field in ROW_FIELDS:
+            tensors[field] = torch.stack(self._rows[field][:num_rows])
+            self._rows[field] = self._rows[field][num_rows:]
+        tmp_path = os.path.join(self.cache_dir, name + ".tmp")
+        save_file(tensors, tmp_path)
+        os.replace(tmp_path, os.path.join(self.cache_dir, name))
+        self.shards.append({"file": name, "rows": num_rows})
+
+    def finish(self, text_embeds: Dict[str, torch.Tensor], annotations: List[str], **metadata):
+        if self._rows[ROW_FIELDS[0]]:
+            self._flush(len(self._rows[ROW_FIELDS[0]]))
+        save_file(
+            {name: text_embeds[name].detach().to("cpu").contiguous() for name in TEXT_FIELDS},
+            os.path.join(self.cache_dir, "text_embeds.safetensors"),
+        )
+        index = {
+            "version": TRAIN_CACHE_VERSION,
+            "shards": self.shards,
+            "annotations": annotations,
+            **metadata,
+        }
+        with open(os.path.join(self.cache_dir, "index.json"), "w") as f:
+            json.dump(index, f, indent=2)
+
+
+class CachedVitonHDDataset(data.Dataset):
+    r"""
+    Training samples read from a cache written by `precompute_train_cache.py` instead of decoding images and running
+    the frozen encoders. Shards are opened memory-mapped, lazily in every dataloader worker, and only the requested
+    row is read.
+
+    Each item is one of the `num_views` precomputed views of a pair, drawn at random. Horizontal flip is applied
+    online in latent space (to the latents and the mask, with the CLIP states of the flipped garment). Color jitter
+    and scale/shift cannot be applied to cached latents; they are only present through the augmented views baked in
+    at precompute time.
+
+    Args:
+        cache_dir (`str`): Directory written by `precompute_train_cache.py`.
+        flip_prob (`float`, defaults to 0.5): Probability of the latent-space horizontal flip.
+    """
+
+    def __init__(self, cache_dir: str, flip_prob: float = 0.5):
+        super().__init__()
+        with open(os.path.join(cache_dir, "index.json")) as f:
+            self.index = json.load(f)
+        if self.index["version"] != TRAIN_CACHE_VERSION:
+            raise ValueError(
+                f"Training cache {cache_dir} has version {self.index['version']}, expected {TRAIN_CACHE_VERSION}."
+            )
+        self.cache_dir = cache_dir
+        self.flip_prob = flip_prob
+        self.num_samples = self.index["num_samples"]
+        self.num_views = self.index["num_views"]
+        self._shard_of_row = []
+        for shard, entry in enumerate(self.index["shards"]):
+            self._shard_of_row.extend((shard, row) for row in range(entry["rows"]))
+        if len(self._shard_of_row) != self.num_samples * self.num_views:
+            raise ValueError(
+                f"Training cache {cache_dir} holds {len(self._shard_of_row)} rows, expected"
+                f" {self.num_samples} samples x {self.num_views} views."
+            )
+        self._handles = {}
+
+    def _open(self, name: str):
+        if name not in self._handles:
+            self._handles[name] = safe_open(os.path.join(self.cache_dir, name), framework="pt", device="cpu")
+        return self._handles[name]
+
+    def __getitem__(self, index):
+        view = random.randrange(self.num_views)
+        shard, row = self._shard_of_row[view * self.num_samples + index]
+        f = self._open(self.index["shards"][shard]["file"])
+        item = {name: f.get_slice(name)[row : row + 1][0] for name in ROW_FIELDS}
+
+        clip_hidden_flip = item.pop("clip_hidden_flip")
+        if random.random() < self.flip_prob:
+            item["clip_hidden"] = clip_hidden_flip
+            for name in MOMENT_FIELDS + ("mask",):
+                item[name] = torch.flip(item[name], dims=[-1])
+
+        text = self._open("text_embeds.safetensors")
+        annotation_idx = int(item.pop("annotation_idx"))
+        for name in TEXT_FIELDS:
+            item[name] = text.get_slice(name)[annotation_idx : annotation_idx + 1][0]
+        return item
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getstate__(self):
+        # safetensors handles cannot be pickled into dataloader workers, every worker opens its own
+        state = self.__dict__.copy()
+        state["_handles"] = {}
+        return state
+
+
+def sample_latents(moments: torch.Tensor, scaling_factor: float) -> torch.Tensor:
+    r"""
+    Samples scaled latents from stored VAE posterior moments, the same as `vae.encode(x).latent_dist.sample()`.
+    """
+    mean, logvar = moments.float().chunk(2, dim=1)
+    std = torch.exp(0.5 * torch.clamp(logvar, -30.0, 20.0))
+    return (mean + std * torch.randn_like(mean)) * scaling_factor
+
+
+def latent_mask(inpaint_mask: torch.Tensor, height: int, width: int) -> torch.Tensor:
+    r"""
+    The inpainting mask at latent resolution, resized the way the training step does it.
+    """
+    return F.interpolate(inpaint_mask, size=(height // 8, width // 8))
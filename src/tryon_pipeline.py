@@ -13,7 +13,7 @@
 # limitations under the License.
 
 import inspect
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import PIL.Image
@@ -56,6 +56,15 @@ from diffusers.utils import (
 from diffusers.utils.torch_utils import randn_tensor
 from diffusers.pipelines.pipeline_utils import DiffusionPipeline
 
+from src.attention_kv_cache import CrossAttentionKVCache
+from src.attention_maps import AttentionMapRecorder
+from src.compiled_step import CompiledDenoisingStep
+from src.deep_cache import DeepFeatureCache
+from src.garment_cache import GarmentFeatureCache
+from src.samplers import cfg_truncation_step, make_scheduler
+from src.prompt_cache import PromptEmbeddingCache
+from src.stage_timer import StageTimer
+
 
 
 if is_torch_xla_available():
@@ -421,6 +430,114 @@ class StableDiffusionXLInpaintPipeline(
             vae_scale_factor=self.vae_scale_factor, do_normalize=False, do_binarize=True, do_convert_grayscale=True
         )
 
+        self.prompt_cache = None
+        self.attention_map_recorder = None
+        self.kv_cache = None
+        self.compiled_step = None
+        self.vae_decoder = None
+        self._sampler_base_config = None
+
+    @property
+    def _execution_device(self):
+        # text encoders may be offloaded once the prompt cache is warm, the UNet decides where the pipeline runs
+        if self.unet is not None and not hasattr(self.unet, "_hf_hook"):
+            return self.unet.device
+        return super()._execution_device
+
+    def enable_prompt_cache(self, max_entries: int = 512) -> PromptEmbeddingCache:
+        r"""
+        Caches `encode_prompt` outputs per prompt in a bounded LRU cache, see [`PromptEmbeddingCache`]. Calls with
+        precomputed embeddings or a `lora_scale` bypass the cache.
+        """
+        self.prompt_cache = PromptEmbeddingCache(max_entries=max_entries)
+        return self.prompt_cache
+
+    def disable_prompt_cache(self):
+        self.prompt_cache = None
+
+    def enable_attention_maps(
+        self,
+        layers: Optional[Sequence[str]] = None,
+        steps: Optional[Sequence[int]] = None,
+        size: Tuple[int, int] = (32, 24),
+    ) -> AttentionMapRecorder:
+        r"""
+        Records the IP-adapter attention maps of the selected UNet layers and denoising steps during the following
+        calls, see [`AttentionMapRecorder`]. Read them with `recorder.maps()`; they are kept until `recorder.clear()`.
+        """
+        self.disable_attention_maps()
+        self.attention_map_recorder = AttentionMapRecorder(layers=layers, steps=steps, size=size).attach(self.unet)
+        return self.attention_map_recorder
+
+    def disable_attention_maps(self):
+        if self.attention_map_recorder is not None:
+            self.attention_map_recorder.detach()
+        self.attention_map_recorder = None
+
+    def enable_kv_cache(self, sync_timing: bool = False) -> CrossAttentionKVCache:
+        r"""
+        Projects the cross-attention keys/values of the text and IP-adapter tokens once per call and reuses them on
+        the following denoising steps, in both the try-on UNet and GarmentNet, see [`CrossAttentionKVCache`].
+        """
+        self.disable_kv_cache()
+        self.kv_cache = CrossAttentionKVCache(sync_timing=sync_timing).attach(self.unet, "unet")
+        if self.unet_encoder is not None:
+            self.kv_cache.attach(self.unet_encoder, "unet_encoder")
+        return self.kv_cache
+
+    def disable_kv_cache(self):
+        if self.kv_cache is not None:
+            self.kv_cache.detach()
+        self.kv_cache = None
+
+    def enable_compiled_step(
+        self, compile: bool = False, max_graphs: int = 8, warmup_iters: int = 2
+    ) -> CompiledDenoisingStep:
+        r"""
+        Runs the GarmentNet and UNet forward of every denoising step as CUDA graphs captured per input shape,
+        optionally compiled with `torch.compile` first, see [`CompiledDenoisingStep`]. Enable it after `unet_encoder`
+        is set, and capture the shapes a server uses at start before calling `freeze()` on the returned object.
+        """
+        self.compiled_step = CompiledDenoisingStep(
+            self.unet, self.unet_encoder, compile=compile, max_graphs=max_graphs, warmup_iters=warmup_iters
+        )
+        return self.compiled_step
+
+    def disable_compiled_step(self):
+        self.compiled_step = None
+
+    def set_sampler(self, name: str):
+        r"""
+        Replaces the scheduler with the `name` sampler (one of `SAMPLERS`), always built from the config of the
+        scheduler the pipeline was loaded with.
+        """
+        if self._sampler_base_config is None:
+            self._sampler_base_config = self.scheduler.config
+        self.scheduler = make_scheduler(name, self._sampler_base_config)
+
+    def set_vae_decoder(self, vae_decoder: Optional[AutoencoderKL] = None):
+        r"""
+        Decodes the final latents with `vae_decoder` instead of `vae`, typically an fp16-safe SDXL VAE (such as
+        `madebyollin/sdxl-vae-fp16-fix`) loaded in float16 and kept resident next to the encoder of `vae`. It shares
+        the latent space of `vae` and gets its slicing and tiling settings. `None` goes back to decoding with `vae`.
+        """
+        if vae_decoder is not None:
+            vae_decoder.requires_grad_(False)
+            vae_decoder.to(self.vae.device)
+            vae_decoder.use_slicing = self.vae.use_slicing
+            vae_decoder.use_tiling = self.vae.use_tiling
+        self.vae_decoder = vae_decoder
+
+    def offload_text_encoders(self, device: Union[str, torch.device] = "cpu"):
+        r"""
+        Moves both text encoders to `device`, typically once the prompt cache has been pre-warmed. Prompts that miss
+        the cache afterwards are encoded on `device` and moved to the execution device.
+        """
+        for text_encoder in (self.text_encoder, self.text_encoder_2):
+            if text_encoder is not None:
+                text_encoder.to(device)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
 
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.enable_vae_slicing
@@ -430,6 +547,8 @@ class StableDiffusionXLInpaintPipeline(
         compute decoding in several steps. This is useful to save some memory and allow larger batch sizes.
         """
         self.vae.enable_slicing()
+        if self.vae_decoder is not None:
+            self.vae_decoder.enable_slicing()
 
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.disable_vae_slicing
     def disable_vae_slicing(self):
@@ -438,6 +557,8 @@ class StableDiffusionXLInpaintPipeline(
         computing decoding in one step.
         """
         self.vae.disable_slicing()
+        if self.vae_decoder is not None:
+            self.vae_decoder.disable_slicing()
 
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.enable_vae_tiling
     def enable_vae_tiling(self):
@@ -447,6 +568,8 @@ class StableDiffusionXLInpaintPipeline(
         processing larger images.
         """
         self.vae.enable_tiling()
+        if self.vae_decoder is not None:
+            self.vae_decoder.enable_tiling()
 
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.disable_vae_tiling
     def disable_vae_tiling(self):
@@ -455,6 +578,8 @@ class StableDiffusionXLInpaintPipeline(
         computing decoding in one step.
         """
         self.vae.disable_tiling()
+        if self.vae_decoder is not None:
+            self.vae_decoder.disable_tiling()
 
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.encode_image
     def encode_image(self, image, device, num_images_per_prompt, output_hidden_states=None):
@@ -523,6 +648,7 @@ class StableDiffusionXLInpaintPipeline(
         negative_pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
         lora_scale: Optional[float] = None,
         clip_skip: Optional[int] = None,
+        use_prompt_cache: bool = True,
     ):
         r"""
         Encodes the prompt into text encoder hidden states.
@@ -565,9 +691,30 @@ class StableDiffusionXLInpaintPipeline(
             clip_skip (`int`, *optional*):
                 Number of layers to be skipped from CLIP while computing the prompt embeddings. A value of 1 means that
                 the output of the pre-final layer will be used for computing the prompt embeddings.
+            use_prompt_cache (`bool`, defaults to `True`):
+                Look the prompts up in `self.prompt_cache` if it is enabled.
         """
         device = device or self._execution_device
 
+        if (
+            use_prompt_cache
+            and self.prompt_cache is not None
+            and prompt is not None
+            and prompt_embeds is None
+            and negative_prompt_embeds is None
+            and lora_scale is None
+        ):
+            return self._encode_prompt_cached(
+                prompt,
+                prompt_2,
+                device,
+                num_images_per_prompt,
+                do_classifier_free_guidance,
+                negative_prompt,
+                negative_prompt_2,
+                clip_skip,
+            )
+
         # set lora scale so that monkey patched LoRA
         # function of text encoder can correctly access it
         if lora_scale is not None and isinstance(self, StableDiffusionXLLoraLoaderMixin):
@@ -742,6 +889,72 @@ class StableDiffusionXLInpaintPipeline(
 
         return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
 
+    def _encode_prompt_cached(
+        self,
+        prompt,
+        prompt_2,
+        device,
+        num_images_per_prompt,
+        do_classifier_free_guidance,
+        negative_prompt,
+        negative_prompt_2,
+        clip_skip,
+    ):
+        def broadcast(value, name):
+            if value is None or isinstance(value, str):
+                return [value] * batch_size
+            if len(value) != batch_size:
+                raise ValueError(
+                    f"`{name}` has batch size {len(value)}, but `prompt` has batch size {batch_size}. Please make sure"
+                    f" that passed `{name}` matches the batch size of `prompt`."
+                )
+            return list(value)
+
+        prompt = [prompt] if isinstance(prompt, str) else list(prompt)
+        batch_size = len(prompt)
+        prompt_2 = broadcast(prompt_2, "prompt_2")
+        prompt_2 = [p2 or p for p, p2 in zip(prompt, prompt_2)]
+        if do_classifier_free_guidance:
+            negative_prompt = broadcast(negative_prompt, "negative_prompt")
+            negative_prompt_2 = broadcast(negative_prompt_2, "negative_prompt_2")
+        else:
+            negative_prompt = negative_prompt_2 = [None] * batch_size
+
+        encoder_key = self.prompt_cache.encoder_key(self)
+        keys = [
+            (p, p2, n, n2, do_classifier_free_guidance, clip_skip, encoder_key)
+            for p, p2, n, n2 in zip(prompt, prompt_2, negative_prompt, negative_prompt_2)
+        ]
+        entries = [self.prompt_cache.get(key) for key in keys]
+
+        misses = [i for i, entry in enumerate(entries) if entry is None]
+        if misses:
+            text_encoder = self.text_encoder_2 if self.text_encoder_2 is not None else self.text_encoder
+            encoded = self.encode_prompt(
+                [prompt[i] for i in misses],
+                prompt_2=[prompt_2[i] for i in misses],
+                device=text_encoder.device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=do_classifier_free_guidance,
+                negative_prompt=None if negative_prompt[misses[0]] is None else [negative_prompt[i] for i in misses],
+                negative_prompt_2=None
+                if negative_prompt_2[misses[0]] is None
+                else [negative_prompt_2[i] for i in misses],
+                clip_skip=clip_skip,
+                use_prompt_cache=False,
+            )
+            for row, i in enumerate(misses):
+                entry = tuple(None if e is None else e[row : row + 1] for e in encoded)
+                entries[i] = self.prompt_cache.put(keys[i], entry, device)
+
+        outputs = []
+        for j in range(4):
+            if entries[0][j] is None:
+                outputs.append(None)
+            else:
+                outputs.append(torch.cat([entry[j] for entry in entries]).repeat_interleave(num_images_per_prompt, dim=0))
+        return tuple(outputs)
+
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline.prepare_extra_step_kwargs
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -909,27 +1122,103 @@ class StableDiffusionXLInpaintPipeline(
         return outputs
 
     def _encode_vae_image(self, image: torch.Tensor, generator: torch.Generator):
-        dtype = image.dtype
-        if self.vae.config.force_upcast:
-            image = image.float()
-            self.vae.to(dtype=torch.float32)
-
-        if isinstance(generator, list):
-            image_latents = [
-                retrieve_latents(self.vae.encode(image[i : i + 1]), generator=generator[i])
-                for i in range(image.shape[0])
-            ]
-            image_latents = torch.cat(image_latents, dim=0)
-        else:
-            image_latents = retrieve_latents(self.vae.encode(image), generator=generator)
+        return self.encode_vae_images({"image": image}, image.device, image.dtype, generator=generator)["image"]
+
+    def _vae_encoder_dtype(self) -> torch.dtype:
+        # with `force_upcast` the encoder and `quant_conv` are moved to float32 once and stay there, instead of the
+        # whole VAE being cast to float32 and back around every encode
+        encoder_dtype = self.vae.encoder.conv_in.weight.dtype
+        if self.vae.config.force_upcast and encoder_dtype != torch.float32:
+            self.vae.encoder.to(dtype=torch.float32)
+            self.vae.quant_conv.to(dtype=torch.float32)
+            encoder_dtype = torch.float32
+        return encoder_dtype
+
+    def encode_vae_images(
+        self,
+        images: Dict[str, Optional[torch.Tensor]],
+        device: torch.device,
+        dtype: torch.dtype,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        r"""
+        Encodes several image batches with a single VAE encoder call per image size.
 
-        if self.vae.config.force_upcast:
-            self.vae.to(dtype)
+        The pixel-space images are concatenated along the batch dimension, encoded in the precision of the VAE encoder
+        and split back. With `force_upcast` the encoder is kept in float32 (and run outside of autocast) while the
+        rest of the VAE keeps its dtype.
 
-        image_latents = image_latents.to(dtype)
-        image_latents = self.vae.config.scaling_factor * image_latents
+        Args:
+            images (`Dict[str, torch.Tensor]`):
+                Images in [-1, 1] of shape `(batch_size, 3, height, width)` keyed by name. Images of the same height
+                and width are encoded in one call. Entries that already are VAE latents are passed through, `None`
+                entries are dropped.
+            device (`torch.device`):
+                Device of the returned latents.
+            dtype (`torch.dtype`):
+                Dtype of the returned latents.
+            generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
+                Used to sample from the latent distributions. A list of generators is applied per sample within each
+                entry.
 
-        return image_latents
+        Returns:
+            `Dict[str, torch.Tensor]`: The scaled latents of each entry.
+        """
+        latents, distributions = self._encode_vae_distributions(images, device, dtype)
+        for name, (mean, std) in distributions.items():
+            latents[name] = self._sample_vae_latents(mean, std, generator, device, dtype)
+        return latents
+
+    def _encode_vae_distributions(
+        self, images: Dict[str, Optional[torch.Tensor]], device: torch.device, dtype: torch.dtype
+    ) -> Tuple[Dict[str, torch.Tensor], Dict[str, Tuple[torch.Tensor, torch.Tensor]]]:
+        # latents passed through, and the mean and std of the encoded pixel-space entries; entries of the same spatial
+        # size share an encoder call
+        latents = {}
+        groups = {}
+        for name, image in images.items():
+            if image is None:
+                continue
+            if image.shape[1] == self.vae.config.latent_channels:
+                latents[name] = image.to(device=device, dtype=dtype)
+            else:
+                groups.setdefault(tuple(image.shape[2:]), {})[name] = image
+
+        distributions = {}
+        encoder_dtype = self._vae_encoder_dtype()
+        for pixels in groups.values():
+            batch = torch.cat([image.to(device=device, dtype=encoder_dtype) for image in pixels.values()])
+            with torch.autocast(batch.device.type, enabled=False):
+                latent_dist = self.vae.encode(batch).latent_dist
+            start = 0
+            for name, image in pixels.items():
+                end = start + image.shape[0]
+                distributions[name] = (latent_dist.mean[start:end], latent_dist.std[start:end])
+                start = end
+        return latents, {name: distributions[name] for name in images if name in distributions}
+
+    def _sample_vae_latents(self, mean, std, generator, device, dtype) -> torch.Tensor:
+        noise = randn_tensor(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+        return (self.vae.config.scaling_factor * (mean + std * noise)).to(device=device, dtype=dtype)
+
+    def decode_vae_latents(self, latents: torch.Tensor) -> torch.Tensor:
+        r"""
+        Decodes scaled latents to images in [-1, 1] with the decoder set by
+        [`~StableDiffusionXLInpaintPipeline.set_vae_decoder`], or with `vae`.
+
+        With `force_upcast` the decoder of `vae` is upcast on the first call and then stays in float32 (apart from the
+        layers [`~StableDiffusionXLInpaintPipeline.upcast_vae`] keeps in half precision), so no VAE weights are cast
+        per request. The decoder runs in the dtype of its weights, also under autocast. Slicing and tiling apply as
+        enabled with `enable_vae_slicing` / `enable_vae_tiling`.
+        """
+        vae = self.vae_decoder if self.vae_decoder is not None else self.vae
+        if vae is self.vae and self.vae.config.force_upcast and self.vae.decoder.conv_out.weight.dtype == torch.float16:
+            self.upcast_vae()
+
+        latents = latents.to(vae.post_quant_conv.weight.dtype) / vae.config.scaling_factor
+        with torch.autocast(latents.device.type, enabled=False):
+            image = vae.decode(latents, return_dict=False)[0]
+        return image
 
     def prepare_mask_latents(
         self, mask, masked_image, batch_size, height, width, dtype, device, generator, do_classifier_free_guidance
@@ -1072,9 +1361,18 @@ class StableDiffusionXLInpaintPipeline(
 
         return add_time_ids, add_neg_time_ids
 
-    # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_upscale.StableDiffusionUpscalePipeline.upcast_vae
+    def _garment_reference_features(self, cloth, t, text_embeds_cloth, precomputed=None, graphed_step=None):
+        if precomputed is not None and int(t) in precomputed:
+            return precomputed[int(t)]
+        if graphed_step is not None:
+            return graphed_step.garment()
+        _, reference_features = self.unet_encoder(cloth, t, text_embeds_cloth, return_dict=False)
+        return reference_features
+
+    # Adapted from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_upscale.StableDiffusionUpscalePipeline.upcast_vae
     def upcast_vae(self):
-        dtype = self.vae.dtype
+        # the decoder dtype, the encoder may already be kept in float32
+        dtype = self.vae.post_quant_conv.weight.dtype
         self.vae.to(dtype=torch.float32)
         use_torch_2_0_or_xformers = isinstance(
             self.vae.decoder.mid_block.attentions[0].processor,
@@ -1278,6 +1576,7 @@ class StableDiffusionXLInpaintPipeline(
         pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
         negative_pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
         ip_adapter_image: Optional[PipelineImageInput] = None,
+        ip_adapter_image_embeds: Optional[torch.FloatTensor] = None,
         output_type: Optional[str] = "pil",
         cloth =None,
         pose_img = None,
@@ -1295,6 +1594,11 @@ class StableDiffusionXLInpaintPipeline(
         negative_aesthetic_score: float = 2.5,
         clip_skip: Optional[int] = None,
         pooled_prompt_embeds_c=None,
+        garment_cache: Optional[GarmentFeatureCache] = None,
+        deep_cache: Optional[DeepFeatureCache] = None,
+        cfg_truncation: Optional[float] = None,
+        garment_reference_features: Optional[Dict[int, List[torch.FloatTensor]]] = None,
+        stage_timer: Optional[StageTimer] = None,
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         **kwargs,
@@ -1317,6 +1621,11 @@ class StableDiffusionXLInpaintPipeline(
                 repainted, while black pixels will be preserved. If `mask_image` is a PIL image, it will be converted
                 to a single channel (luminance) before use. If it's a tensor, it should contain one color channel (L)
                 instead of 3, so the expected shape would be `(B, H, W, 1)`.
+            masked_image_latents (`torch.FloatTensor`, *optional*):
+                Precomputed VAE latents of the masked person image, e.g. from a per-person cache. Its VAE encode is
+                skipped.
+            pose_img (`torch.FloatTensor`):
+                DensePose image in [-1, 1], or its precomputed 4-channel VAE latents.
             height (`int`, *optional*, defaults to self.unet.config.sample_size * self.vae_scale_factor):
                 The height in pixels of the generated image. This is set to 1024 by default for the best results.
                 Anything below 512 pixels won't work well for
@@ -1391,6 +1700,10 @@ class StableDiffusionXLInpaintPipeline(
                 weighting. If not provided, pooled negative_prompt_embeds will be generated from `negative_prompt`
                 input argument.
             ip_adapter_image: (`PipelineImageInput`, *optional*): Optional image input to work with IP Adapters.
+            ip_adapter_image_embeds (`torch.FloatTensor`, *optional*):
+                Pre-generated IP-adapter tokens, already projected by `unet.encoder_hid_proj` and, with classifier free
+                guidance, concatenated as `[negative, positive]` along the batch. Takes precedence over
+                `ip_adapter_image`.
             num_images_per_prompt (`int`, *optional*, defaults to 1):
                 The number of images to generate per prompt.
             eta (`float`, *optional*, defaults to 0.0):
@@ -1453,6 +1766,22 @@ class StableDiffusionXLInpaintPipeline(
             clip_skip (`int`, *optional*):
                 Number of layers to be skipped from CLIP while computing the prompt embeddings. A value of 1 means that
                 the output of the pre-final layer will be used for computing the prompt embeddings.
+            garment_cache (`GarmentFeatureCache`, *optional*):
+                Reuse policy for the GarmentNet reference features across denoising steps. If not defined, the
+                features are recomputed at every step. The cache is reset at the start of the call and its
+                `report()` describes the run afterwards.
+            deep_cache (`DeepFeatureCache`, *optional*):
+                DeepCache-style reuse of the deep try-on UNet features: on the steps its schedule marks as reused only
+                the shallow UNet blocks run. The cache is reset at the start of the call.
+            cfg_truncation (`float`, *optional*):
+                Fraction of the denoising steps that run with classifier free guidance. The unconditional branch is
+                dropped for the remaining steps, halving the UNet batch. If not defined, guidance is used throughout.
+            garment_reference_features (`Dict[int, List[torch.FloatTensor]]`, *optional*):
+                Pre-generated GarmentNet reference features keyed by timestep. Timesteps that are missing are
+                computed with `unet_encoder`. `cloth` may then be passed as 4-channel VAE latents as well.
+            stage_timer (`StageTimer`, *optional*):
+                Records the time and peak memory of the prompt encoding, IP-Adapter image encoding, VAE encode,
+                denoising loop (with the GarmentNet and UNet time of every step) and VAE decode, see [`StageTimer`].
             callback_on_step_end (`Callable`, *optional*):
                 A function that calls at the end of each denoising steps during the inference. The function is called
                 with the following arguments: `callback_on_step_end(self: DiffusionPipeline, step: int, timestep: int,
@@ -1527,32 +1856,34 @@ class StableDiffusionXLInpaintPipeline(
             batch_size = prompt_embeds.shape[0]
 
         device = self._execution_device
+        timer = stage_timer if stage_timer is not None else StageTimer(enabled=False)
 
         # 3. Encode input prompt
         text_encoder_lora_scale = (
             self.cross_attention_kwargs.get("scale", None) if self.cross_attention_kwargs is not None else None
         )
 
-        (
-            prompt_embeds,
-            negative_prompt_embeds,
-            pooled_prompt_embeds,
-            negative_pooled_prompt_embeds,
-        ) = self.encode_prompt(
-            prompt=prompt,
-            prompt_2=prompt_2,
-            device=device,
-            num_images_per_prompt=num_images_per_prompt,
-            do_classifier_free_guidance=self.do_classifier_free_guidance,
-            negative_prompt=negative_prompt,
-            negative_prompt_2=negative_prompt_2,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
-            lora_scale=text_encoder_lora_scale,
-            clip_skip=self.clip_skip,
-        )
+        with timer.stage("encode_prompt"):
+            (
+                prompt_embeds,
+                negative_prompt_embeds,
+                pooled_prompt_embeds,
+                negative_pooled_prompt_embeds,
+            ) = self.encode_prompt(
+                prompt=prompt,
+                prompt_2=prompt_2,
+                device=device,
+                num_images_per_prompt=num_images_per_prompt,
+                do_classifier_free_guidance=self.do_classifier_free_guidance,
+                negative_prompt=negative_prompt,
+                negative_prompt_2=negative_prompt_2,
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+                lora_scale=text_encoder_lora_scale,
+                clip_skip=self.clip_skip,
+            )
 
         # 4. set timesteps
         def denoising_value_valid(dnv):
@@ -1607,6 +1938,29 @@ class StableDiffusionXLInpaintPipeline(
         return_image_latents = num_channels_unet == 4
 
         add_noise = True if self.denoising_start is None else False
+        # the person, masked person, pose and garment images go through the VAE encoder in one call; the person
+        # latents are only needed when the initial latents start from the image (strength < 1)
+        needs_image_latents = return_image_latents or not add_noise or (latents is None and not is_strength_max)
+        with timer.stage("vae_encode"):
+            vae_latents, vae_distributions = self._encode_vae_distributions(
+                {
+                    "image": init_image if needs_image_latents else None,
+                    "masked_image": masked_image,
+                    "pose_img": pose_img,
+                    "cloth": cloth,
+                },
+                device,
+                prompt_embeds.dtype,
+            )
+
+        def sample_vae_latents(name, generator=None):
+            # sampled in the order of the separate encoder calls this replaced, so a seed gives the same image
+            if name in vae_distributions:
+                mean, std = vae_distributions.pop(name)
+                vae_latents[name] = self._sample_vae_latents(mean, std, generator, device, prompt_embeds.dtype)
+            return vae_latents.get(name)
+
+        vae_image_latents = sample_vae_latents("image", generator)
         latents_outputs = self.prepare_latents(
             batch_size * num_images_per_prompt,
             num_channels_latents,
@@ -1616,7 +1970,7 @@ class StableDiffusionXLInpaintPipeline(
             device,
             generator,
             latents,
-            image=init_image,
+            image=vae_image_latents if vae_image_latents is not None else init_image,
             timestep=latent_timestep,
             is_strength_max=is_strength_max,
             add_noise=add_noise,
@@ -1632,7 +1986,7 @@ class StableDiffusionXLInpaintPipeline(
         # 7. Prepare mask latent variables
         mask, masked_image_latents = self.prepare_mask_latents(
             mask,
-            masked_image,
+            sample_vae_latents("masked_image", generator),
             batch_size * num_images_per_prompt,
             height,
             width,
@@ -1641,17 +1995,12 @@ class StableDiffusionXLInpaintPipeline(
             generator,
             self.do_classifier_free_guidance,
         )
-        pose_img = pose_img.to(device=device, dtype=prompt_embeds.dtype)
-
-        pose_img = self.vae.encode(pose_img).latent_dist.sample()
-        pose_img = pose_img * self.vae.config.scaling_factor
-
-        # pose_img = self._encode_vae_image(pose_img, generator=generator)
-
+        # the pose latents were always sampled without the generator
+        pose_img = sample_vae_latents("pose_img")
         pose_img = (
                 torch.cat([pose_img] * 2) if self.do_classifier_free_guidance else pose_img
         )
-        cloth = self._encode_vae_image(cloth, generator=generator)
+        cloth = sample_vae_latents("cloth", generator)
 
         # # 8. Check that sizes of mask, masked image and latents match
         # if num_channels_unet == 9:
@@ -1717,13 +2066,17 @@ class StableDiffusionXLInpaintPipeline(
         add_text_embeds = add_text_embeds.to(device)
         add_time_ids = add_time_ids.to(device)
 
-        if ip_adapter_image is not None:
-            image_embeds = self.prepare_ip_adapter_image_embeds(
-                ip_adapter_image, device, batch_size * num_images_per_prompt
-            )
+        image_embeds = None
+        if ip_adapter_image_embeds is not None:
+            image_embeds = ip_adapter_image_embeds.to(device=device, dtype=prompt_embeds.dtype)
+        elif ip_adapter_image is not None:
+            with timer.stage("ip_adapter"):
+                image_embeds = self.prepare_ip_adapter_image_embeds(
+                    ip_adapter_image, device, batch_size * num_images_per_prompt
+                )
 
-            #project outside for loop
-            image_embeds = self.unet.encoder_hid_proj(image_embeds).to(prompt_embeds.dtype)
+                #project outside for loop
+                image_embeds = self.unet.encoder_hid_proj(image_embeds).to(prompt_embeds.dtype)
 
 
         # 11. Denoising loop
@@ -1760,13 +2113,51 @@ class StableDiffusionXLInpaintPipeline(
 
 
 
+        if garment_cache is not None:
+            garment_cache.reset()
+        if deep_cache is not None:
+            deep_cache.reset()
+
+        if self.kv_cache is not None:
+            self.kv_cache.begin()
+        if self.attention_map_recorder is not None:
+            self.attention_map_recorder.begin(height // self.vae_scale_factor, width // self.vae_scale_factor)
+
+        do_classifier_free_guidance = self.do_classifier_free_guidance
+        truncation_step = cfg_truncation_step(len(timesteps), cfg_truncation) if do_classifier_free_guidance else None
+        # steps whose Python state changes from step to step are not captured
+        use_compiled_step = (
+            self.compiled_step is not None
+            and deep_cache is None
+            and self.attention_map_recorder is None
+            and self.cross_attention_kwargs is None
+            and not (garment_cache is not None and garment_cache.measure_drift)
+        )
+
         self._num_timesteps = len(timesteps)
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
+        with self.progress_bar(total=num_inference_steps) as progress_bar, timer.stage("denoise"):
             for i, t in enumerate(timesteps):
                 if self.interrupt:
                     continue
+                if i == truncation_step:
+                    # keep the conditional half of every doubled input for the remaining steps
+                    do_classifier_free_guidance = False
+                    prompt_embeds, add_text_embeds, add_time_ids, mask, masked_image_latents, pose_img = (
+                        x.chunk(2)[1]
+                        for x in (prompt_embeds, add_text_embeds, add_time_ids, mask, masked_image_latents, pose_img)
+                    )
+                    if image_embeds is not None:
+                        image_embeds = image_embeds.chunk(2)[1]
+                    if self.kv_cache is not None:
+                        self.kv_cache.invalidate()
+                    if deep_cache is not None:
+                        deep_cache.invalidate()
+                if self.attention_map_recorder is not None:
+                    self.attention_map_recorder.set_step(i, t)
+                if deep_cache is not None:
+                    deep_cache.set_step(i)
                 # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
+                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
 
                 # concat latents, mask, masked_image_latents in the channel dimension
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
@@ -1781,10 +2172,37 @@ class StableDiffusionXLInpaintPipeline(
 
                 # predict the noise residual
                 added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
-                if ip_adapter_image is not None:
+                if image_embeds is not None:
                     added_cond_kwargs["image_embeds"] = image_embeds
+                graphed_step = None
+                if use_compiled_step:
+                    graphed_step = self.compiled_step.lookup(
+                        {
+                            "latent_model_input": latent_model_input,
+                            "timestep": t,
+                            "prompt_embeds": prompt_embeds,
+                            "text_embeds": add_text_embeds,
+                            "time_ids": add_time_ids,
+                            "image_embeds": image_embeds,
+                            "timestep_cond": timestep_cond,
+                            "cloth": cloth,
+                            "text_embeds_cloth": text_embeds_cloth,
+                        },
+                        kv_cache=self.kv_cache,
+                    )
                 # down,reference_features = self.UNet_Encoder(cloth,t, text_embeds_cloth,added_cond_kwargs= {"text_embeds": pooled_prompt_embeds_c, "time_ids": add_time_ids},return_dict=False)
-                down,reference_features = self.unet_encoder(cloth,t, text_embeds_cloth,return_dict=False)
+                with timer.stage("garmentnet", step=i):
+                    if garment_cache is not None:
+                        reference_features = garment_cache.get(
+                            i,
+                            lambda: self._garment_reference_features(
+                                cloth, t, text_embeds_cloth, garment_reference_features, graphed_step
+                            ),
+                        )
+                    else:
+                        reference_features = self._garment_reference_features(
+                            cloth, t, text_embeds_cloth, garment_reference_features, graphed_step
+                        )
                 # print(type(reference_features))
                 # print(reference_features)
                 reference_features = list(reference_features)
@@ -1792,30 +2210,32 @@ class StableDiffusionXLInpaintPipeline(
                 # for elem in reference_features:
                 #     print(elem.shape)
                 # exit(1)
-                if self.do_classifier_free_guidance:
-                    reference_features = [torch.cat([torch.zeros_like(d), d]) for d in reference_features]
-
-
-                noise_pred = self.unet(
-                    latent_model_input,
-                    t,
-                    encoder_hidden_states=prompt_embeds,
-                    timestep_cond=timestep_cond,
-                    cross_attention_kwargs=self.cross_attention_kwargs,
-                    added_cond_kwargs=added_cond_kwargs,
-                    return_dict=False,
-                    garment_features=reference_features,
-                )[0]
+                # with classifier free guidance only the conditional garment features are passed, the try-on
+                # self-attention treats the missing leading rows as an all-zero unconditional garment
+                with timer.stage("unet", step=i):
+                    noise_pred = graphed_step.unet(reference_features) if graphed_step is not None else None
+                    if noise_pred is None:
+                        noise_pred = self.unet(
+                            latent_model_input,
+                            t,
+                            encoder_hidden_states=prompt_embeds,
+                            timestep_cond=timestep_cond,
+                            cross_attention_kwargs=self.cross_attention_kwargs,
+                            added_cond_kwargs=added_cond_kwargs,
+                            return_dict=False,
+                            garment_features=reference_features,
+                            deep_cache=deep_cache,
+                        )[0]
                 # noise_pred = self.unet(latent_model_input, t, 
                 #                             prompt_embeds,timestep_cond=timestep_cond,cross_attention_kwargs=self.cross_attention_kwargs,added_cond_kwargs=added_cond_kwargs,down_block_additional_attn=down ).sample
 
 
                 # perform guidance
-                if self.do_classifier_free_guidance:
+                if do_classifier_free_guidance:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
                     noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
 
-                if self.do_classifier_free_guidance and self.guidance_rescale > 0.0:
+                if do_classifier_free_guidance and self.guidance_rescale > 0.0:
                     # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
                     noise_pred = rescale_noise_cfg(noise_pred, noise_pred_text, guidance_rescale=self.guidance_rescale)
 
@@ -1824,7 +2244,7 @@ class StableDiffusionXLInpaintPipeline(
 
                 if num_channels_unet == 4:
                     init_latents_proper = image_latents
-                    if self.do_classifier_free_guidance:
+                    if do_classifier_free_guidance:
                         init_mask, _ = mask.chunk(2)
                     else:
                         init_mask = mask
@@ -1842,6 +2262,8 @@ class StableDiffusionXLInpaintPipeline(
                     for k in callback_on_step_end_tensor_inputs:
                         callback_kwargs[k] = locals()[k]
                     callback_outputs = callback_on_step_end(self, i, t, callback_kwargs)
+                    if self.kv_cache is not None and "prompt_embeds" in callback_outputs:
+                        self.kv_cache.invalidate()
 
                     latents = callback_outputs.pop("latents", latents)
                     prompt_embeds = callback_outputs.pop("prompt_embeds", prompt_embeds)
@@ -1865,24 +2287,20 @@ class StableDiffusionXLInpaintPipeline(
                 if XLA_AVAILABLE:
                     xm.mark_step()
 
-        if not output_type == "latent":
-            # make sure the VAE is in float32 mode, as it overflows in float16
-            needs_upcasting = self.vae.dtype == torch.float16 and self.vae.config.force_upcast
-
-            if needs_upcasting:
-                self.upcast_vae()
-                latents = latents.to(next(iter(self.vae.post_quant_conv.parameters())).dtype)
-
-            image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False)[0]
+        if self.kv_cache is not None:
+            self.kv_cache.end()
+        if self.attention_map_recorder is not None:
+            self.attention_map_recorder.end()
 
-            # cast back to fp16 if needed
-            if needs_upcasting:
-                self.vae.to(dtype=torch.float16)
-        # else:
-        #     return StableDiffusionXLPipelineOutput(images=latents)
+        if not output_type == "latent":
+            with timer.stage("vae_decode"):
+                image = self.decode_vae_latents(latents)
+        else:
+            image = latents
 
 
-        image = self.image_processor.postprocess(image, output_type=output_type)
+        with timer.stage("postprocess"):
+            image = self.image_processor.postprocess(image, output_type=output_type)
 
         if padding_mask_crop is not None:
             image = [self.image_processor.apply_overlay(mask_image, original_image, i, crops_coords) for i in image]
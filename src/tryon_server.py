@@ -0,0 +1,427 @@
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import PIL.Image
+import torch
+from torchvision import transforms
+
+from src.prompt_cache import GARMENT_PROMPT_TEMPLATE, NEGATIVE_PROMPT, PERSON_PROMPT_TEMPLATE
+from src.stage_timer import StageTimer
+
+
+tensor_transfrom = transforms.Compose(
+    [
+        transforms.ToTensor(),
+        transforms.Normalize([0.5], [0.5]),
+    ]
+)
+
+
+@dataclass
+class TryonRequest:
+    r"""
+    One preprocessed try-on request.
+
+    Args:
+        human_img (`PIL.Image.Image`): Person image at the output resolution.
+        mask (`PIL.Image.Image`): Inpainting mask at the output resolution.
+        pose_img (`PIL.Image.Image`): DensePose image at the output resolution.
+        garm_img (`PIL.Image.Image`): Garment image at the output resolution.
+        garment_des (`str`): Garment description.
+        num_inference_steps (`int`, defaults to 30): Requested denoising steps, rounded up to a step bucket.
+        seed (`int`, *optional*): Seed of this request; requests in one batch keep their own generator.
+        guidance_scale (`float`, defaults to 2.0): Classifier free guidance scale.
+        sampler (`str`, defaults to `"ddpm"`): Sampler the batch runs with, one of `src.samplers.SAMPLERS`.
+        cfg_truncation (`float`, *optional*): Fraction of the steps that run with classifier free guidance.
+        stage_timer (`StageTimer`, *optional*):
+            Receives the queue wait of this request and the stages of the batch it ran in, see [`StageTimer`].
+        person_latents (`Dict[str, torch.Tensor]`, *optional*):
+            Precomputed `"masked_image"` and `"pose_img"` VAE latents of this person and mask, from
+            [`encode_person_latents`]. The pipeline then skips their VAE encode.
+        size (`Tuple[int, int]`, *optional*):
+            `(width, height)` of `human_img`, `mask` and `pose_img` when they are a region of the frame (see
+            `src.roi`) instead of the server's output size. Only requests of the same size are batched together.
+    """
+
+    human_img: PIL.Image.Image
+    mask: PIL.Image.Image
+    pose_img: PIL.Image.Image
+    garm_img: PIL.Image.Image
+    garment_des: str
+    num_inference_steps: int = 30
+    seed: Optional[int] = None
+    guidance_scale: float = 2.0
+    sampler: str = "ddpm"
+    cfg_truncation: Optional[float] = None
+    stage_timer: Optional[StageTimer] = None
+    person_latents: Optional[Dict[str, torch.Tensor]] = None
+    size: Optional[Tuple[int, int]] = None
+
+
+@torch.no_grad()
+def encode_person_latents(
+    pipe,
+    human_imgs: Sequence[PIL.Image.Image],
+    masks: Sequence[PIL.Image.Image],
+    pose_imgs: Sequence[PIL.Image.Image],
+    height: int = 1024,
+    width: int = 768,
+) -> Dict[str, torch.Tensor]:
+    r"""
+    VAE latents of the masked person images and the pose images, preprocessed as in the pipeline, to be reused across
+    requests for the same person through `TryonRequest.person_latents`.
+    """
+    device = pipe._execution_device
+    init_image = pipe.image_processor.preprocess(list(human_imgs), height=height, width=width).to(dtype=torch.float32)
+    mask = pipe.mask_processor.preprocess(list(masks), height=height, width=width)
+    pose_img = torch.stack([tensor_transfrom(p) for p in pose_imgs]).to(torch.float16)
+    with torch.inference_mode():
+        return pipe.encode_vae_images(
+            {"masked_image": init_image * (mask < 0.5), "pose_img": pose_img}, device, torch.float16
+        )
+
+
+@dataclass(eq=False)
+class _Pending:
+    request: TryonRequest
+    key: Tuple
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+class BatchingTryonServer:
+    r"""
+    Dynamic batching in front of the try-on pipeline.
+
+    Requests submitted from any thread are queued; a worker thread waits up to `max_wait_ms` after the oldest queued
+    request for others with the same batch key (step bucket, guidance scale, sampler and CFG truncation) and runs up to `max_batch_size` of
+    them as one batch through `encode_prompt`, the UNet/GarmentNet loop and the VAE decode. Every request keeps its
+    own generator, so its noise does not depend on the batch it lands in. Requests with a `size` (region of interest
+    try-on) are batched per size.
+
+    Args:
+        pipe ([`StableDiffusionXLInpaintPipeline`]): The try-on pipeline.
+        max_batch_size (`int`, defaults to 4): Largest batch run at once.
+        max_wait_ms (`float`, defaults to 50.0): Latency window for collecting a batch.
+        step_buckets (`Sequence[int]`, defaults to `(20, 30, 40)`):
+            Step counts requests are rounded up to, so requests with nearby step counts share a batch. Requests above
+            the largest bucket run with their own step count.
+        height (`int`, defaults to 1024): Output height.
+        width (`int`, defaults to 768): Output width.
+    """
+
+    def __init__(
+        self,
+        pipe,
+        max_batch_size: int = 4,
+        max_wait_ms: float = 50.0,
+        step_buckets: Sequence[int] = (20, 30, 40),
+        height: int = 1024,
+        width: int = 768,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"`max_batch_size` has to be a positive integer but is {max_batch_size}.")
+        self.pipe = pipe
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.step_buckets = sorted(step_buckets)
+        self.height = height
+        self.width = width
+
+        self._queue: List[_Pending] = []
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._stopped = False
+        self._sampler: Optional[str] = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.latencies: List[float] = []
+        self.batch_sizes: List[int] = []
+        self._first_submit: Optional[float] = None
+        self._last_done: Optional[float] = None
+
+    def bucket(self, num_inference_steps: int) -> int:
+        for steps in self.step_buckets:
+            if num_inference_steps <= steps:
+                return steps
+        return int(num_inference_steps)
+
+    def start(self) -> "BatchingTryonServer":
+        with self._cond:
+            if self._worker is None:
+                self._stopped = False
+                self._worker = threading.Thread(target=self._loop, name="tryon-batcher", daemon=True)
+                self._worker.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def submit(self, request: TryonRequest) -> Future:
+        key = (
+            self.bucket(request.num_inference_steps),
+            float(request.guidance_scale),
+            request.sampler,
+            request.cfg_truncation,
+            request.size,
+        )
+        pending = _Pending(request, key=key)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("The try-on server has been stopped.")
+            if self._first_submit is None:
+                self._first_submit = pending.enqueued_at
+            self._queue.append(pending)
+            self._cond.notify_all()
+        self.start()
+        return pending.future
+
+    def __call__(self, request: TryonRequest) -> PIL.Image.Image:
+        return self.submit(request).result()
+
+    def _next_batch(self) -> List[_Pending]:
+        with self._cond:
+            while not self._queue and not self._stopped:
+                self._cond.wait()
+            if not self._queue:
+                return []
+
+            key = self._queue[0].key
+            deadline = self._queue[0].enqueued_at + self.max_wait
+            while not self._stopped:
+                num_ready = sum(p.key == key for p in self._queue)
+                remaining = deadline - time.perf_counter()
+                if num_ready >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = [p for p in self._queue if p.key == key][: self.max_batch_size]
+            self._queue = [p for p in self._queue if p not in batch]
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            started = time.perf_counter()
+            for p in batch:
+                if p.request.stage_timer is not None:
+                    p.request.stage_timer.add("queue_wait", (started - p.enqueued_at) * 1000)
+            try:
+                images = self.run_batch([p.request for p in batch])
+            except Exception as e:
+                for p in batch:
+                    p.future.set_exception(e)
+                continue
+
+            done = time.perf_counter()
+            with self._cond:
+                self.batch_sizes.append(len(batch))
+                self.latencies.extend(done - p.enqueued_at for p in batch)
+                self._last_done = done
+            for p, image in zip(batch, images):
+                p.future.set_result(image)
+
+    @torch.no_grad()
+    def run_batch(self, requests: List[TryonRequest]) -> List[PIL.Image.Image]:
+        r"""
+        Runs `requests` as one pipeline call. All requests have to share the batch key. When a request has a
+        `stage_timer`, the batch is timed and its stages are added to every such timer.
+        """
+        timers = [r.stage_timer for r in requests if r.stage_timer is not None]
+        timer = StageTimer(
+            enabled=bool(timers),
+            track_memory=any(t.track_memory for t in timers),
+            record_functions=any(t.record_functions for t in timers),
+        )
+        width, height = requests[0].size or (self.width, self.height)
+        pipe = self.pipe
+        device = pipe._execution_device
+        num_inference_steps = self.bucket(max(r.num_inference_steps for r in requests))
+        guidance_scale = requests[0].guidance_scale
+        if requests[0].sampler != self._sampler:
+            pipe.set_sampler(requests[0].sampler)
+            self._sampler = requests[0].sampler
+        negative_prompt = [NEGATIVE_PROMPT] * len(requests)
+
+        generator = []
+        for r in requests:
+            g = torch.Generator(device)
+            if r.seed is not None:
+                g.manual_seed(int(r.seed))
+            else:
+                g.seed()
+            generator.append(g)
+
+        with torch.cuda.amp.autocast():
+            with torch.inference_mode():
+                with timer.stage("encode_prompt"):
+                    (
+                        prompt_embeds,
+                        negative_prompt_embeds,
+                        pooled_prompt_embeds,
+                        negative_pooled_prompt_embeds,
+                    ) = pipe.encode_prompt(
+                        [PERSON_PROMPT_TEMPLATE + r.garment_des for r in requests],
+                        num_images_per_prompt=1,
+                        do_classifier_free_guidance=True,
+                        negative_prompt=negative_prompt,
+                    )
+                    prompt_embeds_c, _, _, _ = pipe.encode_prompt(
+                        [GARMENT_PROMPT_TEMPLATE + r.garment_des for r in requests],
+                        num_images_per_prompt=1,
+                        do_classifier_free_guidance=False,
+                        negative_prompt=negative_prompt,
+                    )
+
+                masked_image_latents = None
+                if any(r.person_latents is not None for r in requests):
+                    # requests of cached persons pass their latents, the others are encoded here in one call
+                    missing = [r for r in requests if r.person_latents is None]
+                    encoded = {}
+                    if missing:
+                        with timer.stage("person_encode"):
+                            encoded = encode_person_latents(
+                                pipe,
+                                [r.human_img for r in missing],
+                                [r.mask for r in missing],
+                                [r.pose_img for r in missing],
+                                height=height,
+                                width=width,
+                            )
+                    missing_index = {id(r): j for j, r in enumerate(missing)}
+                    person_latents = []
+                    for r in requests:
+                        if r.person_latents is not None:
+                            person_latents.append(r.person_latents)
+                        else:
+                            j = missing_index[id(r)]
+                            person_latents.append({name: latents[j : j + 1] for name, latents in encoded.items()})
+                    masked_image_latents = torch.cat([latents["masked_image"].to(device) for latents in person_latents])
+                    pose_img = torch.cat([latents["pose_img"].to(device) for latents in person_latents])
+                else:
+                    pose_img = torch.stack([tensor_transfrom(r.pose_img) for r in requests]).to(device, torch.float16)
+                garm_tensor = torch.stack([tensor_transfrom(r.garm_img) for r in requests]).to(device, torch.float16)
+                images = pipe(
+                    prompt_embeds=prompt_embeds.to(device, torch.float16),
+                    negative_prompt_embeds=negative_prompt_embeds.to(device, torch.float16),
+                    pooled_prompt_embeds=pooled_prompt_embeds.to(device, torch.float16),
+                    negative_pooled_prompt_embeds=negative_pooled_prompt_embeds.to(device, torch.float16),
+                    num_inference_steps=num_inference_steps,
+                    generator=generator,
+                    strength=1.0,
+                    pose_img=pose_img,
+                    text_embeds_cloth=prompt_embeds_c.to(device, torch.float16),
+                    cloth=garm_tensor,
+                    mask_image=[r.mask for r in requests],
+                    masked_image_latents=masked_image_latents,
+                    image=[r.human_img for r in requests],
+                    height=height,
+                    width=width,
+                    ip_adapter_image=[r.garm_img for r in requests],
+                    guidance_scale=guidance_scale,
+                    cfg_truncation=requests[0].cfg_truncation,
+                    stage_timer=timer,
+                )[0]
+        for request_timer in timers:
+            request_timer.merge(timer, batch_size=len(requests))
+        return images
+
+    def warmup(
+        self,
+        batch_sizes: Optional[Sequence[int]] = None,
+        sizes: Optional[Sequence[Tuple[int, int]]] = None,
+        sampler: str = "ddpm",
+        freeze: bool = True,
+    ) -> Dict:
+        r"""
+        Runs a blank batch of every batch size in `batch_sizes` (1 to `max_batch_size` by default) and `(width,
+        height)` in `sizes` (the output size by default) through the pipeline, half of the steps with classifier free
+        guidance and half without. With the compiled step of the pipeline enabled this captures the denoising step of
+        each of these shapes and then, with `freeze`, stops capturing, so other shapes (e.g. region of interest
+        sizes not warmed up) run eagerly instead of being captured on a request path. Has to be called before the
+        first request. Returns the report of the compiled step, empty without one.
+        """
+        if self._worker is not None:
+            raise RuntimeError("The try-on server has to be warmed up before it serves requests.")
+        compiled_step = getattr(self.pipe, "compiled_step", None)
+        garm_img = PIL.Image.new("RGB", (self.width, self.height), (127, 127, 127))
+        for width, height in sizes or [(self.width, self.height)]:
+            human_img = PIL.Image.new("RGB", (width, height), (127, 127, 127))
+            mask = PIL.Image.new("L", (width, height), 0)
+            mask.paste(255, (width // 4, height // 4, 3 * width // 4, 3 * height // 4))
+            for batch_size in batch_sizes or range(1, self.max_batch_size + 1):
+                request = TryonRequest(
+                    human_img=human_img,
+                    mask=mask,
+                    pose_img=human_img,
+                    garm_img=garm_img,
+                    garment_des="",
+                    num_inference_steps=1,
+                    seed=0,
+                    sampler=sampler,
+                    cfg_truncation=0.5,
+                    size=None if (width, height) == (self.width, self.height) else (width, height),
+                )
+                self.run_batch([request] * batch_size)
+        if compiled_step is None:
+            return {}
+        if freeze:
+            compiled_step.freeze()
+        return compiled_step.report()
+
+    def report(self) -> Dict[str, float]:
+        with self._cond:
+            latencies = list(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+            elapsed = (
+                self._last_done - self._first_submit
+                if self._first_submit is not None and self._last_done is not None
+                else 0.0
+            )
+        if not latencies:
+            return {"requests": 0}
+        return {
+            "requests": len(latencies),
+            "batches": len(batch_sizes),
+            "mean_batch_size": float(np.mean(batch_sizes)),
+            "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+            "p50_latency": float(np.percentile(latencies, 50)),
+            "p99_latency": float(np.percentile(latencies, 99)),
+        }
+
+
+def benchmark_batching(
+    pipe,
+    requests: Sequence[TryonRequest],
+    batch_sizes: Sequence[int] = (1, 2, 4),
+    max_wait_ms: float = 50.0,
+    warmup: int = 1,
+) -> Dict[int, Dict[str, float]]:
+    r"""
+    Submits all of `requests` at once to a [`BatchingTryonServer`] per batch size and returns its report (throughput
+    in requests per second, p50/p99 latency in seconds) keyed by batch size.
+    """
+    reports = {}
+    for max_batch_size in batch_sizes:
+        server = BatchingTryonServer(pipe, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms).start()
+        for request in requests[:warmup]:
+            server(request)
+        server.reset_stats()
+        futures = [server.submit(request) for request in requests]
+        for future in futures:
+            future.result()
+        reports[max_batch_size] = server.report()
+        server.stop()
+    return reports
@@ -58,6 +58,7 @@ from diffusers.models.transformer_2d import Transformer2DModel
 import math
 
 from ip_adapter.ip_adapter import Resampler
+from src.deep_cache import DeepFeatureCache
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -1018,6 +1019,7 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         encoder_attention_mask: Optional[torch.Tensor] = None,
         return_dict: bool = True,
         garment_features: Optional[Tuple[torch.Tensor]] = None,
+        deep_cache: Optional[DeepFeatureCache] = None,
     ) -> Union[UNet2DConditionOutput, Tuple]:
         r"""
         The [`UNet2DConditionModel`] forward method.
@@ -1067,6 +1069,12 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                 additional residual to be added to UNet mid block output, for example from ControlNet side model
             down_intrablock_additional_residuals (`tuple` of `torch.Tensor`, *optional*):
                 additional residuals to be added within UNet down blocks, for example from T2I-Adapter side model(s)
+            garment_features (`list` of `torch.Tensor`, *optional*):
+                GarmentNet reference features, one per transformer block. They may have fewer rows than `sample`; the
+                leading rows of `sample` are then treated as an unconditional batch with an all-zero garment.
+            deep_cache (`DeepFeatureCache`, *optional*):
+                Deep feature reuse across denoising steps. On its reused steps only the shallow down and up blocks run,
+                on top of the deep features cached on the last full step.
 
         Returns:
             [`~models.unet_2d_condition.UNet2DConditionOutput`] or `tuple`:
@@ -1252,6 +1260,15 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
 
         curr_garment_feat_idx = 0
 
+        reuse_deep = False
+        if deep_cache is not None:
+            if deep_cache.branch >= len(self.down_blocks):
+                raise ValueError(
+                    f"`deep_cache.branch` has to be smaller than the number of down blocks ({len(self.down_blocks)}) but"
+                    f" is {deep_cache.branch}."
+                )
+            reuse_deep = deep_cache.reuse
+            first_cached_up_block = len(self.up_blocks) - deep_cache.branch
 
         # 3. down
         lora_scale = cross_attention_kwargs.get("scale", 1.0) if cross_attention_kwargs is not None else 1.0
@@ -1278,7 +1295,9 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             is_adapter = True
 
         down_block_res_samples = (sample,)
-        for downsample_block in self.down_blocks:
+        for i, downsample_block in enumerate(self.down_blocks):
+            if reuse_deep and i >= deep_cache.branch:
+                break
             if hasattr(downsample_block, "has_cross_attention") and downsample_block.has_cross_attention:
                 # For t2i-adapter CrossAttnDownBlock2D
                 additional_residuals = {}
@@ -1302,7 +1321,15 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                     sample += down_intrablock_additional_residuals.pop(0)
 
             down_block_res_samples += res_samples
-
+            if deep_cache is not None and i == deep_cache.branch - 1:
+                shallow_garment_feat_idx = curr_garment_feat_idx
+
+        if reuse_deep:
+            if is_controlnet or is_adapter:
+                raise ValueError("`deep_cache` can not be combined with ControlNet or T2I-Adapter residuals.")
+            sample, curr_garment_feat_idx, down_block_res_samples = deep_cache.restore(
+                curr_garment_feat_idx, down_block_res_samples
+            )
 
         if is_controlnet:
             new_down_block_res_samples = ()
@@ -1316,7 +1343,7 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             down_block_res_samples = new_down_block_res_samples
 
         # 4. mid
-        if self.mid_block is not None:
+        if self.mid_block is not None and not reuse_deep:
             if hasattr(self.mid_block, "has_cross_attention") and self.mid_block.has_cross_attention:
                 sample ,curr_garment_feat_idx= self.mid_block(
                     sample,
@@ -1347,6 +1374,10 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         # 5. up
         for i, upsample_block in enumerate(self.up_blocks):
             is_final_block = i == len(self.up_blocks) - 1
+            if reuse_deep and i < first_cached_up_block:
+                continue
+            if deep_cache is not None and not reuse_deep and i == first_cached_up_block:
+                deep_cache.store(sample, shallow_garment_feat_idx, curr_garment_feat_idx, len(down_block_res_samples))
 
             res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
             down_block_res_samples = down_block_res_samples[: -len(upsample_block.resnets)]
@@ -0,0 +1,122 @@
+import argparse
+import dataclasses
+import json
+import time
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKL
+from transformers import AutoTokenizer, CLIPImageProcessor, CLIPVisionModelWithProjection, CLIPTextModelWithProjection, CLIPTextModel
+
+from benchmark_server import load_requests
+from src.unet_hacked_tryon import UNet2DConditionModel
+from src.unet_hacked_garmnet import UNet2DConditionModel as UNet2DConditionModel_ref
+from src.tryon_pipeline import StableDiffusionXLInpaintPipeline as TryonPipeline
+from src.tryon_server import BatchingTryonServer
+from src.deep_cache import compare_images
+from src.samplers import load_scheduler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Latency and quality of samplers, step counts and CFG truncation on VITON-HD test pairs.")
+    parser.add_argument("--pretrained_model_name_or_path",type=str,default= "yisol/IDM-VTON",required=False,)
+    parser.add_argument("--data_dir",type=str,required=True,)
+    parser.add_argument("--width",type=int,default=768,)
+    parser.add_argument("--height",type=int,default=1024,)
+    parser.add_argument("--num_requests",type=int,default=8,)
+    parser.add_argument("--samplers",type=str,default="ddpm,dpmpp_2m,dpmpp_2m_karras,unipc,euler",)
+    parser.add_argument("--steps",type=str,default="10,15,20,30",)
+    parser.add_argument("--cfg_truncations",type=str,default="1.0,0.6,0.4", help="Fractions of the steps run with classifier free guidance.")
+    parser.add_argument("--reference",type=str,default="ddpm:30:1.0", help="sampler:steps:cfg_truncation every setting is compared against.")
+    parser.add_argument("--num_inference_steps",type=int,default=30,)
+    parser.add_argument("--seed", type=int, default=42,)
+    parser.add_argument("--output",type=str,default="sampler_sweep.json",)
+    args = parser.parse_args()
+    return args
+
+
+def run_setting(server, requests, sampler, steps, cfg_truncation):
+    images, seconds = [], []
+    for request in requests:
+        request = dataclasses.replace(
+            request,
+            sampler=sampler,
+            num_inference_steps=steps,
+            cfg_truncation=cfg_truncation if cfg_truncation < 1.0 else None,
+        )
+        start = time.perf_counter()
+        images.extend(server.run_batch([request]))
+        seconds.append(time.perf_counter() - start)
+    return images, seconds
+
+
+def main():
+    args = parse_args()
+    device = "cuda"
+
+    noise_scheduler = load_scheduler("ddpm", args.pretrained_model_name_or_path, subfolder="scheduler")
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae", torch_dtype=torch.float16)
+    unet = UNet2DConditionModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet", torch_dtype=torch.float16)
+    image_encoder = CLIPVisionModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder", torch_dtype=torch.float16)
+    unet_encoder = UNet2DConditionModel_ref.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet_encoder", torch_dtype=torch.float16)
+    text_encoder_one = CLIPTextModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder", torch_dtype=torch.float16)
+    text_encoder_two = CLIPTextModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder_2", torch_dtype=torch.float16)
+    tokenizer_one = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer", revision=None, use_fast=False)
+    tokenizer_two = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path, subfolder="tokenizer_2", revision=None, use_fast=False)
+    for model in (vae, unet, image_encoder, unet_encoder, text_encoder_one, text_encoder_two):
+        model.requires_grad_(False)
+
+    pipe = TryonPipeline.from_pretrained(
+            args.pretrained_model_name_or_path,
+            unet=unet,
+            vae=vae,
+            feature_extractor= CLIPImageProcessor(),
+            text_encoder = text_encoder_one,
+            text_encoder_2 = text_encoder_two,
+            tokenizer = tokenizer_one,
+            tokenizer_2 = tokenizer_two,
+            scheduler = noise_scheduler,
+            image_encoder=image_encoder,
+            unet_encoder = unet_encoder,
+            torch_dtype=torch.float16,
+    ).to(device)
+    pipe.set_progress_bar_config(disable=True)
+    pipe.enable_prompt_cache()
+
+    requests = load_requests(args)
+    # no step buckets, every setting runs with its own step count
+    server = BatchingTryonServer(pipe, max_batch_size=1, step_buckets=(), height=args.height, width=args.width)
+
+    sampler, steps, cfg_truncation = args.reference.split(":")
+    run_setting(server, requests[:1], sampler, int(steps), float(cfg_truncation))  # warmup
+    reference, reference_seconds = run_setting(server, requests, sampler, int(steps), float(cfg_truncation))
+    results = [
+        {
+            "sampler": sampler,
+            "steps": int(steps),
+            "cfg_truncation": float(cfg_truncation),
+            "seconds": float(np.mean(reference_seconds)),
+            "reference": True,
+        }
+    ]
+    for sampler in args.samplers.split(","):
+        for steps in [int(s) for s in args.steps.split(",") if s]:
+            for cfg_truncation in [float(c) for c in args.cfg_truncations.split(",") if c]:
+                images, seconds = run_setting(server, requests, sampler, steps, cfg_truncation)
+                result = {
+                    "sampler": sampler,
+                    "steps": steps,
+                    "cfg_truncation": cfg_truncation,
+                    "seconds": float(np.mean(seconds)),
+                    "speedup": float(np.mean(reference_seconds) / np.mean(seconds)),
+                    **compare_images(images, reference),
+                }
+                print(json.dumps(result))
+                results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,10 +16,12 @@ from transformers import CLIPTextModel, CLIPTokenizer, CLIPVisionModelWithProjec
 from src.unet_hacked_tryon import UNet2DConditionModel
 from src.unet_hacked_garmnet import UNet2DConditionModel as UNet2DConditionModel_ref
 from src.tryon_pipeline import StableDiffusionXLInpaintPipeline as TryonPipeline
+from src.train_cache import CachedVitonHDDataset, sample_latents
+from src.train_augment import BatchAugmenter, TRAIN_AUGMENT_MODES
 
 from ip_adapter.ip_adapter import Resampler
 from diffusers.utils.import_utils import is_xformers_available
-from typing import Literal, Tuple,List
+from typing import Literal, Optional, Tuple,List
 import torch.utils.data as data
 import math
 from tqdm.auto import tqdm
@@ -35,10 +37,13 @@ class VitonHDDataset(data.Dataset):
         phase: Literal["train", "test"],
         order: Literal["paired", "unpaired"] = "paired",
         size: Tuple[int, int] = (512, 384),
+        augment: Optional[bool] = None,
     ):
         super(VitonHDDataset, self).__init__()
         self.dataroot = dataroot_path
         self.phase = phase
+        # random flip, color jitter, scale and shift, on for the train phase by default
+        self.augment = phase == "train" if augment is None else augment
         self.height = size[0]
         self.width = size[1]
         self.size = size
@@ -149,7 +154,7 @@ class VitonHDDataset(data.Dataset):
  
 
 
-        if self.phase == "train":
+        if self.augment:
             if random.random() > 0.5:
                 cloth = self.flip_transform(cloth)
                 mask = self.flip_transform(mask)
@@ -286,6 +291,9 @@ def parse_args():
     parser.add_argument("--adam_epsilon", type=float, default=1e-08, help="Epsilon value for the Adam optimizer")
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
     parser.add_argument("--data_dir", type=str, default="/home/omnious/workspace/yisol/Dataset/VITON-HD/zalando", help="For distributed training: local_rank")
+    parser.add_argument("--train_cache_dir", type=str, default=None, help="Cache written by precompute_train_cache.py; the frozen VAE, text and image encoders are then not run in the train step.")
+    parser.add_argument("--dataloader_num_workers", type=int, default=16, help="Train dataloader workers, a few are enough with --train_cache_dir or --gpu_augment.")
+    parser.add_argument("--gpu_augment", type=str, default="off", choices=TRAIN_AUGMENT_MODES, help="Run the flip/color/scale/shift augmentation batch-wise on the device, on the images ('pixel') or with the geometric part on the VAE latents ('latent').")
     
     args = parser.parse_args()
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
@@ -432,18 +440,38 @@ def main():
         eps=args.adam_epsilon,
     )
     
-    train_dataset = VitonHDDataset(
-        dataroot_path=args.data_dir,
-        phase="train",
-        order="paired",
-        size=(args.height, args.width),
-    )
+    augmenter = None
+    if args.train_cache_dir is not None and args.gpu_augment == "pixel":
+        raise ValueError("The training cache only holds latents, use `--gpu_augment latent` with `--train_cache_dir`.")
+    if args.train_cache_dir is not None and args.gpu_augment == "latent":
+        # the cached dataset already flips, garment colors cannot change in the cache
+        augmenter = BatchAugmenter(flip_prob=0.0, color_prob=0.0)
+    elif args.gpu_augment != "off":
+        augmenter = BatchAugmenter()
+    if args.gpu_augment == "latent":
+        augmenter.set_latent_fill(vae)
+
+    if args.train_cache_dir is not None:
+        train_dataset = CachedVitonHDDataset(args.train_cache_dir)
+        if (train_dataset.index["height"], train_dataset.index["width"]) != (args.height, args.width):
+            raise ValueError(
+                f"The training cache was computed at {train_dataset.index['height']}x{train_dataset.index['width']},"
+                f" not at {args.height}x{args.width}."
+            )
+    else:
+        train_dataset = VitonHDDataset(
+            dataroot_path=args.data_dir,
+            phase="train",
+            order="paired",
+            size=(args.height, args.width),
+            augment=augmenter is None,
+        )
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         pin_memory=True,
         shuffle=False,
         batch_size=args.train_batch_size,
-        num_workers=16,
+        num_workers=args.dataloader_num_workers,
     )
     test_dataset = VitonHDDataset(
         dataroot_path=args.data_dir,
@@ -595,25 +623,108 @@ def main():
 
 
 
-                pixel_values = batch["image"].to(dtype=vae.dtype)
-                model_input = vae.encode(pixel_values).latent_dist.sample()
-                model_input = model_input * vae.config.scaling_factor
-
-                masked_latents = vae.encode(
-                    batch["im_mask"].reshape(batch["image"].shape).to(dtype=vae.dtype)
-                ).latent_dist.sample()
-                masked_latents = masked_latents * vae.config.scaling_factor
-                masks = batch["inpaint_mask"]
-                # resize the mask to latents shape as we concatenate the mask to the latents
-                mask = torch.stack(
-                    [
-                        torch.nn.functional.interpolate(masks, size=(args.height // 8, args.width // 8))
-                    ]
-                )
-                mask = mask.reshape(-1, 1, args.height // 8, args.width // 8)
-
-                pose_map = vae.encode(batch["pose_img"].to(dtype=vae.dtype)).latent_dist.sample()
-                pose_map = pose_map * vae.config.scaling_factor
+                if args.train_cache_dir is not None:
+                    # everything the frozen encoders produce comes from the precomputed cache
+                    model_input = sample_latents(batch["image_moments"], vae.config.scaling_factor).to(vae.dtype)
+                    masked_latents = sample_latents(batch["masked_moments"], vae.config.scaling_factor).to(vae.dtype)
+                    mask = batch["mask"].to(dtype=vae.dtype)
+                    pose_map = sample_latents(batch["pose_moments"], vae.config.scaling_factor).to(vae.dtype)
+                    cloth_values = sample_latents(batch["cloth_moments"], vae.config.scaling_factor).to(vae.dtype)
+                    encoder_hidden_states = batch["caption_embeds"].to(dtype=weight_dtype)
+                    pooled_text_embeds = batch["caption_pooled"].to(dtype=weight_dtype)
+                    text_embeds_cloth = batch["cloth_embeds"].to(dtype=weight_dtype)
+                    image_embeds = batch["clip_hidden"].to(dtype=weight_dtype)
+                    if augmenter is not None:
+                        augment_params = augmenter.sample(model_input.shape[0], model_input.device)
+                        model_input, masked_latents, pose_map, mask = augmenter.augment_latents(
+                            model_input, masked_latents, pose_map, mask, augment_params
+                        )
+                else:
+                    if augmenter is not None:
+                        augment_params = augmenter.sample(batch["image"].shape[0], accelerator.device)
+                        if args.gpu_augment == "pixel":
+                            batch = augmenter.augment_pixels(batch, augment_params)
+                        else:
+                            batch = augmenter.augment_garment(batch, augment_params)
+
+                    pixel_values = batch["image"].to(dtype=vae.dtype)
+                    model_input = vae.encode(pixel_values).latent_dist.sample()
+                    model_input = model_input * vae.config.scaling_factor
+
+                    masked_latents = vae.encode(
+                        batch["im_mask"].reshape(batch["image"].shape).to(dtype=vae.dtype)
+                    ).latent_dist.sample()
+                    masked_latents = masked_latents * vae.config.scaling_factor
+                    masks = batch["inpaint_mask"]
+                    # resize the mask to latents shape as we concatenate the mask to the latents
+                    mask = torch.stack(
+                        [
+                            torch.nn.functional.interpolate(masks, size=(args.height // 8, args.width // 8))
+                        ]
+                    )
+                    mask = mask.reshape(-1, 1, args.height // 8, args.width // 8)
+
+                    pose_map = vae.encode(batch["pose_img"].to(dtype=vae.dtype)).latent_dist.sample()
+                    pose_map = pose_map * vae.config.scaling_factor
+
+                    if args.gpu_augment == "latent":
+                        model_input, masked_latents, pose_map, mask = augmenter.augment_latents(
+                            model_input, masked_latents, pose_map, mask, augment_params
+                        )
+
+                    text_input_ids = tokenizer(
+                        batch['caption'],
+                        max_length=tokenizer.model_max_length,
+                        padding="max_length",
+                        truncation=True,
+                        return_tensors="pt"
+                    ).input_ids
+                    text_input_ids_2 = tokenizer_2(
+                        batch['caption'],
+                        max_length=tokenizer_2.model_max_length,
+                        padding="max_length",
+                        truncation=True,
+                        return_tensors="pt"
+                    ).input_ids
+
+                    encoder_output = text_encoder(text_input_ids.to(accelerator.device), output_hidden_states=True)
+                    text_embeds = encoder_output.hidden_states[-2]
+                    encoder_output_2 = text_encoder_2(text_input_ids_2.to(accelerator.device), output_hidden_states=True)
+                    pooled_text_embeds = encoder_output_2[0]
+                    text_embeds_2 = encoder_output_2.hidden_states[-2]
+                    encoder_hidden_states = torch.concat([text_embeds, text_embeds_2], dim=-1) # concat
+
+                    img_emb_list = []
+                    for i in range(batch['cloth'].shape[0]):
+                        img_emb_list.append(batch['cloth'][i])
+
+                    image_embeds = torch.cat(img_emb_list,dim=0)
+                    image_embeds = image_encoder(image_embeds, output_hidden_states=True).hidden_states[-2]
+
+                    cloth_values = batch["cloth_pure"].to(accelerator.device,dtype=vae.dtype)
+                    cloth_values = vae.encode(cloth_values).latent_dist.sample()
+                    cloth_values = cloth_values * vae.config.scaling_factor
+
+                    text_input_ids = tokenizer(
+                        batch['caption_cloth'],
+                        max_length=tokenizer.model_max_length,
+                        padding="max_length",
+                        truncation=True,
+                        return_tensors="pt"
+                    ).input_ids
+                    text_input_ids_2 = tokenizer_2(
+                        batch['caption_cloth'],
+                        max_length=tokenizer_2.model_max_length,
+                        padding="max_length",
+                        truncation=True,
+                        return_tensors="pt"
+                    ).input_ids
+
+                    encoder_output = text_encoder(text_input_ids.to(accelerator.device), output_hidden_states=True)
+                    text_embeds_cloth = encoder_output.hidden_states[-2]
+                    encoder_output_2 = text_encoder_2(text_input_ids_2.to(accelerator.device), output_hidden_states=True)
+                    text_embeds_2_cloth = encoder_output_2.hidden_states[-2]
+                    text_embeds_cloth = torch.concat([text_embeds_cloth, text_embeds_2_cloth], dim=-1) # concat
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(model_input)
@@ -625,29 +736,6 @@ def main():
                 # Add noise to the latents according to the noise magnitude at each timestep
                 noisy_latents = noise_scheduler.add_noise(model_input, noise, timesteps)
                 latent_model_input = torch.cat([noisy_latents, mask,masked_latents,pose_map], dim=1)
-            
-            
-                text_input_ids = tokenizer(
-                    batch['caption'],
-                    max_length=tokenizer.model_max_length,
-                    padding="max_length",
-                    truncation=True,
-                    return_tensors="pt"
-                ).input_ids
-                text_input_ids_2 = tokenizer_2(
-                    batch['caption'],
-                    max_length=tokenizer_2.model_max_length,
-                    padding="max_length",
-                    truncation=True,
-                    return_tensors="pt"
-                ).input_ids
-
-                encoder_output = text_encoder(text_input_ids.to(accelerator.device), output_hidden_states=True)
-                text_embeds = encoder_output.hidden_states[-2]
-                encoder_output_2 = text_encoder_2(text_input_ids_2.to(accelerator.device), output_hidden_states=True)
-                pooled_text_embeds = encoder_output_2[0]
-                text_embeds_2 = encoder_output_2.hidden_states[-2]
-                encoder_hidden_states = torch.concat([text_embeds, text_embeds_2], dim=-1) # concat
 
 
                 def compute_time_ids(original_size, crops_coords_top_left = (0,0)):
@@ -661,48 +749,13 @@ def main():
                 add_time_ids = torch.cat(
                     [compute_time_ids((args.height, args.height)) for i in range(bsz)]
                 )
-                        
-                img_emb_list = []
-                for i in range(bsz):
-                    img_emb_list.append(batch['cloth'][i])
-                
-                image_embeds = torch.cat(img_emb_list,dim=0)
-                image_embeds = image_encoder(image_embeds, output_hidden_states=True).hidden_states[-2]
-                ip_tokens =image_proj_model(image_embeds)
-            
 
+                ip_tokens =image_proj_model(image_embeds)
 
                 # add cond
                 unet_added_cond_kwargs = {"text_embeds": pooled_text_embeds, "time_ids": add_time_ids}
                 unet_added_cond_kwargs["image_embeds"] = ip_tokens
 
-                cloth_values = batch["cloth_pure"].to(accelerator.device,dtype=vae.dtype)
-                cloth_values = vae.encode(cloth_values).latent_dist.sample()
-                cloth_values = cloth_values * vae.config.scaling_factor
-
-
-                text_input_ids = tokenizer(
-                    batch['caption_cloth'],
-                    max_length=tokenizer.model_max_length,
-                    padding="max_length",
-                    truncation=True,
-                    return_tensors="pt"
-                ).input_ids
-                text_input_ids_2 = tokenizer_2(
-                    batch['caption_cloth'],
-                    max_length=tokenizer_2.model_max_length,
-                    padding="max_length",
-                    truncation=True,
-                    return_tensors="pt"
-                ).input_ids
-
-            
-                encoder_output = text_encoder(text_input_ids.to(accelerator.device), output_hidden_states=True)
-                text_embeds_cloth = encoder_output.hidden_states[-2]
-                encoder_output_2 = text_encoder_2(text_input_ids_2.to(accelerator.device), output_hidden_states=True)
-                text_embeds_2_cloth = encoder_output_2.hidden_states[-2]
-                text_embeds_cloth = torch.concat([text_embeds_cloth, text_embeds_2_cloth], dim=-1) # concat
-
 
                 down,reference_features = unet_encoder(cloth_values,timesteps, text_embeds_cloth,return_dict=False)
                 reference_features = list(reference_features)